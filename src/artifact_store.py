@@ -0,0 +1,224 @@
+import os
+import shutil
+import argparse
+import numpy as np
+from PIL import Image
+
+# How intermediate images are handed from one stage to the next:
+#   png:  PNG files only (default)
+#   npy:  uncompressed .npy sidecars only, memory-mapped by the reading stage
+#         (no PNG encode/decode; PNGs can be exported later with this script)
+#   both: .npy sidecars for the next stage plus PNGs for inspection
+#   container: one compressed file per job (job_container.py) holding every
+#         artifact below the job root; masks bit-packed, label maps uint8.
+#         Artifacts outside a job root fall back to .npy sidecars.
+# The artifact keeps its PNG path everywhere (stage graph, cache, CLI args);
+# the sidecar lives next to it as <path>.npy. Subprocesses inherit the mode.
+ARTIFACT_MODE_ENV = "VITON_ARTIFACT_MODE"
+MODES = ["png", "npy", "both", "container"]
+
+
+def artifact_mode():
+    mode = os.environ.get(ARTIFACT_MODE_ENV, "png")
+    return mode if mode in MODES else "png"
+
+
+def sidecar(path):
+    return path + ".npy"
+
+
+def _container(path):
+    """(job container, name) that artifact `path` is written to in container mode, else None."""
+    if artifact_mode() != "container":
+        return None
+    import job_container
+    return job_container.find(path)
+
+
+def packed(path):
+    """(job container, name) if artifact `path` is stored in a job container, else None."""
+    found = _container(path)
+    return found if found and found[1] in found[0] else None
+
+
+def prepare_root(root):
+    """Creates the job container at `root` in container mode (call once per job output folder)."""
+    if artifact_mode() == "container":
+        import job_container
+        job_container.create(root)
+
+
+def exists(path):
+    return packed(path) is not None or os.path.exists(path) or os.path.exists(sidecar(path))
+
+
+def resolve(path):
+    """The file currently holding artifact `path`: its .npy sidecar if there is one, else `path`."""
+    side = sidecar(path)
+    return side if os.path.exists(side) else path
+
+
+def _convert(arr, mode):
+    """Array equivalent of PIL's Image.convert for the modes the stages use."""
+    if mode is None:
+        return arr
+    if mode == "L":
+        if arr.ndim == 2:
+            return arr
+        # Same integer ITU-R 601-2 luma transform as PIL
+        rgb = arr[:, :, :3].astype(np.uint32)
+        return ((rgb[:, :, 0] * 19595 + rgb[:, :, 1] * 38470 + rgb[:, :, 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+    if arr.ndim == 2:
+        arr = np.repeat(arr[:, :, None], 3, axis=2)
+    if mode == "RGB":
+        return arr[:, :, :3]
+    if mode == "RGBA":
+        if arr.shape[2] == 4:
+            return arr
+        return np.dstack([arr[:, :, :3], np.full(arr.shape[:2], 255, np.uint8)])
+    raise ValueError(f"Unsupported mode {mode!r}")
+
+
+def read_array(path, mode=None):
+    """
+    Decoded pixels of artifact `path` as a numpy array (H,W) or (H,W,C), RGB order.
+    A sidecar is memory-mapped read-only (copy before modifying in place);
+    otherwise the image file is decoded. Sidecars of palette images (SCHP) hold
+    the label indices, like np.array(Image.open(...)) does.
+    mode: optional "L" / "RGB" / "RGBA" conversion.
+    """
+    found = packed(path)
+    if found:
+        return _convert(found[0].read(found[1]), mode)
+    side = sidecar(path)
+    if os.path.exists(side):
+        return _convert(np.load(side, mmap_mode="r"), mode)
+    img = Image.open(path)
+    return np.array(img.convert(mode) if mode else img)
+
+
+def read_image(path, mode=None):
+    """Artifact `path` as a PIL image (for stages that resize with PIL)."""
+    if packed(path) or os.path.exists(sidecar(path)):
+        return Image.fromarray(np.ascontiguousarray(read_array(path, mode)))
+    img = Image.open(path)
+    return img.convert(mode) if mode else img
+
+
+def _save_sidecar(path, arr):
+    side = sidecar(path)
+    tmp = f"{side}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(arr))
+    # Readers never see a half-written array
+    os.replace(tmp, side)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_array(path, arr, png=False, palette=None):
+    """
+    Stores artifact `path` (uint8 array, RGB order) according to the artifact mode.
+    png: also write the PNG in npy mode (outputs someone will look at).
+    palette: write a (H,W) label array as a palette PNG with this palette (SCHP style).
+    Stale files of the other kind are removed so readers never mix runs.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    mode = artifact_mode()
+    found = _container(path)
+    if found:
+        found[0].write(found[1], arr, palette)
+        _remove(sidecar(path))
+        if png:
+            _save_png(path, arr, palette)
+        else:
+            _remove(path)
+        return
+    if mode == "png":
+        _remove(sidecar(path))
+    else:
+        _save_sidecar(path, arr)
+    if png or mode not in ("npy", "container"):
+        _save_png(path, arr, palette)
+    else:
+        _remove(path)
+
+
+def _save_png(path, arr, palette=None):
+    img = Image.fromarray(np.ascontiguousarray(arr))
+    if palette is not None:
+        img.putpalette(palette)
+    img.save(path)
+
+
+def import_record(path, record):
+    """Stores an encoded container record (stage cache) as artifact `path`."""
+    found = _container(path)
+    if found:
+        found[0].append_record(found[1], record)
+        _remove(sidecar(path))
+        _remove(path)
+        return
+    import job_container
+    meta, arr = job_container.unpack_record(record)
+    write_array(path, arr, palette=meta.get("palette"))
+
+
+def import_png(path):
+    """
+    Brings a PNG written by an external tool (e.g. SCHP) in line with the artifact mode.
+    In container mode a .npy sidecar (e.g. restored from the stage cache) is taken as well.
+    """
+    mode = artifact_mode()
+    if mode == "png":
+        _remove(sidecar(path))
+        return
+    if _container(path):
+        if os.path.exists(sidecar(path)):
+            write_array(path, np.load(sidecar(path)))
+        else:
+            img = Image.open(path)
+            write_array(path, np.array(img), palette=img.getpalette() if img.mode == "P" else None)
+        return
+    _save_sidecar(path, np.array(Image.open(path)))
+    if mode != "both":
+        os.remove(path)
+
+
+def export_png(path, dest=None):
+    """Writes artifact `path` as a PNG at `dest` (default: `path`) for tools that need a file."""
+    dest = dest or path
+    found = packed(path)
+    if found:
+        _save_png(dest, read_array(path), found[0].meta(found[1]).get("palette"))
+        return dest
+    if not os.path.exists(sidecar(path)):
+        if os.path.abspath(dest) != os.path.abspath(path):
+            shutil.copy(path, dest)
+        return dest
+    Image.fromarray(np.ascontiguousarray(read_array(path))).save(dest)
+    return dest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write PNGs for the .npy and job container artifacts under the given folders")
+    parser.add_argument("dirs", nargs="+")
+    args = parser.parse_args(argv)
+
+    count = 0
+    for root_dir in args.dirs:
+        for dirpath, _, filenames in os.walk(root_dir):
+            for name in filenames:
+                if name.endswith(".png.npy"):
+                    export_png(os.path.join(dirpath, name[:-4]))
+                    count += 1
+                elif name == "job.vtc":
+                    import job_container
+                    count += job_container.export(os.path.join(dirpath, name))
+    print(f"Exported {count} PNGs.")
+
+if __name__ == "__main__":
+    main()
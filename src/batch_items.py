@@ -0,0 +1,51 @@
+import traceback
+
+# Per-item status for the main_batch functions of the model stages (see
+# model_worker.run_module_batch). Jobs merged into one batch must not fail
+# together because one of them has bad arguments or an unreadable input:
+#
+#   all_args = parse_each(build_parser(), argv_list)
+#   return run_items(all_args, lambda indices: process([all_args[i] for i in indices]))
+
+
+def parse_each(parser, argv_list):
+    """Parsed args per argv, None where the arguments are invalid."""
+    parsed = []
+    for argv in argv_list:
+        try:
+            parsed.append(parser.parse_args(argv))
+        except SystemExit:
+            print(f"!!! Invalid arguments: {' '.join(argv)}")
+            parsed.append(None)
+    return parsed
+
+
+def _attempt(run, indices):
+    try:
+        results = run(indices)
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        return None
+    return [True] * len(indices) if results is None else [r is not False for r in results]
+
+
+def run_items(all_args, run, key=None):
+    """
+    One bool per item. run(indices) processes the items at `indices` together (one
+    merged batch per key(args)) and raises on failure, or returns one bool per index.
+    If a merged batch raises, its items are retried one at a time, so only the
+    failing ones fail. Items whose arguments did not parse (None) fail.
+    """
+    results = [False] * len(all_args)
+    groups = {}
+    for i, args in enumerate(all_args):
+        if args is not None:
+            groups.setdefault(key(args) if key else None, []).append(i)
+    for indices in groups.values():
+        status = _attempt(run, indices)
+        if status is None and len(indices) > 1:
+            print(f"!!! Batch of {len(indices)} failed, retrying its items one at a time.")
+            status = [(_attempt(run, [i]) or [False])[0] for i in indices]
+        for i, ok in zip(indices, status or [False] * len(indices)):
+            results[i] = ok
+    return results
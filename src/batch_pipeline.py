@@ -0,0 +1,206 @@
+import os
+import sys
+import csv
+import json
+import hashlib
+import argparse
+from pathlib import Path
+from master_pipeline import add_pipeline_args, StageRunner, pair_stages, roi_pad, ROI_PAD
+from preprocess_pipeline import person_stages, garment_stages, target_masks_stage
+from stage_cache import open_cache
+from stage_graph import run_graph
+from timing_trace import span, start_trace, finish_trace
+from artifact_store import ARTIFACT_MODE_ENV, prepare_root
+from garment_catalog import catalog_ref, is_catalog_ref, ref_id, open_catalog
+import rembg_sessions
+
+# Per-pair options a manifest row may override (defaults come from the CLI)
+PAIR_OPTIONS = ["type", "sleeve_type", "initial_sleeve"]
+
+
+def asset_id(path):
+    """Stable directory name for an input image: <stem>_<hash of its absolute path>."""
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+    return f"{Path(path).stem}_{digest}"
+
+
+def read_manifest(manifest_path, cross=False):
+    """
+    Returns a list of pair dicts {"person", "garment", and optional PAIR_OPTIONS}.
+
+    CSV:   columns person,garment[,type,sleeve_type,initial_sleeve]
+    JSONL: {"person": ..., "garment": ...} per line, or
+           {"persons": [...], "garments": [...]} to cross those lists.
+    Catalog garments: "garment_id" / "garment_ids" instead of "garment" / "garments"
+    (become "catalog:<id>" garments, see garment_catalog.py).
+    cross: cross every person in the manifest with every garment in it
+           (rows may then leave either column empty).
+    Relative paths are resolved against the manifest's folder.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    def resolve(p):
+        return p if not p or os.path.isabs(p) or is_catalog_ref(p) else os.path.normpath(os.path.join(base_dir, p))
+
+    rows = []
+    if manifest_path.lower().endswith(".csv"):
+        with open(manifest_path, newline="") as f:
+            for row in csv.DictReader(f):
+                rows.append({k.strip(): (v or "").strip() for k, v in row.items() if k})
+    else:
+        with open(manifest_path) as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError as e:
+                    raise ValueError(f"{manifest_path}:{line_no}: invalid JSON ({e})")
+
+    pairs, persons, garments = [], [], []
+    for row in rows:
+        options = {k: row[k] for k in PAIR_OPTIONS if row.get(k)}
+        row_persons = [resolve(p) for p in row.get("persons", [])] or ([resolve(row["person"])] if row.get("person") else [])
+        row_garments = [resolve(g) for g in row.get("garments", [])] or ([resolve(row["garment"])] if row.get("garment") else [])
+        row_garments += [catalog_ref(g) for g in row.get("garment_ids", [])] or ([catalog_ref(row["garment_id"])] if row.get("garment_id") else [])
+        persons += row_persons
+        garments += [(g, options) for g in row_garments]
+        if not cross:
+            if not row_persons or not row_garments:
+                raise ValueError(f"Manifest row {row} needs both a person and a garment (or use --cross)")
+            pairs += [dict(options, person=p, garment=g) for p in row_persons for g in row_garments]
+
+    if cross:
+        unique_persons = list(dict.fromkeys(persons))
+        # A garment listed with different options (type, sleeve type...) is tried on with each of them
+        unique_garments = {(g, json.dumps(opts, sort_keys=True)): (g, opts) for g, opts in garments}
+        pairs = [dict(opts, person=p, garment=g) for p in unique_persons for g, opts in unique_garments.values()]
+    # Duplicates are dropped by build_batch, once the CLI defaults are applied
+    return pairs
+
+
+def build_batch(pairs, args, run_stage, cache=None):
+    """
+    One graph for the whole batch: person-side stages once per unique person,
+    garment-side stages once per unique (garment, type), the target mask once per
+    person (all the sleeve types its pairs need, in one pass) and only
+    flow/agnostic/compositing/restore per pair. Pairs that resolve to the same
+    options (e.g. one row spells out a default another leaves empty) run once.
+    Returns (stages, results) where results describes each unique pair's outputs.
+    """
+    o_root = args.output_root
+    prepare_root(o_root)
+    role_runner = run_stage.role_runner()
+    stages, results = [], []
+    seen_persons, seen_garments, seen_masks, seen_pairs = set(), set(), set(), set()
+
+    # Sleeve types needed per person, so its target mask variants are made by one stage
+    variants = ["none", "half", "full"] if args.mask_variants == "all" else [t for t in args.mask_variants.split(",") if t]
+    person_sleeves = {}
+    for pair in pairs:
+        sleeve_types = person_sleeves.setdefault(asset_id(pair["person"]), list(variants))
+        sleeve_type = pair.get("sleeve_type", args.sleeve_type)
+        if sleeve_type not in sleeve_types:
+            sleeve_types.append(sleeve_type)
+
+    for pair in pairs:
+        opts = {k: pair.get(k, getattr(args, k)) for k in PAIR_OPTIONS}
+        person_img, garment_img = pair["person"], pair["garment"]
+        pid = asset_id(person_img)
+        garment_id = ref_id(garment_img) if is_catalog_ref(garment_img) else None
+        if garment_id:
+            if not args.catalog or garment_id not in open_catalog(args.catalog):
+                raise ValueError(f"Garment {garment_id!r} is not in the catalog ({args.catalog})")
+            # Preprocessed at ingestion (flat): nothing to schedule for the garment
+            gid = f"catalog_{garment_id}"
+            seen_garments.add(gid)
+        else:
+            gid = f"{asset_id(garment_img)}_{opts['type']}"
+        pair_id = f"{pid}__{gid}__{opts['sleeve_type']}_{opts['initial_sleeve']}"
+        if pair_id in seen_pairs:
+            print(f"[BATCH] Skipping duplicate pair {pair_id}")
+            continue
+        seen_pairs.add(pair_id)
+        person_root = os.path.join(o_root, "persons", pid)
+        garment_root = os.path.join(o_root, "garments", gid)
+        target_mask_dir = os.path.join(person_root, "target_mask")
+
+        if pid not in seen_persons:
+            seen_persons.add(pid)
+            stages += person_stages(person_img, person_root, args.project_root, role_runner, cache, tag=pid,
+                                    densepose_short_side=args.densepose_short_side, roi_pad=roi_pad(args))
+            stages.append(target_masks_stage(person_root, target_mask_dir, person_sleeves[pid], role_runner, cache, tag=pid))
+        if gid not in seen_garments:
+            seen_garments.add(gid)
+            stages += garment_stages(garment_img, opts["type"], garment_root, args.project_root, role_runner, cache, tag=gid)
+        seen_masks.add((pid, opts["sleeve_type"]))
+
+        pair_args = argparse.Namespace(**dict(vars(args), **opts))
+        p_stages, final_output, comp_path = pair_stages(run_stage, pair_args, person_img, person_root, garment_root,
+                                                        os.path.join(target_mask_dir, f"target_mask_{opts['sleeve_type']}.png"),
+                                                        os.path.join(o_root, "pairs", pair_id), cache, tag=pair_id,
+                                                        garment_id=garment_id)
+        stages += p_stages
+        results.append(dict(pair, **opts, pair_id=pair_id, tryon=final_output, composite=comp_path))
+
+    print(f"[BATCH] {len(results)} pairs: {len(seen_persons)} unique persons, {len(seen_garments)} unique garments, "
+          f"{len(seen_masks)} target masks -> {len(stages)} stages")
+    return stages, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch VITON pipeline over a manifest of person/garment pairs")
+    parser.add_argument("--manifest", required=True, help="CSV or JSONL manifest (see read_manifest)")
+    parser.add_argument("--cross", action="store_true", help="Cross every person in the manifest with every garment")
+    parser.add_argument("--stop_on_error", action="store_true", help="Stop the batch at the first failing stage")
+    add_pipeline_args(parser)
+    parser.set_defaults(roi_pad=ROI_PAD)
+    args = parser.parse_args(argv)
+
+    run_stage = StageRunner(args)
+    if args.stop_workers:
+        run_stage.stop_workers()
+        return
+
+    pairs = read_manifest(args.manifest, cross=args.cross)
+    if not pairs:
+        print("!!! Manifest contains no pairs.")
+        sys.exit(1)
+    os.makedirs(args.output_root, exist_ok=True)
+
+    os.environ[ARTIFACT_MODE_ENV] = args.artifact_mode
+    rembg_sessions.configure(args.rembg_person_model, args.rembg_garment_model, args.rembg_threads)
+    cache = open_cache(args.cache_dir, args.cache_max_gb)
+    stages, results = build_batch(pairs, args, run_stage, cache)
+    stage_status = {}
+    if args.trace:
+        start_trace(args.trace)
+    try:
+        with span("batch_pipeline", cat="pipeline", pairs=len(pairs)):
+            ok = run_graph(stages, max_workers=args.jobs, keep_going=not args.stop_on_error, status=stage_status)
+    finally:
+        if args.trace:
+            finish_trace(args.trace)
+            print(f"Timing trace: {args.trace}")
+
+    # Summary (one JSON line per pair)
+    summary_path = os.path.join(args.output_root, "batch_results.jsonl")
+    # A pair succeeded when the stage producing its try-on did (run or restored from the cache)
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    n_ok = 0
+    with open(summary_path, "w") as f:
+        for res in results:
+            res["status"] = "ok" if stage_status.get(producers.get(os.path.abspath(res["tryon"]))) == "done" else "failed"
+            n_ok += res["status"] == "ok"
+            f.write(json.dumps(res) + "\n")
+
+    print("\n" + "="*50)
+    print(f"BATCH COMPLETED: {n_ok}/{len(results)} pairs succeeded")
+    print(f"Summary: {summary_path}")
+    print("="*50)
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
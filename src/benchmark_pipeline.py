@@ -0,0 +1,579 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+import numpy as np
+from PIL import Image
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import cv2
+import artifact_store
+import timing_trace
+from timing_trace import span
+from stage_cache import file_identity
+
+# ---------------------------------------------------------------------------
+# Synthetic fixtures
+# ---------------------------------------------------------------------------
+# Each body part is painted in its own colour so the SCHP / DensePose stand-ins
+# can recover the label map from the rembg output.
+BACKGROUND_RGB = (235, 235, 235)
+PART_COLORS = {
+    2: (20, 20, 20),     # hair
+    13: (230, 60, 150),  # face (far from every mix of its neighbours, so edges are not read as face)
+    5: (30, 90, 200),    # upper clothes
+    14: (200, 130, 40),  # left arm
+    15: (150, 200, 40),  # right arm
+    9: (40, 60, 60),     # pants
+    16: (120, 60, 20),   # left leg
+    17: (20, 140, 110),  # right leg
+}
+
+
+def make_person(height, width, seed=0):
+    """Person standing on a flat background; returns (RGB image, LIP label map)."""
+    rng = np.random.default_rng(seed)
+    labels = np.zeros((height, width), np.uint8)
+    H, W = height, width
+    jitter = rng.uniform(-0.02, 0.02, size=2)
+    cx = int((0.5 + jitter[0]) * W)
+
+    def rect(label, x0, y0, x1, y1):
+        labels[int(y0 * H):int(y1 * H), int(cx + x0 * W):int(cx + x1 * W)] = label
+
+    rect(14, -0.28, 0.24, -0.17, 0.58)
+    rect(15, 0.17, 0.24, 0.28, 0.58)
+    rect(16, -0.14, 0.78, -0.02, 0.96)
+    rect(17, 0.02, 0.78, 0.14, 0.96)
+    rect(9, -0.16, 0.52, 0.16, 0.80)
+    rect(5, -0.18, 0.22, 0.18, 0.56)
+    # Short sleeves over the upper arms
+    rect(5, -0.28, 0.24, -0.17, 0.34)
+    rect(5, 0.17, 0.24, 0.28, 0.34)
+    head_y = int((0.13 + jitter[1]) * H)
+    cv2.ellipse(labels, (cx, head_y - int(0.02 * H)), (int(0.1 * W), int(0.07 * H)), 0, 0, 360, 2, -1)
+    cv2.ellipse(labels, (cx, head_y), (int(0.08 * W), int(0.07 * H)), 0, 0, 360, 13, -1)
+
+    lut = np.tile(np.array(BACKGROUND_RGB, np.uint8), (256, 1))
+    for label, color in PART_COLORS.items():
+        lut[label] = color
+    image = lut[labels].astype(np.int16) + rng.normal(0, 4, size=(H, W, 3)).astype(np.int16)
+    return np.clip(image, 0, 255).astype(np.uint8), labels
+
+
+def make_garment(height, width, seed=0):
+    """Flat T-shirt on a white background (RGB)."""
+    rng = np.random.default_rng(seed + 1000)
+    H, W = height, width
+    image = np.full((H, W, 3), 255, np.uint8)
+    color = rng.integers(20, 200, size=3)
+    body = np.zeros((H, W), np.uint8)
+    body[int(0.15 * H):int(0.9 * H), int(0.25 * W):int(0.75 * W)] = 1
+    body[int(0.15 * H):int(0.4 * H), int(0.08 * W):int(0.92 * W)] = 1
+    stripes = ((np.arange(H) // max(1, H // 24)) % 2).astype(np.int16)[:, None, None] * 40
+    shirt = np.clip(color[None, None, :] + stripes + rng.normal(0, 4, size=(H, W, 3)), 0, 255).astype(np.uint8)
+    image[body > 0] = shirt[body > 0]
+    return image
+
+
+def write_fixtures(fixture_dir, height, width, count):
+    """Writes `count` persons (JPEG, like camera input) and garments. Returns (persons, garments)."""
+    os.makedirs(fixture_dir, exist_ok=True)
+    persons, garments = [], []
+    for i in range(count):
+        person_path = os.path.join(fixture_dir, f"person_{height}x{width}_{i}.jpg")
+        garment_path = os.path.join(fixture_dir, f"garment_{height}x{width}_{i}.jpg")
+        if not os.path.exists(person_path):
+            Image.fromarray(make_person(height, width, seed=i)[0]).save(person_path, quality=95, subsampling=0)
+        if not os.path.exists(garment_path):
+            Image.fromarray(make_garment(height, width, seed=i)).save(garment_path, quality=95, subsampling=0)
+        persons.append(person_path)
+        garments.append(garment_path)
+    return persons, garments
+
+# ---------------------------------------------------------------------------
+# Model stand-ins (no checkpoints, no GPU)
+# ---------------------------------------------------------------------------
+def _foreground_alpha(rgb):
+    """Background colour estimated from the corners; everything far from it is foreground."""
+    corners = np.concatenate([rgb[:8, :8].reshape(-1, 3), rgb[:8, -8:].reshape(-1, 3),
+                              rgb[-8:, :8].reshape(-1, 3), rgb[-8:, -8:].reshape(-1, 3)])
+    bg = np.median(corners, axis=0)
+    dist = np.abs(rgb.astype(np.int16) - bg.astype(np.int16)).sum(axis=2)
+    alpha = (dist > 40).astype(np.uint8) * 255
+    return cv2.morphologyEx(alpha, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+
+def _stub_rembg_module():
+    module = types.ModuleType("rembg")
+
+    def new_session(*args, **kwargs):
+        return object()
+
+    def remove(data, session=None, only_mask=False, **kwargs):
+        rgb = np.array(data.convert("RGB"))
+        if only_mask:
+            return Image.fromarray(_foreground_alpha(rgb), mode="L")
+        return Image.fromarray(np.dstack([rgb, _foreground_alpha(rgb)]), mode="RGBA")
+
+    module.new_session = new_session
+    module.remove = remove
+    return module
+
+
+def _classify_parts(rgb, alpha):
+    """Nearest part colour for every foreground pixel -> LIP label map."""
+    labels = np.array(list(PART_COLORS), np.uint8)
+    colors = np.array([PART_COLORS[l] for l in labels], np.int32)
+    dist = ((rgb[:, :, None, :].astype(np.int32) - colors[None, None]) ** 2).sum(axis=3)
+    parse = labels[dist.argmin(axis=2)]
+    parse[alpha == 0] = 0
+    return parse
+
+
+def stub_schp_main(argv):
+    """Stand-in for run_schp.py: same CLI and outputs, colour-based parsing instead of the model."""
+    import run_schp
+    args = run_schp.build_parser().parse_args(argv)
+    for in_path, out_path in run_schp.jobs_for(args):
+        rgba = artifact_store.read_array(in_path, "RGBA")
+        with span("inference schp (stub)", cat="inference"):
+            parse = _classify_parts(rgba[:, :, :3], rgba[:, :, 3])
+        run_schp.write_parsing(out_path, parse)
+
+
+def stub_densepose_main(argv):
+    """Stand-in for run_densepose.py: same CLI, part indices derived from the part colours."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--project_root", required=True)
+    parser.add_argument("--short_side", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    rgba = artifact_store.read_array(args.input, "RGBA")
+    with span("inference densepose (stub)", cat="inference"):
+        parse = _classify_parts(rgba[:, :, :3], rgba[:, :, 3])
+        part_map = np.zeros(parse.shape, np.uint8)
+        part_map[parse == 5] = 1      # torso
+        part_map[parse == 13] = 23    # head
+        part_map[parse == 16] = 8     # legs
+        part_map[parse == 17] = 7
+        for label, upper, lower, hand in [(14, 16, 20, 4), (15, 15, 19, 3)]:
+            ys = np.nonzero((parse == label).any(axis=1))[0]
+            if len(ys) == 0:
+                continue
+            y_mid = ys[0] + (ys[-1] - ys[0]) // 2
+            y_hand = ys[-1] - (ys[-1] - ys[0]) // 7
+            arm = parse == label
+            rows = np.arange(parse.shape[0])[:, None]
+            part_map[arm & (rows < y_mid)] = upper
+            part_map[arm & (rows >= y_mid)] = lower
+            part_map[arm & (rows >= y_hand)] = hand
+    name = os.path.splitext(os.path.basename(args.input))[0] + "_densepose.png"
+    with span("png_encode", cat="io"):
+        artifact_store.write_array(os.path.join(args.output_dir, name), part_map)
+
+
+STUB_STAGES = {"run_schp": stub_schp_main, "run_densepose": stub_densepose_main}
+
+
+def _stub_projection_module():
+    """Stand-in for FVNT's utils.projection when the FVNT checkout is not available."""
+    import torch
+    import torch.nn.functional as F
+    module = types.ModuleType("utils.projection")
+
+    def project_source_mask(flow_hr, source_mask, anatomical_mask):
+        H, W = source_mask.shape
+        gy, gx = torch.meshgrid(torch.arange(H), torch.arange(W), indexing="ij")
+        grid = torch.stack([gx, gy], 0).float()[None] + flow_hr.cpu()
+        grid[:, 0] = 2.0 * grid[:, 0] / max(W - 1, 1) - 1.0
+        grid[:, 1] = 2.0 * grid[:, 1] / max(H - 1, 1) - 1.0
+        src = torch.from_numpy(np.asarray(source_mask, np.float32))[None, None]
+        warped = F.grid_sample(src, grid.permute(0, 2, 3, 1), align_corners=True)[0, 0].numpy()
+        projected = (warped > 0.5) & (anatomical_mask > 0.5)
+        return {"projected_mask": projected.astype(np.float32),
+                "hole_mask": ((anatomical_mask > 0.5) & ~projected).astype(np.float32)}
+
+    module.project_source_mask = project_source_mask
+    return module
+
+
+def install_model_stubs(fvnt_ckpt, stylevton_ckpt):
+    """
+    Replaces the models with lightweight stand-ins of the same interface:
+    rembg (sys.modules), Stage_2_generator and ResUnetGenerator (pre-filled model caches).
+    Returns the names of everything that was stubbed.
+    """
+    stubbed = ["rembg", "schp", "densepose"]
+    sys.modules["rembg"] = _stub_rembg_module()
+
+    import torch
+    import torch.nn as nn
+    import fvnt_flow_renderer
+    import run_stylevton
+
+    class StubFEM(nn.Module):
+        """Stage_2_generator stand-in: one conv from both parsings to a small flow field."""
+
+        def __init__(self):
+            super().__init__()
+            self.conv = nn.Conv2d(40, 2, 3, padding=1)
+
+        def forward(self, input_1, input_2, ctx=None):
+            flow = torch.tanh(self.conv(torch.cat([input_1, input_2], 1))) * 2.0
+            if ctx is not None:
+                ctx["appearance_flow"] = flow
+            return [flow], None
+
+    class StubGenerator(nn.Module):
+        """ResUnetGenerator(7, 4, ...) stand-in: a single 3x3 conv."""
+
+        def __init__(self):
+            super().__init__()
+            self.conv = nn.Conv2d(7, 4, 3, padding=1)
+
+        def forward(self, x):
+            return self.conv(x)
+
+    torch.manual_seed(0)
+    device = str(torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    fvnt_flow_renderer._FEM_CACHE[(fvnt_ckpt, file_identity(fvnt_ckpt), device)] = StubFEM().eval()
+    run_stylevton._GENERATOR_CACHE[(stylevton_ckpt, device, "fp32", run_stylevton.generator_identity(stylevton_ckpt, "fp32"))] = StubGenerator().eval()
+    stubbed += ["Stage_2_generator", "ResUnetGenerator"]
+
+    try:
+        import utils.projection  # noqa: F401  (FVNT checkout)
+    except ImportError:
+        sys.modules["utils.projection"] = _stub_projection_module()
+        stubbed.append("utils.projection")
+    return stubbed
+
+
+class BenchRunner:
+    """StageRunner stand-in: runs every stage script in this process, like a warm worker."""
+
+    def __call__(self, env_name, script, stage_args):
+        from model_worker import run_module
+        module_name = os.path.splitext(script)[0]
+        argv = [str(a) for a in stage_args]
+        if module_name in STUB_STAGES:
+            try:
+                STUB_STAGES[module_name](argv)
+            except Exception as e:
+                print(f"!!! {module_name} stand-in failed: {e!r}")
+                return False
+            return True
+        return run_module(module_name, argv) == 0
+
+    def role_runner(self):
+        return lambda role, script, stage_args: self(role, script, stage_args)
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM, so every config gets its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (None where it cannot be read)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0**2 if sys.platform == "darwin" else rss / 1024.0
+
+
+def pipeline_args(work_dir, output_root, jobs, options):
+    """master_pipeline options for a benchmark run (stand-in checkpoints under work_dir)."""
+    from master_pipeline import add_pipeline_args
+    parser = argparse.ArgumentParser()
+    add_pipeline_args(parser)
+    return parser.parse_args([
+        "--project_root", os.path.dirname(SRC_DIR),
+        "--output_root", output_root,
+        "--fvnt_ckpt", os.path.join(work_dir, "stub_fvnt.pth"),
+        "--stylevton_ckpt", os.path.join(work_dir, "stub_stylevton.pth"),
+        "--jobs", str(jobs),
+        "--type", options.type,
+        "--sleeve_type", options.sleeve_type,
+        "--initial_sleeve", options.initial_sleeve,
+        "--artifact_mode", options.artifact_mode,
+    ])
+
+
+def run_once(persons, garments, args, runner, trace_path):
+    """One batch through the full stage graph. Returns (ok, seconds, trace events)."""
+    from batch_pipeline import build_batch
+    from stage_graph import run_graph
+
+    if os.path.exists(args.output_root):
+        shutil.rmtree(args.output_root)
+    pairs = [{"person": p, "garment": g} for p, g in zip(persons, garments)]
+    stages, _ = build_batch(pairs, args, runner)
+
+    timing_trace.start_trace(trace_path)
+    start = time.perf_counter()
+    try:
+        with span("benchmark", cat="pipeline", pairs=len(pairs)):
+            ok = run_graph(stages, max_workers=args.jobs)
+    finally:
+        elapsed = time.perf_counter() - start
+        events = timing_trace.finish_trace(trace_path)
+        timing_trace.configure(None)
+        os.environ.pop(timing_trace.TRACE_FILE_ENV, None)
+    return ok, elapsed, events
+
+
+# Span categories reported as sub-steps (see timing_trace.py)
+STEP_CATEGORIES = ["model_load", "io", "compute", "inference", "subprocess"]
+
+
+def stage_times(events):
+    """Mean duration (ms) per stage kind (the stage name without its [tag])."""
+    per_stage = {}
+    for e in events:
+        if e.get("ph") == "X" and e.get("cat") == "stage":
+            per_stage.setdefault(e["name"].split("[")[0], []).append(e["dur"] / 1000.0)
+    return {name: sum(d) / len(d) for name, d in per_stage.items()}
+
+
+def step_times(events):
+    """Total duration (ms) per sub-step span (model load, decode, inference, ...)."""
+    totals = {}
+    for cat in STEP_CATEGORIES:
+        for name, ms in timing_trace.summarize(events, cat).items():
+            totals[name] = totals.get(name, 0.0) + ms
+    return totals
+
+
+def benchmark_config(height, width, batch_size, options, runner):
+    """Warm, repeated runs of one (resolution, batch size) configuration."""
+    config_dir = os.path.join(options.work_dir, f"{height}x{width}_b{batch_size}")
+    persons, garments = write_fixtures(os.path.join(options.work_dir, "fixtures"), height, width, batch_size)
+    args = pipeline_args(options.work_dir, os.path.join(config_dir, "outputs"), options.jobs, options)
+    trace_path = os.path.join(config_dir, "trace.json")
+
+    totals, stages, steps = [], [], []
+    reset_peak_rss()
+    for _ in range(options.repeats):
+        ok, elapsed, events = run_once(persons, garments, args, runner, trace_path)
+        if not ok:
+            raise RuntimeError(f"Benchmark run {height}x{width} b{batch_size} failed (see {options.log})")
+        totals.append(elapsed)
+        stages.append(stage_times(events))
+        steps.append(step_times(events))
+
+    total = statistics.median(totals)
+    median_of = lambda runs, key: statistics.median(r.get(key, 0.0) for r in runs)
+    return {
+        "resolution": [height, width],
+        "batch_size": batch_size,
+        "repeats": options.repeats,
+        "total_s": round(total, 4),
+        "total_s_all": [round(t, 4) for t in totals],
+        "throughput_pairs_per_s": round(batch_size / total, 4),
+        "stages_ms": {k: round(median_of(stages, k), 2) for k in sorted(stages[0])},
+        "steps_ms": {k: round(median_of(steps, k), 2) for k in sorted(steps[0])},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# Stage modules that must start without the heavy frameworks (the model code imports them lazily)
+LIGHT_MODULES = ["run_stylevton", "preprocess_garment", "generate_target_mask",
+                 "generate_agnostic_person", "restore_background"]
+HEAVY_MODULES = ["torch", "torchvision", "rembg", "onnxruntime", "detectron2"]
+
+_IMPORT_PROBE = """
+import sys, time, json
+sys.path.insert(0, sys.argv[2])
+start = time.perf_counter()
+__import__(sys.argv[1])
+ms = (time.perf_counter() - start) * 1000
+print(json.dumps({"ms": ms, "heavy": [m for m in json.loads(sys.argv[3]) if m in sys.modules]}))
+"""
+
+
+def measure_imports(modules, tries=3):
+    """Import time (best of `tries` fresh interpreters) and heavy modules pulled in, per module."""
+    results = {}
+    for module_name in modules:
+        runs = []
+        for _ in range(tries):
+            proc = subprocess.run([sys.executable, "-c", _IMPORT_PROBE, module_name, SRC_DIR, json.dumps(HEAVY_MODULES)],
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                runs.append({"ms": None, "heavy": [], "error": proc.stderr.strip().splitlines()[-1:]})
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r["ms"] if r["ms"] is not None else float("inf"))
+        results[module_name] = dict(best, ms=round(best["ms"], 1) if best["ms"] is not None else None)
+    return results
+
+
+def check_imports(imports, budget_ms):
+    """Prints violations of the import budget. Returns True if every module is within it."""
+    ok = True
+    for module_name, r in imports.items():
+        if r["ms"] is None:
+            print(f"!!! import {module_name} failed: {r.get('error')}")
+            ok = False
+        elif r["heavy"] or r["ms"] > budget_ms:
+            print(f"!!! import {module_name}: {r['ms']:.0f} ms (budget {budget_ms:.0f} ms), heavy imports: {r['heavy'] or 'none'}")
+            ok = False
+        else:
+            print(f"[IMPORT] {module_name}: {r['ms']:.0f} ms")
+    return ok
+
+
+def environment_info(options, stubbed):
+    def version(module_name):
+        try:
+            return __import__(module_name).__version__
+        except Exception:
+            return None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "numpy": version("numpy"), "torch": version("torch"), "cv2": version("cv2"),
+        "jobs": options.jobs,
+        "artifact_mode": options.artifact_mode,
+        "stubbed": stubbed,
+    }
+
+
+def compare(old, new):
+    """Prints per-config and per-stage changes of `new` relative to `old` (results dicts)."""
+    old_configs = {(tuple(c["resolution"]), c["batch_size"]): c for c in old["configs"]}
+    print(f"\nComparison against {old['environment'].get('commit')} (positive = slower):")
+    for module_name, r in new.get("imports", {}).items():
+        o = old.get("imports", {}).get(module_name)
+        if o and o["ms"] and r["ms"]:
+            print(f"  import {module_name:26s} {o['ms']:7.1f} -> {r['ms']:7.1f} ms ({(r['ms'] / o['ms'] - 1) * 100:+.1f}%)")
+    for c in new["configs"]:
+        key = (tuple(c["resolution"]), c["batch_size"])
+        if key not in old_configs:
+            continue
+        o = old_configs[key]
+        print(f"  {key[0][0]}x{key[0][1]} b{key[1]}: total {o['total_s']:.3f}s -> {c['total_s']:.3f}s "
+              f"({(c['total_s'] / o['total_s'] - 1) * 100:+.1f}%)")
+        for name, ms in c["stages_ms"].items():
+            if o["stages_ms"].get(name):
+                print(f"      {name:20s} {o['stages_ms'][name]:9.1f} -> {ms:9.1f} ms ({(ms / o['stages_ms'][name] - 1) * 100:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU benchmark of the full stage graph on synthetic inputs with stand-in models")
+    parser.add_argument("--output", default="benchmark_results.json", help="Results JSON file")
+    parser.add_argument("--resolutions", default="512x384,1024x768", help="Comma separated HxW person/garment sizes")
+    parser.add_argument("--batch_sizes", default="1,4", help="Comma separated numbers of pairs per run")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per configuration (median reported)")
+    parser.add_argument("--jobs", type=int, default=4, help="Max concurrent stages")
+    parser.add_argument("--type", choices=["flat", "worn"], default="flat")
+    parser.add_argument("--sleeve_type", choices=["none", "half", "full"], default="half")
+    parser.add_argument("--initial_sleeve", choices=["none", "half", "full"], default="full",
+                        help="'full' with a shorter sleeve_type exercises GAN skin inpainting")
+    parser.add_argument("--artifact_mode", choices=artifact_store.MODES, default="png")
+    parser.add_argument("--work_dir", default=None, help="Fixtures and outputs (default: a temp folder)")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show stage output instead of logging it to the work dir")
+    parser.add_argument("--import_budget_ms", type=float, default=300.0,
+                        help="Max import time of the torch-free stage modules (%s)" % ", ".join(LIGHT_MODULES))
+    parser.add_argument("--imports_only", action="store_true", help="Only run the import-time check")
+    parser.add_argument("--strict_imports", action="store_true", help="Exit with an error when the import check fails")
+    options = parser.parse_args(argv)
+
+    imports = measure_imports(LIGHT_MODULES)
+    imports_ok = check_imports(imports, options.import_budget_ms)
+    if options.imports_only:
+        with open(options.output, "w") as f:
+            json.dump({"environment": environment_info(options, []), "imports": imports, "configs": []}, f, indent=2)
+        print(f"Results: {options.output}")
+        if options.strict_imports and not imports_ok:
+            sys.exit(1)
+        return
+
+    if options.work_dir is None:
+        import tempfile
+        options.work_dir = tempfile.mkdtemp(prefix="viton_bench_")
+    os.makedirs(options.work_dir, exist_ok=True)
+    options.log = os.path.join(options.work_dir, "benchmark.log")
+    # The benchmark always measures the CPU path
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+    os.environ[artifact_store.ARTIFACT_MODE_ENV] = options.artifact_mode
+
+    # The compositor only loads the generator when its checkpoint file exists
+    for name in ["stub_fvnt.pth", "stub_stylevton.pth"]:
+        open(os.path.join(options.work_dir, name), "wb").close()
+    stubbed = install_model_stubs(os.path.join(options.work_dir, "stub_fvnt.pth"),
+                                  os.path.join(options.work_dir, "stub_stylevton.pth"))
+    runner = BenchRunner()
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in options.resolutions.split(",")]
+    batch_sizes = [int(b) for b in options.batch_sizes.split(",")]
+    configs = []
+    with open(options.log, "w") as log:
+        redirect = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(log)
+        with redirect:
+            # Warmup: imports, model caches, fixture files
+            benchmark_config(*resolutions[0], 1, argparse.Namespace(**dict(vars(options), repeats=1)), runner)
+            for height, width in resolutions:
+                for batch_size in batch_sizes:
+                    configs.append(benchmark_config(height, width, batch_size, options, runner))
+                    c = configs[-1]
+                    print(f"[BENCH] {height}x{width} b{batch_size}: {c['total_s']:.3f}s, "
+                          f"{c['throughput_pairs_per_s']:.2f} pairs/s", file=sys.__stdout__)
+
+    results = {"environment": environment_info(options, stubbed), "imports": imports, "configs": configs}
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("\n" + "="*50)
+    for c in configs:
+        print(f"{c['resolution'][0]}x{c['resolution'][1]} b{c['batch_size']}: total {c['total_s']:.3f}s, "
+              f"{c['throughput_pairs_per_s']:.2f} pairs/s, peak RSS {c['peak_rss_mb'] or 0:.0f} MB")
+        for name, ms in c["stages_ms"].items():
+            print(f"    {name:20s} {ms:9.1f} ms")
+    print(f"Results: {options.output}")
+    print("="*50)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
+    if options.strict_imports and not imports_ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from fvnt_flow_renderer import (FlowHead, load_fem, load_flow_model, engine_path, parsing_tensor, prep_tensor,
+                                BACKENDS, H_MODEL, W_MODEL)
+
+# Exports the FVNT Stage 2 flow network (FlowHead: the FEM reduced to its
+# appearance flow) to a serialized graph for fvnt_flow_renderer --backend,
+# and checks the exported flows against eager PyTorch.
+#
+#   python fem_export.py export --checkpoint <ckpt> --backend torchscript
+#   python fem_export.py parity --checkpoint <ckpt> --backend onnx --person target_mask.png --garment_mask cloth_mask.png
+#
+# torchscript: traced, frozen and optimized for inference; runs wherever
+#   torch + torchvision (for deform_conv2d) are installed.
+# onnx: opset 19, where torchvision exports deform_conv2d as DeformConv; it
+#   needs an onnxruntime build with a DeformConv CPU kernel.
+ONNX_OPSET = 19
+
+
+def example_inputs(count=1, seed=0):
+    """Synthetic FEM inputs: blob-shaped binary masks in the parsing channels (see parsing_tensor)."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:H_MODEL, 0:W_MODEL]
+    pairs = []
+    for _ in range(count):
+        masks = []
+        for _ in range(2):
+            cy, cx = rng.uniform(0.3, 0.7) * H_MODEL, rng.uniform(0.3, 0.7) * W_MODEL
+            ry, rx = rng.uniform(0.15, 0.35) * H_MODEL, rng.uniform(0.15, 0.35) * W_MODEL
+            masks.append(np.where(((ys - cy) / ry) ** 2 + ((xs - cx) / rx) ** 2 <= 1, 255, 0).astype(np.uint8))
+        pairs.append((parsing_tensor(masks[0], "cpu"), parsing_tensor(masks[1], "cpu")))
+    return pairs
+
+
+def export(checkpoint, backend, output=None):
+    """Writes the exported graph of `checkpoint` for `backend`. Returns its path."""
+    path = engine_path(checkpoint, backend, output)
+    head = FlowHead(load_fem(checkpoint, "cpu")).eval()
+    input_1, input_2 = example_inputs(1)[0]
+    tmp = f"{path}.tmp{os.getpid()}"
+    with torch.no_grad():
+        if backend == "torchscript":
+            traced = torch.jit.trace(head, (input_1, input_2), check_trace=False)
+            torch.jit.save(torch.jit.optimize_for_inference(torch.jit.freeze(traced)), tmp)
+        elif backend == "onnx":
+            torch.onnx.export(head, (input_1, input_2), tmp, opset_version=ONNX_OPSET,
+                              input_names=["input_1", "input_2"], output_names=["flow"],
+                              dynamic_axes={"input_1": {0: "batch"}, "input_2": {0: "batch"}, "flow": {0: "batch"}})
+        else:
+            raise ValueError(f"Nothing to export for backend {backend!r}")
+    # Running renderers never load a half-written graph
+    os.replace(tmp, path)
+    return path
+
+
+def parity(checkpoint, backend, engine=None, pairs=None, tolerance=0.05, batch_size=4, tries=3):
+    """
+    Flows of the exported backend vs eager on the same inputs: max / mean absolute
+    difference (low-resolution flow pixels) and latency. ok if max <= tolerance.
+    """
+    pairs = pairs or example_inputs(8)
+    eager = load_flow_model(checkpoint, "cpu", "eager")
+    exported = load_flow_model(checkpoint, "cpu", backend, engine)
+    report = {"backend": backend, "pairs": len(pairs), "batch_size": batch_size, "tolerance": tolerance}
+    diffs, times = [], {"eager": [], backend: []}
+    with torch.no_grad():
+        for start in range(0, len(pairs), batch_size):
+            chunk = pairs[start:start + batch_size]
+            input_1 = torch.cat([p[0] for p in chunk])
+            input_2 = torch.cat([p[1] for p in chunk])
+            flows = {}
+            for name, model in [("eager", eager), (backend, exported)]:
+                best = None
+                for _ in range(tries):
+                    t0 = time.perf_counter()
+                    flows[name] = model(input_1, input_2)
+                    elapsed = time.perf_counter() - t0
+                    best = elapsed if best is None else min(best, elapsed)
+                times[name].append(best * 1000 / len(chunk))
+            diffs.append((flows[backend] - flows["eager"]).abs().flatten())
+    diff = torch.cat(diffs)
+    report["max_abs_diff"] = float(diff.max())
+    report["mean_abs_diff"] = float(diff.mean())
+    report["ms_per_pair"] = {name: round(float(np.mean(t)), 2) for name, t in times.items()}
+    report["ok"] = report["max_abs_diff"] <= tolerance
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the FVNT flow network and check it against eager PyTorch")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--checkpoint", required=True, help="Stage 2 model checkpoint")
+    parser.add_argument("--backend", choices=[b for b in BACKENDS if b != "eager"], default="torchscript")
+    parser.add_argument("--engine", default=None, help="Exported graph path (default: <checkpoint>.ts / .onnx)")
+    parser.add_argument("--person", nargs="*", default=[], help="parity: target masks to use as inputs (paired with --garment_mask)")
+    parser.add_argument("--garment_mask", nargs="*", default=[], help="parity: garment masks to use as inputs")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="parity: max abs flow difference (low-resolution pixels)")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--report", default=None, help="parity: write the report as JSON here")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        path = export(args.checkpoint, args.backend, args.engine)
+        print(f"Exported {args.backend} graph to {path}")
+        args.engine = path
+    if len(args.person) != len(args.garment_mask):
+        parser.error("--person and --garment_mask need the same number of paths")
+    pairs = [(prep_tensor(p, "cpu", is_parsing=True), prep_tensor(g, "cpu", is_parsing=True))
+             for p, g in zip(args.person, args.garment_mask)] or None
+    report = parity(args.checkpoint, args.backend, args.engine, pairs, args.tolerance, args.batch_size)
+    print(json.dumps(report, indent=1))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+    if not report["ok"]:
+        print(f"!!! {args.backend} flows differ from eager by up to {report['max_abs_diff']:.4f} (tolerance {args.tolerance})")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
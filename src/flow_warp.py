@@ -0,0 +1,223 @@
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn.functional as F
+
+# High-resolution warping with FVNT appearance flows (pixel offsets, x then y).
+# The normalized identity grid of each (H, W, device) is built once and reused,
+# and the sampling grid is formed in one fused op, so a warp costs one
+# full-resolution allocation plus the grid_sample. Several sources (garments,
+# or a garment and its mask) are warped by a single batched grid_sample.
+#
+# Outputs much larger than the flow (multi-megapixel photos) are produced in
+# bands of rows (warp_rows / map_bands), so memory is bounded by the band size.
+# A band repeats the whole-frame arithmetic for its rows only (resize_rows:
+# the bilinear upsampling of the input rows it needs, then the same base grid
+# rows and flow scaling), so bands need no overlap and reproduce warp_high_res.
+# `python flow_warp.py` checks this, and the grid against the original
+# per-call formula, on random flows:
+#
+#   python flow_warp.py --size 1024x768 2048x1536 --tile_rows 256 300
+
+# (H, W, device) -> (1, H, W, 2) identity grid in grid_sample coordinates (align_corners=True)
+_BASE_GRIDS = {}
+
+
+def base_grid(H, W, device):
+    key = (H, W, str(device))
+    if key not in _BASE_GRIDS:
+        ys = torch.linspace(-1.0, 1.0, H, device=device) if H > 1 else torch.full((1,), -1.0, device=device)
+        xs = torch.linspace(-1.0, 1.0, W, device=device) if W > 1 else torch.full((1,), -1.0, device=device)
+        gy, gx = torch.meshgrid(ys, xs, indexing="ij")
+        _BASE_GRIDS[key] = torch.stack([gx, gy], dim=-1).unsqueeze(0)
+    return _BASE_GRIDS[key]
+
+
+def upsample_flow(low_res_flow, H, W):
+    """(B, 2, H, W) pixel flow at the target resolution from a low-resolution flow."""
+    _, _, H_lr, W_lr = low_res_flow.shape
+    flow_hr = F.interpolate(low_res_flow, size=(H, W), mode='bilinear', align_corners=True)
+    flow_hr[:, 0] *= (W / W_lr)
+    flow_hr[:, 1] *= (H / H_lr)
+    return flow_hr
+
+
+def sampling_grid(flow_hr, base=None, H=None):
+    """
+    (B, H, W, 2) grid_sample grid for a pixel flow: identity + flow, normalized.
+    base / H: rows of base_grid and the full-frame height when flow_hr is a band.
+    """
+    _, _, rows, W = flow_hr.shape
+    H = H or rows
+    scale = flow_hr.new_tensor([2.0 / max(W - 1, 1), 2.0 / max(H - 1, 1)])
+    base = base_grid(H, W, flow_hr.device) if base is None else base
+    return torch.addcmul(base, flow_hr.permute(0, 2, 3, 1), scale)
+
+
+def warp(sources, flow_hr):
+    """
+    Warps sources with a full-resolution pixel flow (see upsample_flow).
+    sources: (N, C, H, W) tensor, or a list of (N, C_i, H, W) tensors (e.g. the
+    cloth RGB and its mask) warped together and returned as a list.
+    flow_hr: (1, 2, H, W), shared by all N sources, or (N, 2, H, W), one per source.
+    """
+    if isinstance(sources, (list, tuple)):
+        channels = [s.shape[1] for s in sources]
+        warped = warp(torch.cat(list(sources), dim=1), flow_hr)
+        return list(torch.split(warped, channels, dim=1))
+    grid = sampling_grid(flow_hr)
+    if grid.shape[0] != sources.shape[0]:
+        grid = grid.expand(sources.shape[0], -1, -1, -1)
+    return F.grid_sample(sources, grid, align_corners=True)
+
+
+def warp_high_res(img_t, low_res_flow):
+    """Warps a high-res image batch using a low-res predicted flow field."""
+    return warp(img_t, upsample_flow(low_res_flow, img_t.shape[2], img_t.shape[3]))
+
+
+def band_grid(H, W, y0, y1, device):
+    """Rows y0:y1 of base_grid(H, W, device), built without the full frame."""
+    ys = torch.linspace(-1.0, 1.0, H, device=device)[y0:y1] if H > 1 else torch.full((1,), -1.0, device=device)
+    xs = torch.linspace(-1.0, 1.0, W, device=device) if W > 1 else torch.full((1,), -1.0, device=device)
+    gy, gx = torch.meshgrid(ys, xs, indexing="ij")
+    return torch.stack([gx, gy], dim=-1).unsqueeze(0)
+
+
+def resize_rows(img, H, W, y0, y1):
+    """
+    Rows y0:y1 of F.interpolate(img, (H, W), mode='bilinear', align_corners=True) for
+    (N, C, h, w) img, from the input rows they need. Computed like the interpolate
+    kernel: each input row resized along x, then rows mixed with the same weights.
+    """
+    h = img.shape[2]
+    src = torch.arange(y0, y1, dtype=torch.float32, device=img.device)
+    # Source row scale rounded in float32, as the kernel computes it
+    src = src * (torch.tensor(float(h - 1)) / (H - 1)).to(img.device) if H > 1 else src * 0
+    i0 = src.long()
+    l1 = (src - i0).clamp_(0, 1).view(1, 1, -1, 1)
+    l0 = 1 - l1
+    i1 = i0 + (i0 < h - 1).long()
+    lo, hi = int(i0[0]), int(i1[-1]) + 1
+    # Along x only: a resize to the same number of rows leaves each row as is
+    rows = F.interpolate(img[:, :, lo:hi], size=(hi - lo, W), mode='bilinear', align_corners=True)
+    return rows[:, :, i0 - lo] * l0 + rows[:, :, i1 - lo] * l1
+
+
+def warp_rows(sources, low_res_flow, y0, y1):
+    """
+    Rows y0:y1 of warp_high_res(sources, low_res_flow). sources: the full-resolution
+    (N, C, H, W) images (warped pixels may come from anywhere in them).
+    """
+    _, _, H, W = sources.shape
+    _, _, H_lr, W_lr = low_res_flow.shape
+    # upsample_flow, for these rows
+    flow = resize_rows(low_res_flow, H, W, y0, y1)
+    flow[:, 0] *= (W / W_lr)
+    flow[:, 1] *= (H / H_lr)
+    grid = sampling_grid(flow, band_grid(H, W, y0, y1, sources.device), H)
+    if grid.shape[0] != sources.shape[0]:
+        grid = grid.expand(sources.shape[0], -1, -1, -1)
+    return F.grid_sample(sources, grid, align_corners=True)
+
+
+def map_bands(fn, H, rows=256, workers=1):
+    """
+    Calls fn(y0, y1) for bands of `rows` rows covering 0:H, `workers` bands at a
+    time on a thread pool (torch releases the GIL). Intra-op threads are divided
+    between the workers so the bands do not oversubscribe the cores.
+    """
+    bands = [(y0, min(y0 + rows, H)) for y0 in range(0, H, rows)]
+    workers = max(1, min(workers, len(bands)))
+    if workers == 1:
+        for y0, y1 in bands:
+            fn(y0, y1)
+        return
+    threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, threads // workers))
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda band: fn(*band), bands))
+    finally:
+        torch.set_num_threads(threads)
+
+
+def reference_warp(sources, low_res_flow):
+    """The original per-call warp (integer pixel grid + flow, renormalized), for parity()."""
+    B, _, H, W = sources.shape
+    _, _, H_lr, W_lr = low_res_flow.shape
+    flow_hr = F.interpolate(low_res_flow, size=(H, W), mode='bilinear', align_corners=True)
+    flow_hr[:, 0] = flow_hr[:, 0] * (W / W_lr)
+    flow_hr[:, 1] = flow_hr[:, 1] * (H / H_lr)
+    gx = torch.arange(W, device=sources.device).view(1, -1).repeat(H, 1).view(1, 1, H, W).expand(B, -1, -1, -1)
+    gy = torch.arange(H, device=sources.device).view(-1, 1).repeat(1, W).view(1, 1, H, W).expand(B, -1, -1, -1)
+    grid = torch.cat([gx, gy], 1).float() + flow_hr
+    grid[:, 0] = 2.0 * grid[:, 0] / max(W - 1, 1) - 1.0
+    grid[:, 1] = 2.0 * grid[:, 1] / max(H - 1, 1) - 1.0
+    return F.grid_sample(sources, grid.permute(0, 2, 3, 1), align_corners=True)
+
+
+def parity(H, W, rows=256, flow_px=8.0, low_res=(256, 192), seed=0):
+    """
+    Max absolute differences on a random (1, 2, *low_res) flow of up to +-flow_px
+    low-resolution pixels and a random (1, 3, H, W) source in [-1, 1]:
+      grid:    warp_high_res vs reference_warp (the original formula)
+      bands:   warp_rows over bands of `rows` rows vs warp_high_res
+      resize:  resize_rows bands vs a whole-frame bilinear resize of a low-res mask
+      uint8:   bands vs warp_high_res after the renderer's (x + 1) * 0.5 * 255 -> uint8
+    """
+    gen = torch.Generator().manual_seed(seed)
+    flow = (torch.rand(1, 2, *low_res, generator=gen) * 2 - 1) * flow_px
+    source = torch.rand(1, 3, H, W, generator=gen) * 2 - 1
+    mask = (torch.rand(1, 1, *low_res, generator=gen) > 0.5).float()
+    with torch.no_grad():
+        whole = warp_high_res(source, flow)
+        reference = reference_warp(source, flow)
+        bands = torch.empty_like(whole)
+        resized = torch.empty(1, 1, H, W)
+
+        def band(y0, y1):
+            bands[:, :, y0:y1] = warp_rows(source, flow, y0, y1)
+            resized[:, :, y0:y1] = resize_rows(mask, H, W, y0, y1)
+        map_bands(band, H, rows)
+        whole_mask = F.interpolate(mask, size=(H, W), mode='bilinear', align_corners=True)
+
+    def to_u8(x):
+        return ((x + 1) * 0.5).clamp(0, 1).mul(255).to(torch.uint8).int()
+    return {"size": f"{H}x{W}", "rows": rows,
+            "grid": float((whole - reference).abs().max()),
+            "bands": float((bands - whole).abs().max()),
+            "resize": float((resized - whole_mask).abs().max()),
+            "uint8": int((to_u8(bands) - to_u8(whole)).abs().max())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check banded and cached-grid warping against the whole-frame warp")
+    parser.add_argument("--size", nargs="+", default=["1024x768", "2048x1536"], help="Output sizes as HxW")
+    parser.add_argument("--tile_rows", type=int, nargs="+", default=[256, 300], help="Band heights to check")
+    parser.add_argument("--flow_px", type=float, default=8.0, help="Max random flow (low-resolution pixels)")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="Max abs difference of the bands and resized rows from the whole frame ([-1, 1] image units)")
+    parser.add_argument("--grid_tolerance", type=float, default=2e-3,
+                        help="Max abs difference from the original formula (float32 rounding of normalized coordinates)")
+    args = parser.parse_args(argv)
+
+    reports = []
+    for size in args.size:
+        H, W = (int(v) for v in size.lower().split("x"))
+        for rows in args.tile_rows:
+            reports.append(parity(H, W, rows, args.flow_px))
+            print(json.dumps(reports[-1]))
+    worst = max(max(r["bands"], r["resize"]) for r in reports)
+    worst_grid = max(r["grid"] for r in reports)
+    if worst > args.tolerance:
+        print(f"!!! Bands differ from the whole-frame warp by up to {worst:.2e} (tolerance {args.tolerance})")
+    if worst_grid > args.grid_tolerance:
+        print(f"!!! Warp differs from the original formula by up to {worst_grid:.2e} (tolerance {args.grid_tolerance})")
+    if worst > args.tolerance or worst_grid > args.grid_tolerance:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
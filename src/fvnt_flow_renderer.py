@@ -1,36 +1,31 @@
 import os
 import sys
 import torch
-import shutil
+import types
+import hashlib
+import tempfile
 import numpy as np
 import argparse
 from PIL import Image
 import torch.nn as nn
-import torch.nn.functional as F
 from torchvision.ops import deform_conv2d
 import math
+from artifact_store import read_image, write_array
+from timing_trace import span
+from flow_warp import upsample_flow, warp, warp_rows, resize_rows, map_bands
+from stage_cache import open_cache, file_identity
+from batch_items import parse_each, run_items
 
 # Add FVNT to path
 FVNT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "FVNT"))
 if FVNT_DIR not in sys.path:
     sys.path.insert(0, FVNT_DIR)
 
-# 1. Zero-Build DCN Injection (Pure Python fallback)
-def inject_dcn():
-    DCN_FOLDER = os.path.join(FVNT_DIR, "Deformable")
-    if os.path.isdir(DCN_FOLDER):
-        shutil.rmtree(DCN_FOLDER)
-    os.makedirs(DCN_FOLDER, exist_ok=True)
-
-    with open(os.path.join(DCN_FOLDER, "__init__.py"), "w") as f:
-        f.write("from .modules import DeformConvPack")
-
-    modules_py = """
-import torch
-from torch import nn
-from torchvision.ops import deform_conv2d
-import math
-
+# 1. Zero-Build DCN (Pure Python fallback)
+# FVNT imports DeformConvPack from its compiled Deformable package. The
+# torchvision-based replacement below is registered in sys.modules under that
+# package name, so nothing is written to the FVNT checkout and several flow
+# renders can import the model at the same time.
 class DeformConvPack(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding,
                  dilation=1, groups=1, deformable_groups=1, im2col_step=64, bias=True, lr_mult=0.1):
@@ -70,128 +65,388 @@ class DeformConvPack(nn.Module):
         offset = self.conv_offset(x)
         return deform_conv2d(x, offset, self.weight, self.bias,
                              stride=self.stride, padding=self.padding, dilation=self.dilation)
-"""
-    with open(os.path.join(DCN_FOLDER, "modules.py"), "w") as f:
-        f.write(modules_py)
+
+def inject_dcn():
+    """Registers Deformable / Deformable.modules (in memory only) providing DeformConvPack."""
+    if getattr(sys.modules.get("Deformable"), "DeformConvPack", None) is DeformConvPack:
+        return
+    package = types.ModuleType("Deformable")
+    package.__path__ = []  # a package, so "Deformable.modules" resolves
+    modules = types.ModuleType("Deformable.modules")
+    package.DeformConvPack = modules.DeformConvPack = DeformConvPack
+    package.modules = modules
+    sys.modules["Deformable"] = package
+    sys.modules["Deformable.modules"] = modules
+
+# Models loaded so far, keyed by (checkpoint, file_identity(checkpoint), device)
+# (reused by persistent workers; a checkpoint replaced in place is loaded again)
+_FEM_CACHE = {}
+
+def drop_stale(models, key):
+    """Forgets the models loaded from an earlier version of the files in `key`."""
+    for old in [k for k in models if k[0] == key[0] and k[-1] == key[-1] and k != key]:
+        del models[old]
+
+def load_fem(checkpoint, device):
+    key = (checkpoint, file_identity(checkpoint), str(device))
+    if key in _FEM_CACHE:
+        return _FEM_CACHE[key]
+    drop_stale(_FEM_CACHE, key)
+
+    with span("model_load fvnt", cat="model_load"):
+        # Register the DCN shim before importing the model
+        inject_dcn()
+        from mine.network_stage_2_mine_x2_resflow import Stage_2_generator
+
+        fem = Stage_2_generator(20).to(device)
+        ckpt = torch.load(checkpoint, map_location=device)
+        fem.load_state_dict(ckpt['G'] if 'G' in ckpt else ckpt)
+        fem.eval()
+    _FEM_CACHE[key] = fem
+    return fem
+
+# Inference backends for the flow: eager PyTorch, or a graph exported with
+# fem_export.py (TorchScript, frozen and optimized for inference, or ONNX run
+# by ONNX Runtime with all graph optimizations). All are called as
+# flow_model(input_1, input_2) -> low-resolution appearance flow.
+BACKENDS = ["eager", "torchscript", "onnx"]
+ENGINE_EXTS = {"torchscript": ".ts", "onnx": ".onnx"}
+
+class FlowHead(nn.Module):
+    """The FEM reduced to the flow the renderer uses (the graph that gets exported)."""
+
+    def __init__(self, fem):
+        super().__init__()
+        self.fem = fem
+
+    def forward(self, input_1, input_2):
+        ctx = {}
+        flow_list, _ = self.fem(input_1, input_2, ctx=ctx)
+        return ctx.get('appearance_flow', flow_list[-1])
+
+class OnnxFlow:
+    """ONNX Runtime session with the FlowHead call signature."""
+
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_1, input_2):
+        flow, = self.session.run(None, {"input_1": input_1.cpu().numpy(), "input_2": input_2.cpu().numpy()})
+        return torch.from_numpy(flow).to(input_1.device)
+
+def engine_path(checkpoint, backend, engine=None):
+    """The exported graph of a backend: `engine`, or next to the checkpoint (<checkpoint>.ts / .onnx)."""
+    return engine or checkpoint + ENGINE_EXTS[backend]
+
+# Flow models loaded so far, keyed by (engine, file_identity(engine), backend, device)
+_FLOW_MODELS = {}
+
+def load_flow_model(checkpoint, device, backend="eager", engine=None):
+    if backend == "eager":
+        return FlowHead(load_fem(checkpoint, device))
+    path = engine_path(checkpoint, backend, engine)
+    key = (path, file_identity(path), backend, str(device))
+    if key not in _FLOW_MODELS:
+        # A graph re-exported to the same path replaces the loaded one
+        drop_stale(_FLOW_MODELS, key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No {backend} engine at {path}; export it with fem_export.py export --backend {backend}")
+        with span(f"model_load fvnt {backend}", cat="model_load"):
+            if backend == "torchscript":
+                model = torch.jit.load(path, map_location=device)
+            else:
+                model = OnnxFlow(path)
+        _FLOW_MODELS[key] = model
+    return _FLOW_MODELS[key]
 
 # Constants
 H_MODEL, W_MODEL = 256, 192
+# Working resolution of the warp and projection; larger outputs (--out_height /
+# --out_width) are warped in bands of rows (see render_tiled)
 H_HD, W_HD = 1024, 768
 
-def warp_high_res(img_t, low_res_flow, device):
-    """Warps a high-res image using a low-res predicted flow field."""
-    B, _, H_hr, W_hr = img_t.shape
-    _, _, H_lr, W_lr = low_res_flow.shape
-    
-    flow_hr = F.interpolate(low_res_flow, size=(H_hr, W_hr), mode='bilinear', align_corners=True)
-    flow_hr[:, 0] = flow_hr[:, 0] * (W_hr / W_lr)
-    flow_hr[:, 1] = flow_hr[:, 1] * (H_hr / H_lr)
-    
-    gx = torch.arange(W_hr, device=device).view(1,-1).repeat(H_hr,1).view(1,1,H_hr,W_hr).expand(B,-1,-1,-1)
-    gy = torch.arange(H_hr, device=device).view(-1,1).repeat(1,W_hr).view(1,1,H_hr,W_hr).expand(B,-1,-1,-1)
-    grid = torch.cat([gx, gy], 1).float() + flow_hr
-    
-    grid[:, 0] = 2.0 * grid[:, 0] / max(W_hr - 1, 1) - 1.0
-    grid[:, 1] = 2.0 * grid[:, 1] / max(H_hr - 1, 1) - 1.0
-    return F.grid_sample(img_t, grid.permute(0, 2, 3, 1), align_corners=True)
+def parsing_tensor(lbl, device):
+    """20-channel FEM input from a (H_MODEL, W_MODEL) label map or 0/255 mask."""
+    out = torch.zeros(20, H_MODEL, W_MODEL)
+    # Place torso/arm/dress regions into specific channels as expected by Stage 2
+    for i in [4, 5, 6, 7]: 
+        mask = (lbl == i) if lbl.max() < 20 else (lbl >= 128)
+        out[i] = torch.from_numpy(mask.astype(np.float32))
+    return out.unsqueeze(0).to(device)
 
 def prep_tensor(path, device, is_parsing=False):
     """Formats inputs for the FEM model."""
-    img = Image.open(path).resize((W_MODEL, H_MODEL), Image.NEAREST if is_parsing else Image.BILINEAR)
+    img = read_image(path).resize((W_MODEL, H_MODEL), Image.NEAREST if is_parsing else Image.BILINEAR)
     if is_parsing:
-        lbl = np.array(img)
-        out = torch.zeros(20, H_MODEL, W_MODEL)
-        # Place torso/arm/dress regions into specific channels as expected by Stage 2
-        for i in [4, 5, 6, 7]: 
-            mask = (lbl == i) if lbl.max() < 20 else (lbl >= 128)
-            out[i] = torch.from_numpy(mask.astype(np.float32))
-        return out.unsqueeze(0).to(device)
+        return parsing_tensor(np.array(img), device)
     else:
         return (torch.from_numpy(np.array(img.convert('RGB'))).permute(2,0,1).float().unsqueeze(0)/127.5-1).to(device)
 
-def main():
+def tensor_digest(t):
+    return hashlib.sha256(t.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+
+def predict_flows(flow_model, inputs_1, inputs_2, device, cache=None, checkpoint=None, backend="eager", engine=None):
+    """
+    Low-resolution appearance flows of the FEM for lists of prepared inputs
+    (one (1, 2, h, w) flow per pair), computed in one batched forward pass.
+    A flow depends only on its two inputs and the checkpoint, so with a cache
+    (stage_cache.StageCache) it is stored as float16 under their hashes and
+    re-renders with the same masks (colourways, projection or output changes)
+    skip inference. With a cache the flow is always rounded to float16, so a
+    hit and a miss give the same result.
+    """
+    # Exported backends are only equal to eager within the parity tolerance, so they get their own
+    # entries, per exported graph (engine: its path, see engine_path)
+    backend_param = {} if backend == "eager" else {"backend": backend,
+                                                   "engine": file_identity(engine_path(checkpoint, backend, engine))}
+    flows, keys = [None] * len(inputs_1), [None] * len(inputs_1)
+    if cache is not None:
+        with span("cache lookup fem_flow", cat="cache", batch=len(inputs_1)), tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "flow.npy")
+            for i, (input_1, input_2) in enumerate(zip(inputs_1, inputs_2)):
+                keys[i] = cache.make_key("fem_flow", params={"person": tensor_digest(input_1), "garment": tensor_digest(input_2),
+                                                             "checkpoint": file_identity(checkpoint), **backend_param})
+                if cache.restore(keys[i], {"flow.npy": path}):
+                    print(f"[CACHE] Hit for fem_flow ({keys[i][:12]}), skipping FEM inference.")
+                    flows[i] = torch.from_numpy(np.load(path).astype(np.float32)).to(device)
+
+    todo = [i for i, flow in enumerate(flows) if flow is None]
+    if todo:
+        with span("inference fvnt", cat="inference", batch=len(todo), backend=backend), torch.no_grad():
+            batch_flow = flow_model(torch.cat([inputs_1[i] for i in todo]), torch.cat([inputs_2[i] for i in todo]))
+        for j, i in enumerate(todo):
+            flows[i] = batch_flow[j:j + 1]
+
+    if cache is not None and todo:
+        with span("cache store fem_flow", cat="cache", batch=len(todo)), tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "flow.npy")
+            for i in todo:
+                flow_half = flows[i].half()
+                np.save(path, flow_half.cpu().numpy())
+                cache.store(keys[i], {"flow.npy": path})
+                flows[i] = flow_half.float()
+    return flows
+
+def build_parser():
     parser = argparse.ArgumentParser(description="FVNT Flow Renderer Script")
     parser.add_argument("--person", required=True, help="Path to person target mask")
-    parser.add_argument("--garment_rgb", required=True, help="Path to garment RGB image")
-    parser.add_argument("--garment_mask", required=True, help="Path to garment mask")
+    parser.add_argument("--garment_rgb", nargs="+", help="Path to garment RGB image (several: one output folder per garment)")
+    parser.add_argument("--garment_mask", nargs="+", help="Path to garment mask (one per --garment_rgb)")
+    parser.add_argument("--catalog", help="Garment catalog folder (see garment_catalog.py); use with --garment_id")
+    parser.add_argument("--garment_id", nargs="+", help="Catalog garment(s) (replaces --garment_rgb / --garment_mask)")
     parser.add_argument("--checkpoint", required=True, help="Path to Stage 2 model checkpoint")
     parser.add_argument("--schp", help="Path to target person SCHP parsing (optional, for better sleeve control)")
-    parser.add_argument("--output_dir", default="output", help="Directory to save results")
+    parser.add_argument("--output_dir", default="output", help="Directory to save results (<output_dir>/<garment> with several garments)")
     parser.add_argument("--no_projection", action="store_true", help="Disable sleeve projection refinement")
     parser.add_argument("--sleeve_type", choices=["auto", "short", "long"], default="auto", help="Override sleeve type detection")
-    
-    args = parser.parse_args()
-    
+    parser.add_argument("--flow_cache", default=None, help="Stage cache directory for float16 FEM flows keyed by the two input masks")
+    parser.add_argument("--flow_cache_max_gb", type=float, default=20.0, help="Size budget of --flow_cache")
+    parser.add_argument("--batch_size", type=int, default=8, help="Garments per FEM forward pass and batched warp")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager", help="FEM inference backend (exported graphs: see fem_export.py)")
+    parser.add_argument("--engine", default=None, help="Exported graph for --backend torchscript/onnx (default: <checkpoint>.ts / .onnx)")
+    parser.add_argument("--out_height", type=int, default=H_HD, help="Output height (above 1024x768 the warp runs in bands of rows)")
+    parser.add_argument("--out_width", type=int, default=W_HD, help="Output width")
+    parser.add_argument("--tile_rows", type=int, default=256, help="Rows per band for outputs above 1024x768")
+    parser.add_argument("--tile_workers", type=int, default=min(4, os.cpu_count() or 1), help="Bands warped in parallel")
+    return parser
+
+def garment_jobs(parser, args):
+    """One render job per garment of a command line: {"args", "garment" (catalog arrays or None), "garment_rgb", "garment_mask", "output_dir"}."""
+    if args.garment_id:
+        if not args.catalog:
+            parser.error("--garment_id needs --catalog")
+        from garment_catalog import open_catalog
+        # Preprocessed arrays, memory-mapped: no decode or resize per request
+        catalog = open_catalog(args.catalog)
+        garments = [(garment_id, catalog.arrays(garment_id), None, None) for garment_id in args.garment_id]
+    elif not (args.garment_rgb and args.garment_mask):
+        parser.error("--garment_rgb and --garment_mask are required without --garment_id")
+    elif len(args.garment_rgb) != len(args.garment_mask):
+        parser.error("--garment_rgb and --garment_mask need the same number of paths")
+    else:
+        garments = [(os.path.splitext(os.path.basename(rgb))[0], None, rgb, mask)
+                    for rgb, mask in zip(args.garment_rgb, args.garment_mask)]
+    names = [name for name, _, _, _ in garments]
+    if len(set(names)) < len(names):
+        names = [f"{i:03d}_{name}" for i, name in enumerate(names)]
+    multi = len(garments) > 1
+    return [{"args": args, "garment": arrays, "garment_rgb": rgb, "garment_mask": mask,
+             "output_dir": os.path.join(args.output_dir, name) if multi else args.output_dir}
+            for name, (_, arrays, rgb, mask) in zip(names, garments)]
+
+def render(jobs, batch_size=8):
+    """
+    Flow, warp and projection for render jobs (see garment_jobs): the FEM runs
+    once per batch of up to batch_size garments and the cloth of a batch is
+    warped by one grid_sample. Person inputs are prepared once per target mask.
+    """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}")
 
-    # Inject DCN before importing model
-    inject_dcn()
-    from mine.network_stage_2_mine_x2_resflow import Stage_2_generator
-    from utils.projection import project_source_mask
-
-    # Load Model
-    fem = Stage_2_generator(20).to(device)
-    ckpt = torch.load(args.checkpoint, map_location=device)
-    fem.load_state_dict(ckpt['G'] if 'G' in ckpt else ckpt)
-    fem.eval()
-    print("[OK] Model loaded.")
-
-    # Prepare Inputs
-    os.makedirs(args.output_dir, exist_ok=True)
-    
-    # Use user-preferred prep_tensor logic
-    input_1 = prep_tensor(args.person, device, is_parsing=True)
-    input_2 = prep_tensor(args.garment_mask, device, is_parsing=True)
-
-    # 3. Predict Flow
-    ctx = {}
-    with torch.no_grad():
-        flow_list, _ = fem(input_1, input_2, ctx=ctx)
-    low_res_flow = ctx.get('appearance_flow', flow_list[-1])
-
-    # 4. Warp Cloth
-    cloth_hd = Image.open(args.garment_rgb).convert('RGB').resize((W_HD, H_HD))
-    cloth_hd_t = (torch.from_numpy(np.array(cloth_hd)).permute(2,0,1).float().unsqueeze(0)/127.5-1).to(device)
-    warped_hd = warp_high_res(cloth_hd_t, low_res_flow, device)
-    warped_hd_np = ((warped_hd[0].permute(1,2,0).cpu().numpy()+1)*0.5).clip(0,1)
+    by_model = {}
+    for job in jobs:
+        args = job["args"]
+        by_model.setdefault((args.checkpoint, args.backend, args.engine, args.flow_cache, args.flow_cache_max_gb), []).append(job)
 
-    # 5. Projection Refinement
-    if not args.no_projection:
-        print("Applying projection refinement...")
-        s_mask_hd = Image.open(args.garment_mask).convert('L').resize((W_HD, H_HD))
-        t_mask_hd = Image.open(args.person).convert('L').resize((W_HD, H_HD))
-        
+    person_inputs, person_masks = {}, {}
+    for (checkpoint, backend, engine, flow_cache, flow_cache_max_gb), model_jobs in by_model.items():
+        # Load Model (DCN is injected on first load)
+        flow_model = load_flow_model(checkpoint, device, backend, engine)
+        from utils.projection import project_source_mask
+        print("[OK] Model loaded.")
+        cache = open_cache(flow_cache, flow_cache_max_gb)
+
+        for start in range(0, len(model_jobs), batch_size):
+            chunk = model_jobs[start:start + batch_size]
+            # Use user-preferred prep_tensor logic
+            with span("decode", cat="io"):
+                for job in chunk:
+                    if job["args"].person not in person_inputs:
+                        person_inputs[job["args"].person] = prep_tensor(job["args"].person, device, is_parsing=True)
+                inputs_1 = [person_inputs[job["args"].person] for job in chunk]
+                inputs_2 = [parsing_tensor(job["garment"]["mask_model"], device) if job["garment"] is not None
+                            else prep_tensor(job["garment_mask"], device, is_parsing=True) for job in chunk]
+
+            # 3. Predict Flow
+            flows = predict_flows(flow_model, inputs_1, inputs_2, device, cache, checkpoint, backend, engine)
+
+            # 4. Warp Cloth (garments of the same output size share one grid_sample)
+            by_size = {}
+            for i, job in enumerate(chunk):
+                by_size.setdefault((job["args"].out_height, job["args"].out_width), []).append(i)
+            for (H, W), indices in by_size.items():
+                if H * W > H_HD * W_HD:
+                    for i in indices:
+                        render_tiled(chunk[i], flows[i], project_source_mask, person_masks)
+                    continue
+                with span("decode", cat="io"):
+                    cloths = [garment_image(chunk[i], "cloth", (H, W)) for i in indices]
+                with span("warp", cat="compute", batch=len(indices)):
+                    cloth_hd_t = (torch.from_numpy(np.stack([np.asarray(c) for c in cloths])).permute(0,3,1,2).float()/127.5-1).to(device)
+                    # Full-resolution flows, shared by the cloth warp and the projection
+                    flow_hr = upsample_flow(torch.cat([flows[i] for i in indices]), H, W)
+                    warped_hd = warp(cloth_hd_t, flow_hr)
+                    warped_hd_np = ((warped_hd.permute(0,2,3,1).cpu().numpy()+1)*0.5).clip(0,1)
+
+                for k, i in enumerate(indices):
+                    finish_job(chunk[i], warped_hd_np[k], flow_hr[k:k + 1], project_source_mask, person_masks)
+
+def garment_image(job, name, size):
+    """The garment's "cloth" (RGB) or "cloth_mask" (L) at size (H, W): catalog arrays are stored at 1024x768."""
+    H, W = size
+    if job["garment"] is not None:
+        arr = job["garment"][name]
+        return arr if arr.shape[:2] == (H, W) else Image.fromarray(arr).resize((W, H))
+    if name == "cloth":
+        return read_image(job["garment_rgb"], 'RGB').resize((W, H))
+    return read_image(job["garment_mask"], 'L').resize((W, H))
+
+def project(job, flow_hr, project_source_mask, person_masks):
+    """Projection refinement of one garment at the resolution of flow_hr (1, 2, H, W)."""
+    args = job["args"]
+    H, W = flow_hr.shape[2:]
+    print("Applying projection refinement...")
+    s_mask_hd = garment_image(job, "cloth_mask", (H, W))
+    if (args.person, H, W) not in person_masks:
+        t_mask_hd = read_image(args.person, 'L').resize((W, H))
         # Use provided person mask as anatomical constraint
-        anat_mask_np = np.array(t_mask_hd) / 255.0
-        
-        # If SCHP is provided, we can further refine boundaries (optional)
-        if args.schp:
-            schp_hd = Image.open(args.schp).resize((W_HD, H_HD), Image.NEAREST)
-            schp_np = np.array(schp_hd)
-            print("Using SCHP for boundary refinement.")
-
-        # Upsample flow...
-        flow_hr = F.interpolate(low_res_flow, size=(H_HD, W_HD), mode='bilinear', align_corners=True)
-        flow_hr[:, 0] *= (W_HD / W_MODEL)
-        flow_hr[:, 1] *= (H_HD / H_MODEL)
-        
-        res = project_source_mask(
+        person_masks[(args.person, H, W)] = np.array(t_mask_hd) / 255.0
+    anat_mask_np = person_masks[(args.person, H, W)]
+
+    # If SCHP is provided, we can further refine boundaries (optional)
+    if args.schp:
+        print("Using SCHP for boundary refinement.")
+
+    with span("projection", cat="compute"):
+        return project_source_mask(
             flow_hr,
             source_mask=np.array(s_mask_hd)/255.0,
             anatomical_mask=anat_mask_np
         )
+
+def finish_job(job, warped_hd_np, flow_hr, project_source_mask, person_masks):
+    """Projection refinement and outputs of one garment."""
+    args = job["args"]
+    os.makedirs(job["output_dir"], exist_ok=True)
+
+    # 5. Projection Refinement
+    if not args.no_projection:
+        res = project(job, flow_hr, project_source_mask, person_masks)
         warped_hd_np = warped_hd_np * res['projected_mask'][..., None]
         
         # Save masks
-        Image.fromarray((res['projected_mask']*255).astype(np.uint8)).save(os.path.join(args.output_dir, "projected_mask.png"))
-        if 'hole_mask' in res:
-            Image.fromarray((res['hole_mask']*255).astype(np.uint8)).save(os.path.join(args.output_dir, "hole_mask.png"))
+        with span("png_encode", cat="io"):
+            write_array(os.path.join(job["output_dir"], "projected_mask.png"), (res['projected_mask']*255).astype(np.uint8))
+            if 'hole_mask' in res:
+                write_array(os.path.join(job["output_dir"], "hole_mask.png"), (res['hole_mask']*255).astype(np.uint8))
 
     # Save final warped garment
-    final_img = Image.fromarray((warped_hd_np * 255).astype(np.uint8))
-    final_img.save(os.path.join(args.output_dir, "warped_garment.png"))
-    print(f"[SUCCESS] Results saved to {args.output_dir}")
+    with span("png_encode", cat="io"):
+        write_array(os.path.join(job["output_dir"], "warped_garment.png"), (warped_hd_np * 255).astype(np.uint8))
+    print(f"[SUCCESS] Results saved to {job['output_dir']}")
+
+def render_tiled(job, flow, project_source_mask, person_masks):
+    """
+    Warp and outputs of one garment above 1024x768, in bands of --tile_rows rows
+    (--tile_workers at a time): no full-frame flow, grid or float image is held.
+    The projection runs at 1024x768, where it was designed, and its masks are
+    resampled per band to the output size.
+    """
+    args = job["args"]
+    H, W = args.out_height, args.out_width
+    os.makedirs(job["output_dir"], exist_ok=True)
+
+    masks_t = None
+    if not args.no_projection:
+        res = project(job, upsample_flow(flow, H_HD, W_HD), project_source_mask, person_masks)
+        names = [name for name in ["projected_mask", "hole_mask"] if name in res]
+        masks_t = torch.from_numpy(np.stack([res[name] for name in names]).astype(np.float32)).unsqueeze(0).to(flow.device)
+        masks = {name: np.empty((H, W), np.uint8) for name in names}
+
+    with span("decode", cat="io"):
+        cloth = np.asarray(garment_image(job, "cloth", (H, W)))
+        source = torch.from_numpy(cloth).permute(2, 0, 1).unsqueeze(0).to(flow.device).float().div_(127.5).sub_(1)
+    warped = np.empty((H, W, 3), np.uint8)
+
+    def band(y0, y1):
+        rgb = ((warp_rows(source, flow, y0, y1)[0].permute(1, 2, 0).cpu().numpy() + 1) * 0.5).clip(0, 1)
+        if masks_t is not None:
+            band_masks = resize_rows(masks_t, H, W, y0, y1)[0].cpu().numpy()
+            rgb = rgb * band_masks[0][..., None]
+            for name, mask in zip(masks, band_masks):
+                masks[name][y0:y1] = (mask * 255).astype(np.uint8)
+        warped[y0:y1] = (rgb * 255).astype(np.uint8)
+
+    with span("warp tiled", cat="compute", size=f"{W}x{H}", rows=args.tile_rows, workers=args.tile_workers):
+        map_bands(band, H, args.tile_rows, args.tile_workers)
+
+    with span("png_encode", cat="io"):
+        if masks_t is not None:
+            for name, mask in masks.items():
+                write_array(os.path.join(job["output_dir"], f"{name}.png"), mask)
+        write_array(os.path.join(job["output_dir"], "warped_garment.png"), warped)
+    print(f"[SUCCESS] Results saved to {job['output_dir']} ({W}x{H})")
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    render(garment_jobs(parser, args), args.batch_size)
+
+def main_batch(argv_list):
+    """Several invocations (e.g. one person in many garments) through batched FEM passes (used by model_worker run_batch)."""
+    parser = build_parser()
+    all_args = parse_each(parser, argv_list)
+
+    def run(indices):
+        render([job for i in indices for job in garment_jobs(parser, all_args[i])],
+               max(all_args[i].batch_size for i in indices))
+
+    with span("fvnt_flow_renderer", cat="script", batch=len(all_args)):
+        return run_items(all_args, run)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+import numpy as np
+from PIL import Image
+from timing_trace import span
+
+# Precomputed garment catalog. `ingest` preprocesses a folder of flat garment
+# photos once (resize to 768x1024, rembg mask, FVNT model-resolution mask) and
+# appends the arrays to one packed file; index.json maps garment ids to their
+# content hash and the byte ranges of their arrays. Try-on requests then refer
+# to a garment by id ("catalog:<id>" wherever a garment path is accepted, or
+# --garment_id) and fvnt_flow_renderer.py memory-maps the arrays directly, so
+# there is no per-request garment preprocessing, decoding or resizing.
+#
+#   <catalog>/garments.bin   packed arrays (append-only; `compact` drops stale ones)
+#   <catalog>/index.json     {"version", "garments": {id: {"hash", "source", "arrays": {name: {offset, shape, dtype}}}}}
+INDEX_FILE = "index.json"
+DATA_FILE = "garments.bin"
+CATALOG_PREFIX = "catalog:"
+FORMAT_VERSION = 1
+ALIGN = 64
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+# Garment working size (preprocess_garment.py) and FEM input size (fvnt_flow_renderer.py)
+W_HD, H_HD = 768, 1024
+W_MODEL, H_MODEL = 192, 256
+# cloth: (H_HD, W_HD, 3) RGB, cloth_mask: (H_HD, W_HD) 0/255, mask_model: (H_MODEL, W_MODEL) nearest-resized mask
+ARRAYS = ["cloth", "cloth_mask", "mask_model"]
+
+
+def catalog_ref(garment_id):
+    return CATALOG_PREFIX + garment_id
+
+
+def is_catalog_ref(garment):
+    return isinstance(garment, str) and garment.startswith(CATALOG_PREFIX)
+
+
+def ref_id(garment):
+    return garment[len(CATALOG_PREFIX):]
+
+
+def content_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    # Part of the hash so a change to the stored layout re-ingests everything
+    h.update(f"v{FORMAT_VERSION}:{W_HD}x{H_HD}:{W_MODEL}x{H_MODEL}".encode())
+    return h.hexdigest()
+
+
+def garment_id_for(path):
+    """Default id: the file stem, reduced to [A-Za-z0-9_.-]."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.splitext(os.path.basename(path))[0])
+
+
+def model_mask(cloth_mask):
+    """The mask as fvnt_flow_renderer.prep_tensor resizes it for the FEM (PIL nearest)."""
+    return np.array(Image.fromarray(cloth_mask).resize((W_MODEL, H_MODEL), Image.NEAREST))
+
+
+class GarmentCatalog:
+    """Read access to a catalog folder; arrays are read-only views of the memory-mapped data file."""
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.data_path = os.path.join(root, DATA_FILE)
+        self.index = {"version": FORMAT_VERSION, "garments": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self._data = None
+
+    def __contains__(self, garment_id):
+        return garment_id in self.index["garments"]
+
+    def ids(self):
+        return sorted(self.index["garments"])
+
+    def entry(self, garment_id):
+        if garment_id not in self.index["garments"]:
+            raise KeyError(f"Garment {garment_id!r} is not in the catalog at {self.root}")
+        return self.index["garments"][garment_id]
+
+    def arrays(self, garment_id):
+        """{name: read-only array} of one garment (see ARRAYS)."""
+        entry = self.entry(garment_id)
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        return {name: np.ndarray(tuple(a["shape"]), dtype=np.dtype(a["dtype"]), buffer=self._data, offset=a["offset"])
+                for name, a in entry["arrays"].items()}
+
+    def save_index(self):
+        tmp = f"{self.index_path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1)
+        # Readers never see a half-written index
+        os.replace(tmp, self.index_path)
+
+    def append(self, garment_id, source, digest, arrays):
+        """Appends a garment's arrays to the data file and records them (call save_index after)."""
+        self._data = None
+        entries = {}
+        with open(self.data_path, "ab") as f:
+            for name in ARRAYS:
+                arr = np.ascontiguousarray(arrays[name])
+                offset = f.tell()
+                if offset % ALIGN:
+                    f.write(b"\0" * (ALIGN - offset % ALIGN))
+                    offset = f.tell()
+                f.write(arr.tobytes())
+                entries[name] = {"offset": offset, "shape": list(arr.shape), "dtype": arr.dtype.str}
+        self.index["garments"][garment_id] = {"hash": digest, "source": os.path.abspath(source), "type": "flat",
+                                              "arrays": entries}
+
+
+# Catalogs opened so far, keyed by folder (reused by persistent workers; reopened when the index changes)
+_CATALOGS = {}
+
+def open_catalog(root):
+    root = os.path.abspath(root)
+    index_path = os.path.join(root, INDEX_FILE)
+    stamp = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else None
+    cached = _CATALOGS.get(root)
+    if cached is None or cached[0] != stamp:
+        cached = _CATALOGS[root] = (stamp, GarmentCatalog(root))
+    return cached[1]
+
+
+def garment_identity(root, garment_id):
+    """Cache key part for a catalog garment: its id and content hash."""
+    return f"{garment_id}:{open_catalog(root).entry(garment_id)['hash']}"
+
+
+def list_images(input_dir):
+    return [os.path.join(input_dir, n) for n in sorted(os.listdir(input_dir)) if n.lower().endswith(IMAGE_EXTS)]
+
+
+def ingest(input_dir, root, force=False, batch_size=8, workers=1):
+    """Preprocesses every garment photo in input_dir that is new or changed. Returns (added, skipped, failed)."""
+    from preprocess_garment import load_garment, flat_garment_masks
+    import cv2
+
+    os.makedirs(root, exist_ok=True)
+    catalog = GarmentCatalog(root)
+    todo, skipped, failed = [], 0, []
+    for path in list_images(input_dir):
+        garment_id = garment_id_for(path)
+        digest = content_hash(path)
+        known = catalog.index["garments"].get(garment_id)
+        if known and known["source"] != os.path.abspath(path):
+            # Same stem from another folder: keep both
+            garment_id = f"{garment_id}_{digest[:8]}"
+            known = catalog.index["garments"].get(garment_id)
+        if known and known["hash"] == digest and not force:
+            skipped += 1
+            continue
+        todo.append((garment_id, path, digest))
+
+    print(f"[CATALOG] {len(todo)} garments to ingest, {skipped} unchanged")
+    added = 0
+    for start in range(0, len(todo), batch_size):
+        chunk = todo[start:start + batch_size]
+        with span("catalog ingest", cat="step", batch=len(chunk)):
+            imgs = [load_garment(path) for _, path, _ in chunk]
+            ok = [(item, img) for item, img in zip(chunk, imgs) if img is not None]
+            failed += [path for (_, path, _), img in zip(chunk, imgs) if img is None]
+            masks = flat_garment_masks([img for _, img in ok], workers=workers) if ok else []
+            for ((garment_id, path, digest), img), mask in zip(ok, masks):
+                catalog.append(garment_id, path, digest, {
+                    "cloth": cv2.cvtColor(img, cv2.COLOR_BGR2RGB),
+                    "cloth_mask": mask,
+                    "mask_model": model_mask(mask),
+                })
+                added += 1
+            # Index after every chunk, so an interrupted ingest keeps what it finished
+            catalog.save_index()
+    return added, skipped, failed
+
+
+def compact(root):
+    """Rewrites the data file with only the arrays the index still refers to."""
+    catalog = GarmentCatalog(root)
+    tmp = GarmentCatalog(root)
+    tmp.data_path = catalog.data_path + ".compact"
+    tmp.index = {"version": FORMAT_VERSION, "garments": {}}
+    if os.path.exists(tmp.data_path):
+        os.remove(tmp.data_path)
+    for garment_id in catalog.ids():
+        entry = catalog.entry(garment_id)
+        tmp.append(garment_id, entry["source"], entry["hash"], catalog.arrays(garment_id))
+    before = os.path.getsize(catalog.data_path) if os.path.exists(catalog.data_path) else 0
+    catalog._data = None
+    os.replace(tmp.data_path, catalog.data_path)
+    tmp.data_path = catalog.data_path
+    tmp.save_index()
+    return before, os.path.getsize(catalog.data_path) if os.path.exists(catalog.data_path) else 0
+
+
+def export(root, garment_id, output_dir):
+    """Writes cloth.png / cloth_mask.png of a catalog garment (for inspection or file-based tools)."""
+    from artifact_store import write_array
+    arrays = open_catalog(root).arrays(garment_id)
+    os.makedirs(output_dir, exist_ok=True)
+    write_array(os.path.join(output_dir, "cloth.png"), arrays["cloth"], png=True)
+    write_array(os.path.join(output_dir, "cloth_mask.png"), arrays["cloth_mask"], png=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precomputed garment catalog (packed, memory-mapped)")
+    parser.add_argument("command", choices=["ingest", "list", "export", "compact"])
+    parser.add_argument("--catalog", required=True, help="Catalog folder")
+    parser.add_argument("--input_dir", help="ingest: folder of flat garment photos")
+    parser.add_argument("--force", action="store_true", help="ingest: re-process garments whose hash is unchanged")
+    parser.add_argument("--batch_size", type=int, default=8, help="ingest: garments masked per rembg batch")
+    parser.add_argument("--workers", type=int, default=1, help="ingest: garments segmented concurrently")
+    parser.add_argument("--garment_id", help="export: garment to export")
+    parser.add_argument("--output_dir", help="export: destination folder")
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        if not args.input_dir:
+            parser.error("ingest needs --input_dir")
+        added, skipped, failed = ingest(args.input_dir, args.catalog, args.force, args.batch_size, args.workers)
+        print(f"[CATALOG] Added {added}, unchanged {skipped}, failed {len(failed)} -> {args.catalog}")
+        for path in failed:
+            print(f"!!! Could not read {path}")
+    elif args.command == "list":
+        catalog = open_catalog(args.catalog)
+        for garment_id in catalog.ids():
+            entry = catalog.entry(garment_id)
+            print(f"{garment_id}\t{entry['hash'][:12]}\t{entry['source']}")
+        print(f"{len(catalog.ids())} garments")
+    elif args.command == "export":
+        if not args.garment_id or not args.output_dir:
+            parser.error("export needs --garment_id and --output_dir")
+        export(args.catalog, args.garment_id, args.output_dir)
+        print(f"Exported {args.garment_id} to {args.output_dir}")
+    else:
+        before, after = compact(args.catalog)
+        print(f"[CATALOG] Compacted {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+
+if __name__ == "__main__":
+    main()
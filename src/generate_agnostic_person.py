@@ -4,6 +4,9 @@ import numpy as np
 from PIL import Image
 from pathlib import Path
 import argparse
+from artifact_store import read_array, read_image, write_array
+from timing_trace import span
+from label_groups import parse_flags, in_group, GARMENT, PRESERVE
 
 def generate_agnostic(img_path, parse_path, output_dir, warped_mask_path=None, dilation_kernel_size=15, smoothing_sigma=5):
     """
@@ -19,27 +22,31 @@ def generate_agnostic(img_path, parse_path, output_dir, warped_mask_path=None, d
     os.makedirs(agnostic_mask_dir, exist_ok=True)
 
     # Load image and parsing
-    image = np.array(Image.open(img_path).convert("RGB"))
-    parse = np.array(Image.open(parse_path))
+    with span("decode", cat="io"):
+        image = read_array(img_path, "RGB")
+        parse = read_array(parse_path)
 
     # 1. Identify ORIGINAL clothing area (LIP Labels: 5:Upper, 6:Dress, 7:Coat, 10:Jumpsuit, 11:Scarf)
-    clothing_mask = np.isin(parse, [5, 6, 7, 10, 11]).astype(np.uint8)
+    flags = parse_flags(parse)
+    clothing_mask = in_group(flags, GARMENT).astype(np.uint8)
     
     # 2. Identify NEW clothing footprint (if provided)
     w_mask = np.zeros_like(clothing_mask)
     if warped_mask_path:
-        w_mask_img = Image.open(warped_mask_path).convert("L").resize((image.shape[1], image.shape[0]), Image.NEAREST)
+        with span("decode", cat="io"):
+            w_mask_img = read_image(warped_mask_path, "L").resize((image.shape[1], image.shape[0]), Image.NEAREST)
         w_mask = (np.array(w_mask_img) > 127).astype(np.uint8)
     
     # 3. Final Agnostic Mask = (Old Clothing Area OR New Clothing Footprint)
     # Preservation labels: 1:Hat, 2:Hair, 4:Sunglasses, 13:Face (NEVER MASK THESE)
-    preserve_mask = np.isin(parse, [1, 2, 4, 13]).astype(np.uint8)
+    preserve_mask = in_group(flags, PRESERVE).astype(np.uint8)
     
     combined_mask = (clothing_mask | w_mask)
     
     # Refine with Dilation
-    kernel = np.ones((dilation_kernel_size, dilation_kernel_size), np.uint8)
-    dilated_mask = cv2.dilate(combined_mask, kernel, iterations=1)
+    with span("morphology", cat="compute"):
+        kernel = np.ones((dilation_kernel_size, dilation_kernel_size), np.uint8)
+        dilated_mask = cv2.dilate(combined_mask, kernel, iterations=1)
     
     # Ensure face/hair are never masked
     final_agnostic_mask = (dilated_mask == 1) & (preserve_mask == 0)
@@ -59,20 +66,21 @@ def generate_agnostic(img_path, parse_path, output_dir, warped_mask_path=None, d
 
     # 6. Save results
     img_name = Path(img_path).name
-    Image.fromarray(agnostic_img).save(os.path.join(agnostic_img_dir, img_name))
+    with span("png_encode", cat="io"):
+        write_array(os.path.join(agnostic_img_dir, img_name), agnostic_img)
     
-    # Save binary mask
-    Image.fromarray((final_agnostic_mask * 255).astype(np.uint8)).save(os.path.join(agnostic_mask_dir, img_name))
+        # Save binary mask
+        write_array(os.path.join(agnostic_mask_dir, img_name), (final_agnostic_mask * 255).astype(np.uint8))
     
-    # Save parsing (clear out the masked areas)
-    agnostic_parse = parse.copy()
-    agnostic_parse[final_agnostic_mask] = 0
-    parse_name = Path(parse_path).name
-    Image.fromarray(agnostic_parse.astype(np.uint8)).save(os.path.join(agnostic_parse_dir, parse_name))
+        # Save parsing (clear out the masked areas)
+        agnostic_parse = parse.copy()
+        agnostic_parse[final_agnostic_mask] = 0
+        parse_name = Path(parse_path).name
+        write_array(os.path.join(agnostic_parse_dir, parse_name), agnostic_parse.astype(np.uint8))
 
     print(f"Generated agnostic person (Intuitive Layering Mode): {os.path.join(output_dir, img_name)}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Generate Agnostic Person for VITON")
     parser.add_argument("--image", required=True)
     parser.add_argument("--parse", required=True)
@@ -82,5 +90,9 @@ if __name__ == "__main__":
     parser.add_argument("--warped_mask", help="Path to warped garment mask")
     parser.add_argument("--preserve_arms", action="store_true") # Kept for CLI compatibility, but logic is now automatic
 
-    args = parser.parse_args()
-    generate_agnostic(args.image, args.parse, args.output_dir, args.warped_mask, args.dilation, args.smoothing)
+    args = parser.parse_args(argv)
+    with span("generate_agnostic_person", cat="script"):
+        generate_agnostic(args.image, args.parse, args.output_dir, args.warped_mask, args.dilation, args.smoothing)
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,22 @@ import os
 import cv2
 import numpy as np
 import argparse
-from PIL import Image
+from artifact_store import read_array, write_array
+from label_groups import (parse_flags, dp_flags, in_group, PRESERVE, LOWER, TORSO_GARMENT, ARMS, FACE,
+                          DP_TORSO, DP_HANDS, DP_ARMS, DP_LOWER_ARMS)
+from timing_trace import span
 
-def generate_target_mask(schp_path, densepose_path, output_dir, sleeve_type="full", person_mask_path=None):
-    """
-    Generates a robust target mask.
-    """
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # 1. Load Inputs
-    parsing = np.array(Image.open(schp_path))
-    dp_img = cv2.imread(densepose_path)
-    if dp_img is None:
-        raise ValueError(f"Could not load DensePose image from {densepose_path}")
+# Variant order of the stacked output (target_masks.png: one channel per sleeve type)
+SLEEVE_TYPES = ["none", "half", "full"]
+
+def load_inputs(schp_path, densepose_path, person_mask_path=None):
+    """(parsing, DensePose part index map, person mask or None), all at the SCHP resolution."""
+    with span("decode", cat="io"):
+        parsing = read_array(schp_path)
+        try:
+            dp_img = read_array(densepose_path)
+        except OSError:
+            raise ValueError(f"Could not load DensePose image from {densepose_path}")
     
     dp_i = dp_img[:, :, 0] if len(dp_img.shape) == 3 else dp_img
     # Keep all masks in the same resolution to avoid stair-step artifacts.
@@ -23,101 +26,158 @@ def generate_target_mask(schp_path, densepose_path, output_dir, sleeve_type="ful
     
     p_mask = None
     if person_mask_path:
-        p_mask_img = Image.open(person_mask_path).convert("L")
-        p_mask = (np.array(p_mask_img) > 127).astype(np.uint8)
+        with span("decode", cat="io"):
+            p_mask_img = read_array(person_mask_path, "L")
+        p_mask = (p_mask_img > 127).astype(np.uint8)
         if p_mask.shape[:2] != parsing.shape[:2]:
             p_mask = cv2.resize(p_mask, (parsing.shape[1], parsing.shape[0]), interpolation=cv2.INTER_NEAREST)
+    return parsing, dp_i, p_mask
 
-    # 2. Define Masks
-    # LIP Labels to EXCLUDE (Preserve):
-    # 1: Hat, 2: Hair, 4: Sunglasses, 13: Face (Head)
-    # 9: Pants, 12: Skirts/Lower Body, 16: Left-leg, 17: Right-leg, 18: Left-shoe, 19: Right-shoe
-    exclude_indices = [1, 2, 4, 9, 12, 13, 16, 17, 18, 19]
-    exclude_mask = np.isin(parsing, exclude_indices).astype(np.uint8)
-    
-    # Dilate exclusion mask slightly to remove "halo" streaks near hair/face
-    kernel_ex = np.ones((5, 5), np.uint8)
-    exclude_mask = cv2.dilate(exclude_mask, kernel_ex, iterations=1).astype(bool)
-    
-    # Base area: Torso and anything that looks like upper clothes
-    base_torso_garment = np.isin(dp_i, [1, 2]) | np.isin(parsing, [5, 6, 7])
-    
-    # 3. Refine based on sleeve_type
-    if sleeve_type == "full":
-        # Strategy: Include Torso + All Arms detection (15-22). 
-        # FALLBACK: Use person silhouette but strictly block the exclusion zones (Pants/Head)
-        target_mask = base_torso_garment | np.isin(dp_i, range(15, 23)) | np.isin(parsing, [14, 15])
+def shared_masks(parsing, dp_i):
+    """The intermediates every sleeve type uses (computed once for all variants)."""
+    with span("morphology shared", cat="compute"):
+        p_flags, d_flags = parse_flags(parsing), dp_flags(dp_i)
+        # EXCLUDE (preserve): hat, hair, sunglasses, face and the lower body (pants, skirt, legs, shoes)
+        exclude_mask = in_group(p_flags, PRESERVE | LOWER).astype(np.uint8)
+        # Dilate exclusion mask slightly to remove "halo" streaks near hair/face
+        kernel_ex = np.ones((5, 5), np.uint8)
+        face_rows = np.flatnonzero(in_group(p_flags, FACE).any(axis=1))
+        return {
+            "exclude": cv2.dilate(exclude_mask, kernel_ex, iterations=1).astype(bool),
+            # Base area: Torso and anything that looks like upper clothes
+            "base": in_group(d_flags, DP_TORSO) | in_group(p_flags, TORSO_GARMENT),
+            # DP [15-22] = All Arms
+            "arms": in_group(d_flags, DP_ARMS) | in_group(p_flags, ARMS),
+            "lower_arms": in_group(d_flags, DP_LOWER_ARMS),
+            "hands": in_group(d_flags, DP_HANDS),
+            "face_bottom": face_rows[-1] if len(face_rows) > 0 else None,
+        }
+
+def variant_mask(shared, sleeve_type, p_mask=None):
+    """Target mask (uint8 0-255) of one sleeve type from shared_masks."""
+    with span("morphology", cat="compute", sleeve_type=sleeve_type):
+        exclude_mask, base_torso_garment = shared["exclude"], shared["base"]
+
+        # Refine based on sleeve_type
+        if sleeve_type == "full":
+            # Strategy: Include Torso + All Arms detection (15-22). 
+            # FALLBACK: Use person silhouette but strictly block the exclusion zones (Pants/Head)
+            target_mask = base_torso_garment | shared["arms"]
         
-        if p_mask is not None:
-            p_mask_bool = p_mask.astype(bool)
-            robust_full_garment = p_mask_bool & (~exclude_mask)
-            target_mask |= robust_full_garment
+            if p_mask is not None:
+                p_mask_bool = p_mask.astype(bool)
+                robust_full_garment = p_mask_bool & (~exclude_mask)
+                target_mask |= robust_full_garment
             
-    elif sleeve_type == "half":
-        target_mask = base_torso_garment.copy()
-        # DP [19, 20, 21, 22] = Lower Arms
-        lower_arms_dp = np.isin(dp_i, [19, 20, 21, 22])
-        if np.sum(lower_arms_dp) > 0:
-            kernel_la = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
-            lower_arms_broad = cv2.dilate(lower_arms_dp.astype(np.uint8), kernel_la, iterations=1).astype(bool)
-            target_mask &= (~lower_arms_broad)
+        elif sleeve_type == "half":
+            target_mask = base_torso_garment.copy()
+            # DP [19, 20, 21, 22] = Lower Arms
+            lower_arms_dp = shared["lower_arms"]
+            if np.sum(lower_arms_dp) > 0:
+                kernel_la = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
+                lower_arms_broad = cv2.dilate(lower_arms_dp.astype(np.uint8), kernel_la, iterations=1).astype(bool)
+                target_mask &= (~lower_arms_broad)
             
-        # Ensure hands (3, 4) are strictly excluded from garment
-        hands_dp = np.isin(dp_i, [3, 4])
-        target_mask &= (~hands_dp)
+            # Ensure hands (3, 4) are strictly excluded from garment
+            target_mask &= (~shared["hands"])
 
-        # Smooth short-sleeve boundaries
-        target_u8 = target_mask.astype(np.uint8)
-        k_close = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (11, 11))
-        k_open = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        target_u8 = cv2.morphologyEx(target_u8, cv2.MORPH_CLOSE, k_close)
-        target_u8 = cv2.morphologyEx(target_u8, cv2.MORPH_OPEN, k_open)
-        target_u8 = cv2.medianBlur((target_u8 * 255).astype(np.uint8), 5)
-        target_mask = (target_u8 > 127)
-    else: # none
-        # DP [15-22] = All Arms
-        arms_dp = np.isin(dp_i, range(15, 23)) | np.isin(parsing, [14, 15])
-        kernel_a = np.ones((25, 25), np.uint8)
-        arms_broad = cv2.dilate(arms_dp.astype(np.uint8), kernel_a, iterations=1).astype(bool)
-        target_mask = base_torso_garment & (~arms_broad)
+            # Smooth short-sleeve boundaries
+            target_u8 = target_mask.astype(np.uint8)
+            k_close = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (11, 11))
+            k_open = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+            target_u8 = cv2.morphologyEx(target_u8, cv2.MORPH_CLOSE, k_close)
+            target_u8 = cv2.morphologyEx(target_u8, cv2.MORPH_OPEN, k_open)
+            target_u8 = cv2.medianBlur((target_u8 * 255).astype(np.uint8), 5)
+            target_mask = (target_u8 > 127)
+        else: # none
+            kernel_a = np.ones((25, 25), np.uint8)
+            arms_broad = cv2.dilate(shared["arms"].astype(np.uint8), kernel_a, iterations=1).astype(bool)
+            target_mask = base_torso_garment & (~arms_broad)
     
-    # 4. Final Cleanup (Ensure no pants/head/hands pixels slipped in)
-    target_mask[exclude_mask] = False
-    target_mask[np.isin(dp_i, [3, 4])] = False # Block hands
+        # Final Cleanup (Ensure no pants/head/hands pixels slipped in)
+        target_mask[exclude_mask] = False
+        target_mask[shared["hands"]] = False # Block hands
     
-    # --- CHIN CUTOFF FIX ---
-    # Find the chin (Face Bottom) and wipe out anything above it to prevent "turtle neck"
-    face_rows = np.where(parsing == 13)[0] # Face label
-    if len(face_rows) > 0:
-        face_bottom = face_rows.max()
-        target_mask[:face_bottom + 5, :] = False
+        # --- CHIN CUTOFF FIX ---
+        # Find the chin (Face Bottom) and wipe out anything above it to prevent "turtle neck"
+        if shared["face_bottom"] is not None:
+            target_mask[:shared["face_bottom"] + 5, :] = False
 
-    mask_float = target_mask.astype(np.float32)
+        mask_float = target_mask.astype(np.float32)
     
-    # 5. Universal Refinement & Speckle Removal
-    # morphology open removes small noise/speckles
-    kernel_noise = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    mask_float = cv2.morphologyEx(mask_float, cv2.MORPH_OPEN, kernel_noise)
+        # Universal Refinement & Speckle Removal
+        # morphology open removes small noise/speckles
+        kernel_noise = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        mask_float = cv2.morphologyEx(mask_float, cv2.MORPH_OPEN, kernel_noise)
     
-    # Final smooth edges
-    kernel_dil = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-    mask_float = cv2.dilate(mask_float, kernel_dil, iterations=1)
-    mask_float = cv2.GaussianBlur(mask_float, (11, 11), 2)
+        # Final smooth edges
+        kernel_dil = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+        mask_float = cv2.dilate(mask_float, kernel_dil, iterations=1)
+        mask_float = cv2.GaussianBlur(mask_float, (11, 11), 2)
+    return (mask_float * 255).astype(np.uint8)
+
+def compute_target_masks(schp_path, densepose_path, sleeve_types, person_mask_path=None):
+    """{sleeve_type: target mask} for several sleeve types, decoding the inputs and building the shared masks once."""
+    parsing, dp_i, p_mask = load_inputs(schp_path, densepose_path, person_mask_path)
+    shared = shared_masks(parsing, dp_i)
+    return {sleeve_type: variant_mask(shared, sleeve_type, p_mask) for sleeve_type in sleeve_types}
+
+def stack_variants(masks):
+    """(H, W, 3) array with one channel per SLEEVE_TYPES entry (zeros for variants not computed)."""
+    shape = next(iter(masks.values())).shape
+    return np.dstack([masks.get(sleeve_type, np.zeros(shape, np.uint8)) for sleeve_type in SLEEVE_TYPES])
+
+def read_variant(stacked_path, sleeve_type):
+    """One sleeve type's mask out of target_masks.png."""
+    return np.ascontiguousarray(read_array(stacked_path)[:, :, SLEEVE_TYPES.index(sleeve_type)])
+
+def generate_target_mask(schp_path, densepose_path, output_dir, sleeve_type="full", person_mask_path=None):
+    """
+    Generates a robust target mask.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    mask_uint8 = compute_target_masks(schp_path, densepose_path, [sleeve_type], person_mask_path)[sleeve_type]
     
-    # 6. Save Results
     output_path = os.path.join(output_dir, "target_mask.png")
-    mask_uint8 = (mask_float * 255).astype(np.uint8)
-    
-    cv2.imwrite(output_path, mask_uint8)
+    with span("png_encode", cat="io"):
+        write_array(output_path, mask_uint8)
     print(f"Target mask ({sleeve_type}) generated and saved to {output_path}")
 
-if __name__ == "__main__":
+def generate_target_masks(schp_path, densepose_path, output_dir, sleeve_types=SLEEVE_TYPES, person_mask_path=None):
+    """
+    All requested sleeve types in one pass: target_mask_<sleeve_type>.png for each
+    and target_masks.png stacking them (see stack_variants / read_variant).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    masks = compute_target_masks(schp_path, densepose_path, sleeve_types, person_mask_path)
+    with span("png_encode", cat="io"):
+        for sleeve_type, mask in masks.items():
+            write_array(os.path.join(output_dir, f"target_mask_{sleeve_type}.png"), mask)
+        write_array(os.path.join(output_dir, "target_masks.png"), stack_variants(masks))
+    print(f"Target masks ({', '.join(masks)}) generated and saved to {output_dir}")
+    return masks
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--schp", required=True)
     parser.add_argument("--densepose", required=True)
     parser.add_argument("--person_mask", help="Path to person mask from rembg")
     parser.add_argument("--output_dir", required=True)
-    parser.add_argument("--sleeve_type", choices=["none", "half", "full"], default="full")
-    args = parser.parse_args()
+    parser.add_argument("--sleeve_type", choices=SLEEVE_TYPES, default="full")
+    parser.add_argument("--sleeve_types", default=None,
+                        help="Comma-separated sleeve types (or 'all') computed in one pass; writes "
+                             "target_mask_<type>.png and the stacked target_masks.png instead of target_mask.png")
+    args = parser.parse_args(argv)
     
-    generate_target_mask(args.schp, args.densepose, args.output_dir, args.sleeve_type, args.person_mask)
+    with span("generate_target_mask", cat="script"):
+        if args.sleeve_types:
+            sleeve_types = SLEEVE_TYPES if args.sleeve_types == "all" else args.sleeve_types.split(",")
+            unknown = [t for t in sleeve_types if t not in SLEEVE_TYPES]
+            if unknown:
+                parser.error(f"Unknown sleeve types {unknown} (choose from {SLEEVE_TYPES})")
+            generate_target_masks(args.schp, args.densepose, args.output_dir, sleeve_types, args.person_mask)
+        else:
+            generate_target_mask(args.schp, args.densepose, args.output_dir, args.sleeve_type, args.person_mask)
+
+if __name__ == "__main__":
+    main()
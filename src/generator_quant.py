@@ -0,0 +1,188 @@
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from run_stylevton import load_generator
+from stage_cache import file_identity
+
+# Reduced-precision copies of the StyleVTON ResUnetGenerator used for skin
+# inpainting (run_stylevton --inpaint_precision), prepared once and kept next
+# to the checkpoint as <checkpoint>.<precision>.ts:
+#
+#   bf16: BatchNorm folded into the convolutions, weights and activations in
+#         bfloat16 (the model casts its input and output, callers pass fp32).
+#   int8: static post-training quantization (FX graph mode, x86/fbgemm),
+#         calibrated on real generator inputs. Dynamic quantization only
+#         covers Linear/LSTM layers, so it would leave every Conv2d in fp32.
+#
+# Prepared models are never built on the fly: `prepare` calibrates on the
+# given samples and checks them against fp32 (PSNR inside the holes) before
+# the model is used. Each one records the identity of its checkpoint and is
+# refused once the checkpoint changes.
+#
+# Calibration / comparison samples are written by run_stylevton --dump_inpaint_input:
+#
+#   python generator_quant.py prepare --checkpoint <ckpt> --precision int8 --samples dumps/*.npz
+#   python generator_quant.py compare --checkpoint <ckpt> --precision bf16 int8 --samples dumps/*.npz
+PRECISIONS = ["fp32", "bf16", "int8"]
+# Metadata stored in the TorchScript archive
+META_FILE = "generator_quant.json"
+
+
+class CastIO(torch.nn.Module):
+    """Runs `model` in `dtype` behind an fp32 interface."""
+
+    def __init__(self, model, dtype):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x):
+        return self.model(x.to(self.dtype)).float()
+
+
+def prepared_path(checkpoint, precision, path=None):
+    return path or f"{checkpoint}.{precision}.ts"
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in engines else "fbgemm"
+
+
+def prepare(checkpoint, precision, calibration, output=None):
+    """
+    Writes the TorchScript generator of `checkpoint` in `precision`. calibration:
+    (1, 7, H, W) fp32 generator inputs, observed for the int8 ranges (bf16 only
+    traces with the first). Returns the path.
+    """
+    from torch.fx.experimental.optimization import fuse
+    path = prepared_path(checkpoint, precision, output)
+    gen = copy.deepcopy(load_generator(checkpoint, "cpu")).eval()
+    with torch.no_grad():
+        if precision == "bf16":
+            model = CastIO(fuse(gen).to(torch.bfloat16), torch.bfloat16)
+        elif precision == "int8":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            engine = quantized_engine()
+            torch.backends.quantized.engine = engine
+            observed = prepare_fx(gen, get_default_qconfig_mapping(engine), (calibration[0],))
+            for x in calibration:
+                observed(x)
+            model = convert_fx(observed)
+        else:
+            raise ValueError(f"Nothing to prepare for precision {precision!r}")
+        traced = torch.jit.freeze(torch.jit.trace(model.eval(), calibration[0], check_trace=False))
+    tmp = f"{path}.tmp{os.getpid()}"
+    meta = {"checkpoint": file_identity(checkpoint), "precision": precision, "calibration_samples": len(calibration)}
+    torch.jit.save(traced, tmp, _extra_files={META_FILE: json.dumps(meta)})
+    # Running workers never load a half-written model
+    os.replace(tmp, path)
+    return path
+
+
+def load_prepared(checkpoint, precision, device, path=None):
+    """The prepared generator (FileNotFoundError if missing or prepared from another checkpoint)."""
+    path = prepared_path(checkpoint, precision, path)
+    hint = f"prepare it with: generator_quant.py prepare --checkpoint {checkpoint} --precision {precision} --samples ..."
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No {precision} generator at {path}; {hint}")
+    if precision == "int8":
+        torch.backends.quantized.engine = quantized_engine()
+    extra = {META_FILE: ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra)
+    meta = json.loads(extra[META_FILE] or "{}")
+    if meta.get("checkpoint") != file_identity(checkpoint):
+        raise FileNotFoundError(f"{path} was prepared from {meta.get('checkpoint', 'an unknown checkpoint')}, "
+                                f"not {file_identity(checkpoint)}; {hint}")
+    return model.eval()
+
+
+def load_samples(paths):
+    """(input (1, 7, H, W) fp32 tensor, holes (H, W) bool) pairs from --dump_inpaint_input files."""
+    samples = []
+    for path in paths:
+        with np.load(path) as data:
+            samples.append((torch.from_numpy(data["input"].astype(np.float32)).unsqueeze(0), data["holes"].astype(bool)))
+    return samples
+
+
+def inpaint_rgb(model, x):
+    """(H, W, 3) [0, 1] RGB that run_stylevton blends into the holes (before tone matching)."""
+    with torch.no_grad():
+        p_rendered = torch.tanh(model(x)[:, :3].float())
+    return (p_rendered[0].permute(1, 2, 0).numpy() + 1.0) / 2.0
+
+
+def hole_psnr(reference, test, holes):
+    mse = float(np.mean((reference[holes] - test[holes]) ** 2)) if holes.any() else 0.0
+    return float("inf") if mse == 0 else 10.0 * np.log10(1.0 / mse)
+
+
+def compare(checkpoint, precisions, samples, tries=3):
+    """PSNR (dB) inside the holes of each sample vs fp32, and ms per inference, for each precision."""
+    models = {"fp32": load_generator(checkpoint, "cpu")}
+    for precision in precisions:
+        models[precision] = load_prepared(checkpoint, precision, "cpu")
+    report = {name: {"ms": [], "psnr": []} for name in models}
+    for x, holes in samples:
+        outputs = {}
+        for name, model in models.items():
+            best = None
+            for _ in range(tries):
+                t0 = time.perf_counter()
+                outputs[name] = inpaint_rgb(model, x)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            report[name]["ms"].append(round(best * 1000, 1))
+            report[name]["psnr"].append(round(hole_psnr(outputs["fp32"], outputs[name], holes), 2))
+    for name, entry in report.items():
+        entry["mean_ms"] = round(float(np.mean(entry["ms"])), 1)
+        entry["min_psnr"] = min(entry["psnr"])
+    del report["fp32"]["psnr"], report["fp32"]["min_psnr"]
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare reduced-precision skin inpainting generators and compare them with fp32")
+    parser.add_argument("command", choices=["prepare", "compare"])
+    parser.add_argument("--checkpoint", required=True, help="StyleVTON generator checkpoint")
+    parser.add_argument("--precision", nargs="+", choices=PRECISIONS[1:], default=["int8"])
+    parser.add_argument("--samples", nargs="+", default=[], help="Generator inputs from run_stylevton --dump_inpaint_input (globs allowed)")
+    parser.add_argument("--min_psnr", type=float, default=30.0, help="Fail below this PSNR (dB) inside the holes")
+    parser.add_argument("--report", default=None, help="Write the comparison report as JSON here")
+    args = parser.parse_args(argv)
+
+    paths = sorted(p for pattern in args.samples for p in glob.glob(pattern))
+    if not paths:
+        parser.error("--samples matched no files")
+    samples = load_samples(paths)
+
+    if args.command == "prepare":
+        for precision in args.precision:
+            path = prepare(args.checkpoint, precision, [x for x, _ in samples])
+            print(f"Prepared {precision} generator at {path} ({len(samples)} samples)")
+
+    # prepare is always followed by the quality check
+    report = compare(args.checkpoint, args.precision, samples)
+    print(json.dumps(report, indent=1))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+    failed = [p for p in args.precision if report[p]["min_psnr"] < args.min_psnr]
+    if failed:
+        for p in failed:
+            print(f"!!! {p} inpainting drops to {report[p]['min_psnr']:.2f} dB inside the holes (min {args.min_psnr})")
+            if args.command == "prepare":
+                # A model that fails the check is not left where run_stylevton would load it
+                os.remove(prepared_path(args.checkpoint, p))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
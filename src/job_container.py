@@ -0,0 +1,316 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+import numpy as np
+# Lock implementation for _locked, chosen once (not inside the locked block)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# One file per job holding every intermediate artifact (artifact mode "container",
+# see artifact_store.py). Stages keep addressing artifacts by their usual paths;
+# an artifact under a folder that holds a job.vtc is stored in that container
+# under its relative path (e.g. "persons/<id>/schp/person.png").
+#
+# The file is an append-only log of records, so stages in different processes
+# can write concurrently (appends are serialized with a lock file) and a re-run
+# simply appends a newer record of the same name; `compact` drops the old ones.
+#   record = MAGIC | meta length (u32) | payload length (u64) | meta JSON | payload
+# Payloads are zlib-compressed (level 1) and stored compactly by content:
+#   bits: 0/255 masks, bit-packed (1 bit per pixel)
+#   u8:   other uint8 images and label maps
+#   f16:  float arrays (flows), stored as float16
+CONTAINER_FILE = "job.vtc"
+MAGIC = b"VTCR"
+_HEADER = struct.Struct("<4sIQ")
+ZLIB_LEVEL = 1
+
+
+def encode(arr, palette=None):
+    """(meta, payload bytes) for an array."""
+    arr = np.asarray(arr)
+    meta = {"shape": list(arr.shape)}
+    if arr.dtype == np.bool_ or (arr.dtype == np.uint8 and arr.ndim == 2 and not ((arr != 0) & (arr != 255)).any()):
+        meta["kind"] = "bits"
+        raw = np.packbits(arr.reshape(-1) > 0).tobytes()
+    elif arr.dtype == np.uint8:
+        meta["kind"] = "u8"
+        raw = np.ascontiguousarray(arr).tobytes()
+    elif np.issubdtype(arr.dtype, np.floating):
+        meta["kind"] = "f16"
+        raw = np.ascontiguousarray(arr, dtype=np.float16).tobytes()
+    else:
+        meta["kind"] = "raw"
+        meta["dtype"] = arr.dtype.str
+        raw = np.ascontiguousarray(arr).tobytes()
+    if palette is not None:
+        meta["palette"] = list(palette)
+    return meta, zlib.compress(raw, ZLIB_LEVEL)
+
+
+def decode(meta, payload):
+    raw = zlib.decompress(payload)
+    shape = tuple(meta["shape"])
+    kind = meta["kind"]
+    if kind == "bits":
+        count = int(np.prod(shape))
+        return (np.unpackbits(np.frombuffer(raw, np.uint8), count=count) * 255).astype(np.uint8).reshape(shape)
+    if kind == "u8":
+        return np.frombuffer(raw, np.uint8).reshape(shape)
+    if kind == "f16":
+        return np.frombuffer(raw, np.float16).reshape(shape).astype(np.float32)
+    return np.frombuffer(raw, np.dtype(meta["dtype"])).reshape(shape)
+
+
+def unpack_record(record):
+    """(meta, array) of an encoded record (see JobContainer.record)."""
+    _, meta_len, _ = _HEADER.unpack(record[:_HEADER.size])
+    meta = json.loads(record[_HEADER.size:_HEADER.size + meta_len])
+    return meta, decode(meta, record[_HEADER.size + meta_len:])
+
+
+@contextmanager
+def _locked(path):
+    """Exclusive lock on <path>.lock across processes (appends from several stages)."""
+    with open(path + ".lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class JobContainer:
+    """Reader/writer of one job.vtc. The index (name -> latest record) is refreshed as the file grows."""
+
+    def __init__(self, path):
+        self.path = path
+        self._index = {}
+        self._scanned = 0
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size <= self._scanned:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._scanned)
+            pos = self._scanned
+            while pos + _HEADER.size <= size:
+                magic, meta_len, payload_len = _HEADER.unpack(f.read(_HEADER.size))
+                end = pos + _HEADER.size + meta_len + payload_len
+                if magic != MAGIC or end > size:
+                    break  # torn tail of a record still being written
+                meta = json.loads(f.read(meta_len))
+                self._index[meta["name"]] = (pos, meta, payload_len)
+                f.seek(payload_len, os.SEEK_CUR)
+                pos = end
+        self._scanned = pos
+
+    def names(self):
+        with self._lock:
+            self._refresh()
+            return sorted(self._index)
+
+    def __contains__(self, name):
+        with self._lock:
+            self._refresh()
+            return name in self._index
+
+    def meta(self, name):
+        with self._lock:
+            self._refresh()
+            return self._index[name][1]
+
+    def position(self, name):
+        """Offset of the latest record of `name` (changes whenever it is rewritten), or None."""
+        with self._lock:
+            self._refresh()
+            return self._index[name][0] if name in self._index else None
+
+    def record(self, name):
+        """The encoded record of `name` (bytes), e.g. to copy it into the stage cache."""
+        with self._lock:
+            self._refresh()
+            pos, meta, payload_len = self._index[name]
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            header = f.read(_HEADER.size)
+            return header + f.read(_HEADER.unpack(header)[1] + payload_len)
+
+    def read(self, name):
+        """Decoded array of `name` (KeyError if missing)."""
+        with self._lock:
+            self._refresh()
+            pos, meta, payload_len = self._index[name]
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            _, meta_len, _ = _HEADER.unpack(f.read(_HEADER.size))
+            f.seek(meta_len, os.SEEK_CUR)
+            return decode(meta, f.read(payload_len))
+
+    def fingerprint(self, name):
+        """Content hash of `name` (shape, kind and payload, not the name), for stage cache keys."""
+        with self._lock:
+            self._refresh()
+            pos = self._index[name][0]
+        if pos not in self._fingerprints:
+            record = self.record(name)
+            _, meta_len, _ = _HEADER.unpack(record[:_HEADER.size])
+            meta = json.loads(record[_HEADER.size:_HEADER.size + meta_len])
+            meta.pop("name")
+            h = hashlib.sha256(json.dumps(meta, sort_keys=True).encode())
+            h.update(record[_HEADER.size + meta_len:])
+            self._fingerprints[pos] = h.hexdigest()
+        return self._fingerprints[pos]
+
+    def append_record(self, name, record):
+        """Appends an encoded record (from record()), renamed to `name`, unless `name` already holds it."""
+        _, meta_len, payload_len = _HEADER.unpack(record[:_HEADER.size])
+        meta = json.loads(record[_HEADER.size:_HEADER.size + meta_len])
+        payload = record[_HEADER.size + meta_len:]
+        if name in self:
+            current = self.record(name)
+            _, current_meta_len, _ = _HEADER.unpack(current[:_HEADER.size])
+            if current[_HEADER.size + current_meta_len:] == payload and dict(meta, name=name) == self.meta(name):
+                return
+        self._append(dict(meta, name=name), payload)
+
+    def write(self, name, arr, palette=None):
+        meta, payload = encode(arr, palette)
+        self._append(dict(meta, name=name), payload)
+
+    def _append(self, meta, payload):
+        meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+        data = _HEADER.pack(MAGIC, len(meta_bytes), len(payload)) + meta_bytes + payload
+        with _locked(self.path):
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def stats(self):
+        """(artifacts, file bytes, bytes of the latest records, decoded bytes)."""
+        names = self.names()
+        live = sum(_HEADER.size + len(json.dumps(self._index[n][1], separators=(",", ":"))) + self._index[n][2] for n in names)
+        decoded = sum(int(np.prod(self._index[n][1]["shape"])) for n in names)
+        return len(names), os.path.getsize(self.path), live, decoded
+
+
+# Open containers, keyed by file path (the index is kept between calls in workers)
+_CONTAINERS = {}
+# Folders known to hold a container
+_ROOTS = {}
+
+
+def open_container(path):
+    path = os.path.abspath(path)
+    if path not in _CONTAINERS:
+        _CONTAINERS[path] = JobContainer(path)
+    return _CONTAINERS[path]
+
+
+def create(root):
+    """Makes `root` a job root: artifacts below it go into <root>/job.vtc (container mode)."""
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, CONTAINER_FILE)
+    if not os.path.exists(path):
+        with _locked(path):
+            open(path, "ab").close()
+    _ROOTS[os.path.abspath(root)] = os.path.abspath(path)
+    return open_container(path)
+
+
+def find(path):
+    """(container, name) for an artifact path below a job root, or None."""
+    path = os.path.abspath(path)
+    folder = os.path.dirname(path)
+    while True:
+        container_path = _ROOTS.get(folder)
+        if container_path is None and os.path.exists(os.path.join(folder, CONTAINER_FILE)):
+            container_path = _ROOTS[folder] = os.path.join(folder, CONTAINER_FILE)
+        if container_path:
+            return open_container(container_path), os.path.relpath(path, folder).replace(os.sep, "/")
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def export(container_path, output_dir=None):
+    """Writes every image artifact of a container as a PNG (at its original path by default). Returns the count."""
+    from PIL import Image
+    container = open_container(container_path)
+    output_dir = output_dir or os.path.dirname(os.path.abspath(container_path))
+    count = 0
+    for name in container.names():
+        meta = container.meta(name)
+        arr = container.read(name)
+        dest = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if arr.dtype != np.uint8:
+            # Flows and other float data have no PNG form
+            np.save(dest + ".npy", arr)
+            continue
+        img = Image.fromarray(np.ascontiguousarray(arr))
+        if "palette" in meta:
+            img.putpalette(meta["palette"])
+        img.save(dest)
+        count += 1
+    return count
+
+
+def compact(container_path):
+    """Rewrites the container with only the latest record of each artifact. Returns (bytes before, after)."""
+    container = open_container(container_path)
+    with _locked(container.path):
+        before = os.path.getsize(container.path)
+        records = [container.record(name) for name in container.names()]
+        tmp = container.path + ".compact"
+        with open(tmp, "wb") as f:
+            for record in records:
+                f.write(record)
+        os.replace(tmp, container.path)
+    _CONTAINERS.pop(os.path.abspath(container_path), None)
+    return before, os.path.getsize(container_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect, export or compact a job artifact container (job.vtc)")
+    parser.add_argument("command", choices=["ls", "export", "compact"])
+    parser.add_argument("container", help="Path to job.vtc (or the job folder holding it)")
+    parser.add_argument("--output_dir", default=None, help="export: destination (default: next to the container)")
+    args = parser.parse_args(argv)
+
+    path = args.container
+    if os.path.isdir(path):
+        path = os.path.join(path, CONTAINER_FILE)
+    if args.command == "ls":
+        container = open_container(path)
+        for name in container.names():
+            meta = container.meta(name)
+            print(f"{name:60s} {meta['kind']:4s} {'x'.join(map(str, meta['shape']))}")
+        count, size, live, decoded = container.stats()
+        print(f"{count} artifacts, {size / 1e6:.2f} MB on disk ({live / 1e6:.2f} MB live, {decoded / 1e6:.2f} MB decoded)")
+    elif args.command == "export":
+        print(f"Exported {export(path, args.output_dir)} PNGs.")
+    else:
+        before, after = compact(path)
+        print(f"Compacted {before / 1e6:.2f} MB -> {after / 1e6:.2f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import numpy as np
+
+# Label semantics shared by every stage that builds masks from SCHP parsing or
+# DensePose part maps. Each label id maps to a set of group bits through a
+# 256-entry lookup table, so one indexed pass (parse_flags / dp_flags) gives
+# every group of an image and each group mask is a bit test on that result:
+#
+#   flags = parse_flags(parse)
+#   garment = in_group(flags, GARMENT)
+#   keep = in_group(flags, PRESERVE | LOWER)   # union of groups
+
+# LIP / SCHP labels
+LIP_LABELS = ["Background", "Hat", "Hair", "Glove", "Sunglasses", "Upper-clothes", "Dress", "Coat",
+              "Socks", "Pants", "Jumpsuit", "Scarf", "Skirt", "Face", "Left-arm", "Right-arm",
+              "Left-leg", "Right-leg", "Left-shoe", "Right-shoe"]
+FACE_LABEL = 13
+
+# SCHP groups
+PRESERVE = 1 << 0  # Hat, Hair, Sunglasses, Face: never touched
+GARMENT = 1 << 1   # Upper-clothes, Dress, Coat, Jumpsuit, Scarf: the old garment
+TORSO_GARMENT = 1 << 2  # Upper-clothes, Dress, Coat: what a flat garment replaces
+ARMS = 1 << 3      # Left-arm, Right-arm
+LOWER = 1 << 4     # Pants, Skirt, legs, shoes: never touched
+FACE = 1 << 5
+
+PARSE_GROUPS = {
+    PRESERVE: [1, 2, 4, 13],
+    GARMENT: [5, 6, 7, 10, 11],
+    TORSO_GARMENT: [5, 6, 7],
+    ARMS: [14, 15],
+    LOWER: [9, 12, 16, 17, 18, 19],
+    FACE: [FACE_LABEL],
+}
+
+# DensePose part index groups (labels 0-24 of the part maps)
+DP_TORSO = 1 << 0       # 1, 2
+DP_HANDS = 1 << 1       # 3, 4
+DP_UPPER_ARMS = 1 << 2  # 15-18
+DP_LOWER_ARMS = 1 << 3  # 19-22
+DP_ARMS = DP_UPPER_ARMS | DP_LOWER_ARMS
+
+DP_GROUPS = {
+    DP_TORSO: [1, 2],
+    DP_HANDS: [3, 4],
+    DP_UPPER_ARMS: [15, 16, 17, 18],
+    DP_LOWER_ARMS: [19, 20, 21, 22],
+}
+
+
+def build_lut(groups):
+    lut = np.zeros(256, np.uint8)
+    for bit, labels in groups.items():
+        lut[labels] |= bit
+    return lut
+
+
+PARSE_LUT = build_lut(PARSE_GROUPS)
+DP_LUT = build_lut(DP_GROUPS)
+
+
+def parse_flags(parse):
+    """Group bits of every pixel of a SCHP label map (one indexed pass)."""
+    return PARSE_LUT[parse]
+
+
+def dp_flags(dp):
+    """Group bits of every pixel of a DensePose part index map (one indexed pass)."""
+    return DP_LUT[dp]
+
+
+def in_group(flags, groups):
+    """Boolean mask of the pixels in any of `groups` (bits OR-ed together)."""
+    return (flags & groups) != 0
+
+
+def labels_of(groups, table=PARSE_GROUPS):
+    """Sorted label ids in any of `groups` (for tools that want plain label lists)."""
+    return sorted({label for bit, labels in table.items() if bit & groups for label in labels})
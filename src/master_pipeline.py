@@ -3,7 +3,13 @@ import argparse
 import subprocess
 import shutil
 import sys
+import threading
 from pathlib import Path
+from stage_cache import open_cache, run_cached, file_identity
+from stage_graph import Stage, run_graph
+from timing_trace import span, child_env, start_trace, finish_trace
+from artifact_store import ARTIFACT_MODE_ENV, MODES as ARTIFACT_MODES, prepare_root
+import rembg_sessions
 
 def run_cmd(python_cmd, script_path, args, cwd=None):
     """
@@ -11,54 +17,314 @@ def run_cmd(python_cmd, script_path, args, cwd=None):
     """
     if isinstance(python_cmd, str):
         python_cmd = [python_cmd]
-        
+
     cmd = python_cmd + [script_path] + args
     # Quote arguments with spaces
     quoted_cmd = ['"' + str(arg) + '"' if ' ' in str(arg) else str(arg) for arg in cmd]
     print(f"\n>>> Running: {' '.join(quoted_cmd)}")
-    
+
     is_windows = os.name == 'nt'
-    result = subprocess.run(cmd, cwd=cwd, shell=is_windows)
-    
+    with span(f"subprocess {os.path.basename(script_path)}", cat="subprocess") as span_id:
+        result = subprocess.run(cmd, cwd=cwd, shell=is_windows, env=child_env(span_id))
+
     if result.returncode != 0:
         print(f"!!! Error return code {result.returncode} from command.")
         return False
     return True
 
-def main():
-    parser = argparse.ArgumentParser(description="Master VITON Inference Pipeline")
-    parser.add_argument("--person", help="Path to person image (auto-detected in inputs/ if omitted)")
-    parser.add_argument("--garment", help="Path to garment image (auto-detected in inputs/ if omitted)")
+# Person crop padding used by the batch and service builds
+ROI_PAD = 0.05
+
+def add_pipeline_args(parser):
+    """Options shared by master_pipeline.py and batch_pipeline.py."""
     parser.add_argument("--type", choices=["flat", "worn"], default="flat", help="Garment type")
     parser.add_argument("--sleeve_type", "--sleeve_length", choices=["none", "half", "full"], default="full", dest="sleeve_type", help="Sleeve type of target garment (also accepts --sleeve_length)")
+    parser.add_argument("--mask_variants", default="", help="Batch/service: comma-separated sleeve types (or 'all') whose target masks are made for every person in the same pass, so switching sleeve type is a lookup")
     parser.add_argument("--initial_sleeve", choices=["none", "half", "full"], default="half", help="Initial sleeve type of the person (what they are wearing in the photo)")
     parser.add_argument("--preserve_arms", action="store_true", help="Preserve original arms in agnostic generation")
     parser.add_argument("--inpaint_skin", action="store_true", default=True, help="Enable GAN-based skin inpainting for occluded arms (e.g. full-to-half sleeve)")
-    
+    parser.add_argument("--inpaint_precision", choices=["fp32", "bf16", "int8"], default="fp32", help="Skin inpainting generator precision (see generator_quant.py)")
+
     # Environment Names (Easier than full paths)
     parser.add_argument("--schp_env", default="schp")
     parser.add_argument("--dp_env", default="densepose")
     parser.add_argument("--fvnt_env", default="fvnt_env")
     parser.add_argument("--stylevton_env", default="stylevton")
-    
+
     # Conda executable path (using forward slashes for Windows compatibility)
     parser.add_argument("--conda_path", default=r"C:/Users/hp/anaconda3/condabin/conda.bat")
 
+    # Persistent model workers (one per conda env, models stay loaded between runs)
+    parser.add_argument("--use_workers", action="store_true", help="Dispatch stages to persistent per-env model workers (started on first use)")
+    parser.add_argument("--worker_base_port", type=int, default=6100, help="Port of the first env worker; further envs use the following ports")
+    parser.add_argument("--stop_workers", action="store_true", help="Shut down the persistent workers and exit")
+
+    # Content-addressed stage cache (skip stages whose inputs, params and code are unchanged)
+    parser.add_argument("--cache_dir", default=None, help="Stage cache directory (caching disabled if omitted)")
+    parser.add_argument("--cache_max_gb", type=float, default=20.0, help="Stage cache size budget (LRU eviction)")
+    parser.add_argument("--jobs", type=int, default=4, help="Max number of preprocessing stages running concurrently")
+
+    # Timing trace (Chrome trace / Perfetto JSON, one file for every process of the run)
+    parser.add_argument("--trace", default=None, help="Write per-stage timing spans to this trace file (open in ui.perfetto.dev)")
+
+    # How intermediate images are passed between stages (see artifact_store.py)
+    parser.add_argument("--artifact_mode", choices=ARTIFACT_MODES, default="png",
+                        help="png: PNG files; npy: memory-mapped .npy only (no PNG encode/decode); both: .npy plus PNGs for inspection")
+
+    # Background removal models (see rembg_sessions.py; default u2net for both)
+    parser.add_argument("--rembg_person_model", default=None, help="rembg model for person photos (e.g. u2net_human_seg)")
+    parser.add_argument("--rembg_garment_model", default=None, help="rembg model for flat garment photos")
+    parser.add_argument("--rembg_threads", type=int, default=None, help="onnxruntime intra-op threads per rembg session")
+
+    # Fast DensePose: detection + part labels at a reduced short side, no UV (see run_densepose.py --agreement)
+    parser.add_argument("--densepose_short_side", type=int, default=None, help="Run DensePose in fast mode at this short side (e.g. 512); full resolution if omitted")
+
+    # Person ROI: person-side stages run on the padded person box, pasted back by restore_background.
+    # Off by default here; batch_pipeline and tryon_service default to ROI_PAD.
+    parser.add_argument("--roi_pad", type=float, default=None,
+                        help=f"Crop the person-side stages to the person box padded by this fraction of the person height (e.g. {ROI_PAD}); full photo if omitted")
+    parser.add_argument("--no_person_roi", action="store_true", help="Run the person-side stages on the full photo (overrides --roi_pad)")
+
+    # Precomputed garments (see garment_catalog.py); garments are then given as ids
+    parser.add_argument("--catalog", default=None, help="Garment catalog folder for garments referenced by id")
+
     # Project and Checkpoints
     parser.add_argument("--project_root", default="d:/Final Project Viton/virtual-tryon")
     parser.add_argument("--fvnt_ckpt", default="d:/Final Project Viton/virtual-tryon/FVNT/model/stage2_model")
+    parser.add_argument("--fvnt_backend", choices=["eager", "torchscript", "onnx"], default="eager", help="FEM inference backend (export with fem_export.py)")
+    parser.add_argument("--fvnt_height", type=int, default=1024, help="Warped garment height (above 1024x768 the warp runs in bands, see fvnt_flow_renderer --tile_rows)")
+    parser.add_argument("--fvnt_width", type=int, default=768, help="Warped garment width")
+    parser.add_argument("--fvnt_engine", default=None, help="Exported FEM graph (default: <fvnt_ckpt>.ts / .onnx)")
     parser.add_argument("--stylevton_ckpt", default="d:/Final Project Viton/virtual-tryon/Flow-Style-VTON/checkpoints/ckp/non_aug/PFAFN_gen_epoch_101.pth")
     parser.add_argument("--output_root", default="d:/Final Project Viton/virtual-tryon/outputs")
 
-    args = parser.parse_args()
-    
-    p_root = args.project_root
-    o_root = args.output_root
-    os.makedirs(o_root, exist_ok=True)
+def roi_pad(args):
+    """Person crop padding for preprocess_pipeline, None for full-canvas runs."""
+    return None if args.no_person_roi else args.roi_pad
+
+class StageRunner:
+    """
+    Runs a stage script in its conda env, either as a one-shot
+    `conda run ... python <script>` subprocess or on a persistent model worker.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        # Modules each env serves; imported once when its worker starts
+        self.env_modules = {}
+        for env_name, modules in [
+            (args.dp_env, ["remove_background", "run_densepose", "preprocess_garment", "generate_target_mask", "generate_agnostic_person"]),
+            (args.schp_env, ["run_schp"]),
+            (args.fvnt_env, ["fvnt_flow_renderer"]),
+            (args.stylevton_env, ["run_stylevton", "restore_background"]),
+        ]:
+            self.env_modules.setdefault(env_name, []).extend(modules)
+        self.worker_ports = {env_name: args.worker_base_port + i for i, env_name in enumerate(self.env_modules)}
+        # Stages run concurrently; only one of them may start a given worker
+        self.worker_locks = {env_name: threading.Lock() for env_name in self.env_modules}
 
     # Conda runner helper
-    def conda_python(env_name):
-        return [args.conda_path, "run", "--no-capture-output", "-n", env_name, "python"]
+    def conda_python(self, env_name):
+        return [self.args.conda_path, "run", "--no-capture-output", "-n", env_name, "python"]
+
+    def __call__(self, env_name, script, stage_args):
+        if not self.args.use_workers:
+            return run_cmd(self.conda_python(env_name), os.path.join(self.args.project_root, "src", script), stage_args)
+
+        from model_worker import ensure_worker, run_on_worker
+        port = self.worker_ports[env_name]
+        with self.worker_locks[env_name]:
+            if not ensure_worker(port, self.conda_python(env_name), self.env_modules[env_name]):
+                return False
+        print(f"\n>>> Dispatching {script} to {env_name} worker (port {port})")
+        return run_on_worker(port, os.path.splitext(script)[0], stage_args)
+
+    def run_batch(self, env_name, script, stage_args_list):
+        """Runs several invocations of one script; one worker round-trip in worker mode. Returns a list of bools."""
+        if not self.args.use_workers:
+            return [self(env_name, script, stage_args) for stage_args in stage_args_list]
+
+        from model_worker import ensure_worker, run_batch_on_worker
+        port = self.worker_ports[env_name]
+        with self.worker_locks[env_name]:
+            if not ensure_worker(port, self.conda_python(env_name), self.env_modules[env_name]):
+                return [False] * len(stage_args_list)
+        print(f"\n>>> Dispatching {len(stage_args_list)}x {script} to {env_name} worker (port {port})")
+        return run_batch_on_worker(port, os.path.splitext(script)[0], stage_args_list)
+
+    def role_runner(self):
+        """Runner for preprocess_pipeline stage roles ("gen", "dp", "schp")."""
+        role_envs = {"gen": self.args.dp_env, "dp": self.args.dp_env, "schp": self.args.schp_env}
+        return lambda role, script, stage_args: self(role_envs[role], script, stage_args)
+
+    def stop_workers(self):
+        from model_worker import shutdown_worker
+        for env_name, port in self.worker_ports.items():
+            status = "stopped" if shutdown_worker(port) else "not running"
+            print(f"Worker {env_name} (port {port}): {status}")
+
+def pair_stages(run_stage, args, person_img, person_root, garment_root, target_mask, pair_root, cache=None, tag="pair",
+                garment_id=None):
+    """
+    Pair-dependent stages (FVNT flow -> agnostic -> compositing -> background restore)
+    for one person/garment pair. person_root and garment_root hold the preprocess
+    outputs (see preprocess_pipeline.person_paths / garment_paths); results go to pair_root.
+    garment_id: take the garment from the catalog (args.catalog) instead of garment_root.
+    Returns (stages, final_output, composite_path).
+    """
+    from preprocess_pipeline import person_paths, garment_paths
+    person = person_paths(person_root)
+    garment = garment_paths(garment_root)
+
+    # Paths to generated files
+    person_no_bg = person["person_no_bg"]
+    person_parse = person["schp_mask"]
+    densepose_img = person["densepose_mask"]
+    garment_rgb = garment["cloth"]
+    garment_mask = garment["cloth_mask"]
+
+    flow_dir = os.path.join(pair_root, "flow_renderer")
+    warped_garment = os.path.join(flow_dir, "warped_garment.png")
+    projected_mask = os.path.join(flow_dir, "projected_mask.png")
+
+    agnostic_dir = os.path.join(pair_root, "agnostic")
+    agnostic_img = os.path.join(agnostic_dir, "img", "person.png")
+    agnostic_mask = os.path.join(agnostic_dir, "mask", "person.png")
+
+    final_output = os.path.join(pair_root, "final", "tryon_result.png")
+    comp_path = os.path.join(pair_root, "final", "tryon_with_background.png")
+
+    # 2. FVNT Flow Renderer
+    flow_param = {}
+    if (args.fvnt_height, args.fvnt_width) != (1024, 768):
+        flow_param["size"] = f"{args.fvnt_width}x{args.fvnt_height}"
+    if args.fvnt_backend != "eager":
+        # Exported graphs are not bit-identical to eager: a new engine invalidates the cached flows
+        engine = args.fvnt_engine or args.fvnt_ckpt + {"torchscript": ".ts", "onnx": ".onnx"}[args.fvnt_backend]
+        flow_param.update(backend=args.fvnt_backend, engine=file_identity(engine))
+
+    def flow():
+        print(f"\n=== PHASE 2: FLOW ESTIMATION (FVNT) [{tag}] ===")
+        flow_args = [
+            "--person", target_mask,
+            "--checkpoint", args.fvnt_ckpt,
+            "--output_dir", flow_dir,
+            "--schp", person_parse
+        ]
+        if (args.fvnt_height, args.fvnt_width) != (1024, 768):
+            flow_args += ["--out_height", str(args.fvnt_height), "--out_width", str(args.fvnt_width)]
+        if args.fvnt_backend != "eager":
+            flow_args += ["--backend", args.fvnt_backend]
+            if args.fvnt_engine:
+                flow_args += ["--engine", args.fvnt_engine]
+        if args.cache_dir:
+            flow_args += ["--flow_cache", args.cache_dir, "--flow_cache_max_gb", str(args.cache_max_gb)]
+        if garment_id:
+            flow_args += ["--catalog", args.catalog, "--garment_id", garment_id]
+        else:
+            flow_args += ["--garment_rgb", garment_rgb, "--garment_mask", garment_mask]
+        return run_stage(args.fvnt_env, "fvnt_flow_renderer.py", flow_args)
+
+    # 3. Agnostic Person Generation (Layering Mode)
+    def agnostic():
+        print(f"\n=== PHASE 3: AGNOSTIC GENERATION (Layering) [{tag}] ===")
+        agnostic_args = [
+            "--image", person_no_bg,
+            "--parse", person_parse,
+            "--output_dir", agnostic_dir,
+            "--warped_mask", projected_mask
+        ]
+        return run_stage(args.dp_env, "generate_agnostic_person.py", agnostic_args)
+
+    # 4. Layered Try-On Composition (surgical compositing, no GAN)
+    def compose():
+        print(f"\n=== PHASE 4: LAYERED TRY-ON COMPOSITION [{tag}] ===")
+        os.makedirs(os.path.dirname(final_output), exist_ok=True)
+        style_args = [
+            "--agnostic", agnostic_img,
+            "--original", person_no_bg,
+            "--agnostic_mask", agnostic_mask,
+            "--warped_cloth", warped_garment,
+            "--warped_mask", projected_mask,
+            "--parse", person_parse,
+            "--densepose", densepose_img,
+            "--output_path", final_output,
+            "--initial_sleeve", args.initial_sleeve
+        ]
+        if args.inpaint_skin:
+            style_args += ["--inpaint_skin", "--checkpoint", args.stylevton_ckpt, "--inpaint_precision", args.inpaint_precision]
+        return run_stage(args.stylevton_env, "run_stylevton.py", style_args)
+
+    # 5. Result Compositing
+    def restore():
+        print(f"\n=== PHASE 5: RESULT COMPOSITING [{tag}] ===")
+        composite_cmd = [
+            "--original", person_img,
+            "--tryon", final_output,
+            "--rembg_mask", person_no_bg, # This is actually the person image with background removed, not just the mask
+            "--output", comp_path,
+            "--roi", person["roi"]
+        ]
+        # We can use stylevton env or densepose env for this, it just needs PIL and numpy
+        return run_stage(args.stylevton_env, "restore_background.py", composite_cmd)
+
+    def restore_or_warn():
+        if not run_cached(cache, "restore_background", restore,
+                          inputs=[person_img, final_output, person_no_bg, person["roi"]],
+                          outputs={"tryon_with_background.png": comp_path},
+                          code=["restore_background.py"]):
+            print("Warning: Background restoration failed, but tryon result is preserved.")
+        return True
+
+    if garment_id:
+        from garment_catalog import garment_identity
+        garment_inputs, garment_param = [], garment_identity(args.catalog, garment_id)
+    else:
+        garment_inputs, garment_param = [garment_rgb, garment_mask], None
+
+    stages = [
+        Stage(f"fvnt_flow[{tag}]",
+              lambda: run_cached(cache, "fvnt_flow", flow,
+                                 inputs=[target_mask] + garment_inputs + [person_parse],
+                                 outputs={"warped_garment.png": warped_garment, "projected_mask.png": projected_mask,
+                                          "hole_mask.png": os.path.join(flow_dir, "hole_mask.png")},
+                                 params={"checkpoint": file_identity(args.fvnt_ckpt), "catalog_garment": garment_param, **flow_param},
+                                 code=["fvnt_flow_renderer.py"],
+                                 # Only written when the warp leaves holes
+                                 optional=["hole_mask.png"]),
+              inputs=[target_mask] + garment_inputs + [person_parse],
+              outputs=[warped_garment, projected_mask]),
+        Stage(f"agnostic[{tag}]",
+              lambda: run_cached(cache, "agnostic", agnostic,
+                                 inputs=[person_no_bg, person_parse, projected_mask],
+                                 outputs={"img.png": agnostic_img, "mask.png": agnostic_mask,
+                                          "parse.png": os.path.join(agnostic_dir, "parse", "person.png")},
+                                 code=["generate_agnostic_person.py"]),
+              inputs=[person_no_bg, person_parse, projected_mask],
+              outputs=[agnostic_img, agnostic_mask]),
+        Stage(f"compositor[{tag}]",
+              lambda: run_cached(cache, "compositor", compose,
+                                 inputs=[person_no_bg, agnostic_mask, warped_garment, projected_mask, person_parse, densepose_img],
+                                 outputs={"tryon_result.png": final_output},
+                                 params={"initial_sleeve": args.initial_sleeve, "inpaint_skin": args.inpaint_skin,
+                                         "checkpoint": file_identity(args.stylevton_ckpt) if args.inpaint_skin else None,
+                                         # A re-prepared bf16 / int8 generator (generator_quant.py) is a new model
+                                         **({"inpaint_precision": args.inpaint_precision,
+                                             "prepared": file_identity(f"{args.stylevton_ckpt}.{args.inpaint_precision}.ts")}
+                                            if args.inpaint_skin and args.inpaint_precision != "fp32" else {})},
+                                 code=["run_stylevton.py"]),
+              inputs=[person_no_bg, agnostic_img, agnostic_mask, warped_garment, projected_mask, person_parse, densepose_img],
+              outputs=[final_output]),
+        Stage(f"restore_background[{tag}]", restore_or_warn,
+              inputs=[person_img, final_output, person_no_bg],
+              outputs=[comp_path]),
+    ]
+    return stages, final_output, comp_path
+
+def run_pipeline(args, run_stage):
+    p_root = args.project_root
+    o_root = args.output_root
+    prepare_root(o_root)
 
     # --- Auto-Detection Trace ---
     def find_input(pattern, label):
@@ -76,110 +342,98 @@ def main():
         return matches[0]
 
     person_img = args.person if args.person else find_input("person.*", "person image")
-    garment_img = args.garment if args.garment else find_input("garment.*", "garment image")
-    
+    if args.garment_id:
+        if not args.catalog:
+            print("!!! Error: --garment_id needs --catalog")
+            sys.exit(1)
+        # Preprocessed once at ingestion: no garment stages in this run
+        garment_img = None
+    else:
+        garment_img = args.garment if args.garment else find_input("garment.*", "garment image")
+
     print(f"--- Using Inputs ---")
     print(f"Person: {person_img}")
-    print(f"Garment: {garment_img}")
+    print(f"Garment: {garment_img or 'catalog ' + args.garment_id}")
     print(f"--------------------")
 
-    # Paths to generated files
-    person_no_bg = os.path.join(o_root, "rembg", "person.png")
-    person_parse = os.path.join(o_root, "schp", "person.png")
-    densepose_img = os.path.join(o_root, "densepose", "person_densepose.png")
-    garment_rgb = os.path.join(o_root, "garment", "cloth.png")
-    garment_mask = os.path.join(o_root, "garment", "cloth_mask.png")
     target_mask = os.path.join(o_root, "target_mask", "target_mask.png")
-    
-    flow_dir = os.path.join(o_root, "flow_renderer")
-    warped_garment = os.path.join(flow_dir, "warped_garment.png")
-    projected_mask = os.path.join(flow_dir, "projected_mask.png")
-    
-    agnostic_dir = os.path.join(o_root, "agnostic")
-    agnostic_img = os.path.join(agnostic_dir, "img", "person.png")
-    agnostic_mask = os.path.join(agnostic_dir, "mask", "person.png")
-    
-    final_output = os.path.join(o_root, "final", "tryon_result.png")
-    os.makedirs(os.path.dirname(final_output), exist_ok=True)
+    cache = open_cache(args.cache_dir, args.cache_max_gb)
 
     # 1. Preprocessing Pipeline
     print("\n=== PHASE 1: PREPROCESSING ===")
     pre_args = [
         "--person", person_img,
-        "--garment", garment_img,
         "--type", args.type,
         "--sleeve_type", args.sleeve_type,
         "--output_root", o_root,
         "--project_root", p_root,
-        "--schp_py", " ".join(conda_python(args.schp_env)),
-        "--dp_py", " ".join(conda_python(args.dp_env)),
-        "--conda_path", args.conda_path
+        "--schp_py", " ".join(run_stage.conda_python(args.schp_env)),
+        "--dp_py", " ".join(run_stage.conda_python(args.dp_env)),
+        "--conda_path", args.conda_path,
+        "--jobs", str(args.jobs)
     ]
+    if garment_img:
+        pre_args += ["--garment", garment_img]
+    if args.cache_dir:
+        pre_args += ["--cache_dir", args.cache_dir, "--cache_max_gb", str(args.cache_max_gb)]
+    if args.densepose_short_side:
+        pre_args += ["--densepose_short_side", str(args.densepose_short_side)]
+    if roi_pad(args) is not None:
+        pre_args += ["--roi_pad", str(roi_pad(args))]
+    if args.use_workers:
+        # Orchestrate the preprocessing steps from here so each one runs on a warm worker
+        import preprocess_pipeline
+        ok = preprocess_pipeline.main(person_img, garment_img, args.type, args.sleeve_type, o_root, p_root,
+                                      runner=run_stage.role_runner(),
+                                      cache_dir=args.cache_dir, cache_max_gb=args.cache_max_gb, jobs=args.jobs,
+                                      densepose_short_side=args.densepose_short_side, roi_pad=roi_pad(args))
+        if not ok:
+            sys.exit(1)
     # Run preprocessing in the densepose environment (has rembg, torch, etc.)
-    if not run_cmd(conda_python(args.dp_env), os.path.join(p_root, "src/preprocess_pipeline.py"), pre_args):
+    elif not run_cmd(run_stage.conda_python(args.dp_env), os.path.join(p_root, "src/preprocess_pipeline.py"), pre_args):
         sys.exit(1)
 
-    # 2. FVNT Flow Renderer
-    print("\n=== PHASE 2: FLOW ESTIMATION (FVNT) ===")
-    flow_args = [
-        "--person", target_mask,
-        "--garment_rgb", garment_rgb,
-        "--garment_mask", garment_mask,
-        "--checkpoint", args.fvnt_ckpt,
-        "--output_dir", flow_dir,
-        "--schp", person_parse
-    ]
-    if not run_cmd(conda_python(args.fvnt_env), os.path.join(p_root, "src/fvnt_flow_renderer.py"), flow_args):
-        sys.exit(1)
-
-    # 3. Agnostic Person Generation (Layering Mode)
-    print("\n=== PHASE 3: AGNOSTIC GENERATION (Layering) ===")
-    agnostic_args = [
-        "--image", person_no_bg,
-        "--parse", person_parse,
-        "--output_dir", agnostic_dir,
-        "--warped_mask", projected_mask
-    ]
-    if not run_cmd(conda_python(args.dp_env), os.path.join(p_root, "src/generate_agnostic_person.py"), agnostic_args):
+    # 2-5. Flow, agnostic, composition and background restore (a single chain)
+    stages, final_output, comp_path = pair_stages(run_stage, args, person_img, o_root, o_root, target_mask, o_root, cache,
+                                                  garment_id=args.garment_id)
+    if not run_graph(stages, max_workers=1):
         sys.exit(1)
 
-    # 4. Layered Try-On Composition (surgical compositing, no GAN)
-    print("\n=== PHASE 4: LAYERED TRY-ON COMPOSITION ===")
-    style_args = [
-        "--agnostic", agnostic_img,
-        "--original", person_no_bg,
-        "--agnostic_mask", agnostic_mask,
-        "--warped_cloth", warped_garment,
-        "--warped_mask", projected_mask,
-        "--parse", person_parse,
-        "--densepose", densepose_img,
-        "--output_path", final_output,
-        "--initial_sleeve", args.initial_sleeve
-    ]
-    if args.inpaint_skin:
-        style_args += ["--inpaint_skin", "--checkpoint", args.stylevton_ckpt]
-
-    if not run_cmd(conda_python(args.stylevton_env), os.path.join(p_root, "src/run_stylevton.py"), style_args):
-        sys.exit(1)
-
-    # 5. Result Compositing
-    print("\n=== PHASE 5: RESULT COMPOSITING ===")
-    comp_path = os.path.join(o_root, "final", "tryon_with_background.png")
-    composite_cmd = [
-        "--original", person_img,
-        "--tryon", final_output,
-        "--rembg_mask", person_no_bg, # This is actually the person image with background removed, not just the mask
-        "--output", comp_path
-    ]
-    # We can use stylevton env or densepose env for this, it just needs PIL and numpy
-    if not run_cmd(conda_python(args.stylevton_env), os.path.join(p_root, "src/restore_background.py"), composite_cmd):
-        print("Warning: Background restoration failed, but tryon result is preserved.")
-
     print("\n" + "="*50)
     print("MASTER PIPELINE COMPLETED SUCCESSFULLY!")
     print(f"Final Tryon: {final_output}")
     print(f"Composite Result: {comp_path}")
     print("="*50)
 
+def main():
+    parser = argparse.ArgumentParser(description="Master VITON Inference Pipeline")
+    parser.add_argument("--person", help="Path to person image (auto-detected in inputs/ if omitted)")
+    parser.add_argument("--garment", help="Path to garment image (auto-detected in inputs/ if omitted)")
+    parser.add_argument("--garment_id", help="Catalog garment id (with --catalog) instead of a garment image")
+    add_pipeline_args(parser)
+
+    args = parser.parse_args()
+    os.makedirs(args.output_root, exist_ok=True)
+
+    # --- Stage dispatch (one-shot subprocess or persistent worker) ---
+    run_stage = StageRunner(args)
+    if args.stop_workers:
+        run_stage.stop_workers()
+        return
+
+    # Inherited by every stage subprocess and forwarded to workers
+    os.environ[ARTIFACT_MODE_ENV] = args.artifact_mode
+    rembg_sessions.configure(args.rembg_person_model, args.rembg_garment_model, args.rembg_threads)
+    if args.trace:
+        start_trace(args.trace)
+    try:
+        with span("master_pipeline", cat="pipeline"):
+            run_pipeline(args, run_stage)
+    finally:
+        # Also keep the trace of failed runs
+        if args.trace:
+            finish_trace(args.trace)
+            print(f"Timing trace: {args.trace}")
+
 if __name__ == "__main__":
     main()
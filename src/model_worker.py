@@ -0,0 +1,271 @@
+import os
+import sys
+import time
+import secrets
+import argparse
+import importlib
+import traceback
+import subprocess
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# Requests are pickled, so a worker socket must only accept its own clients.
+# Each worker draws a random key at startup and writes it to a file only its
+# user can read (<key dir>/worker-<port>.key); clients read it from there.
+# Deployments that manage the secret themselves set VITON_WORKER_AUTHKEY (hex)
+# for both the workers and the pipeline instead.
+AUTHKEY_ENV = "VITON_WORKER_AUTHKEY"
+KEY_DIR_ENV = "VITON_WORKER_KEY_DIR"
+HOST = "127.0.0.1"
+
+
+def key_path(port):
+    key_dir = os.environ.get(KEY_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "viton-workers")
+    return os.path.join(key_dir, f"worker-{port}.key")
+
+
+def create_authkey(port):
+    """The key the worker on `port` listens with (a new random one unless VITON_WORKER_AUTHKEY is set)."""
+    if os.environ.get(AUTHKEY_ENV):
+        return bytes.fromhex(os.environ[AUTHKEY_ENV])
+    key = secrets.token_bytes(32)
+    path = key_path(port)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key.hex())
+    os.replace(tmp, path)
+    return key
+
+
+def read_authkey(port):
+    """The key of the worker on `port`, or None if it has not published one."""
+    if os.environ.get(AUTHKEY_ENV):
+        return bytes.fromhex(os.environ[AUTHKEY_ENV])
+    try:
+        with open(key_path(port)) as f:
+            return bytes.fromhex(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import timing_trace
+from timing_trace import span, trace_context
+from artifact_store import ARTIFACT_MODE_ENV
+from rembg_sessions import MODEL_ENV as REMBG_MODEL_ENV, THREADS_ENV as REMBG_THREADS_ENV
+
+# Settings a worker takes from each request rather than from its own startup environment
+FORWARDED_ENV = [ARTIFACT_MODE_ENV, REMBG_THREADS_ENV] + list(REMBG_MODEL_ENV.values())
+
+
+@contextmanager
+def request_env(env):
+    """
+    The forwarded settings of one request (FORWARDED_ENV names only), on top of the
+    worker's startup environment, which is restored afterwards: a value sent by one
+    job never leaks into a later request that did not send it.
+    """
+    saved = dict(os.environ)
+    os.environ.update({name: value for name, value in (env or {}).items() if name in FORWARDED_ENV})
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def run_module(module_name, argv):
+    """
+    Runs `module.main(argv)` in this process and returns a process-style return code.
+    Modules stay imported between calls, so their model caches stay warm.
+    """
+    try:
+        module = importlib.import_module(module_name)
+        result = module.main(argv)
+    except SystemExit as e:
+        code = e.code
+        if code is None:
+            return 0
+        return code if isinstance(code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    # Stage functions report failure by returning False (e.g. preprocess_pipeline.main)
+    return 1 if result is False else 0
+
+
+def run_module_batch(module_name, argv_list):
+    """Runs several invocations of one stage module; returns one return code per argv."""
+    try:
+        module = importlib.import_module(module_name)
+    except Exception:
+        traceback.print_exc()
+        return [1] * len(argv_list)
+    if not hasattr(module, "main_batch"):
+        return [run_module(module_name, argv) for argv in argv_list]
+    try:
+        results = module.main_batch(argv_list)
+    except Exception:
+        traceback.print_exc()
+        return [1] * len(argv_list)
+    return [1 if r is False else 0 for r in results]
+
+
+def serve(port, preload=()):
+    """
+    Long-lived worker loop. Requests are dicts:
+      {"cmd": "run", "module": "run_densepose", "argv": [...], "trace": {...} or None, "env": {...}}
+      {"cmd": "run_batch", "module": ..., "argv_list": [[...], ...], "trace": ..., "env": ...}
+      {"cmd": "ping"} / {"cmd": "shutdown"}
+    A batch runs through the module's main_batch(argv_list) when it has one (one
+    batched forward pass), otherwise through main() once per argv.
+    Requests are served one at a time; models are not shared across threads.
+    Concurrent clients queue in the listen backlog until the worker is free.
+    """
+    for name in preload:
+        print(f"[WORKER] Preloading {name}...")
+        importlib.import_module(name)
+
+    with Listener((HOST, port), backlog=32, authkey=create_authkey(port)) as listener:
+        print(f"[WORKER] Listening on {HOST}:{port} (pid {os.getpid()})")
+        sys.stdout.flush()
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"[WORKER] Rejected connection: {e}")
+                continue
+
+            with conn:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    continue
+
+                cmd = request.get("cmd", "run")
+                if cmd == "ping":
+                    conn.send({"ok": True, "pid": os.getpid()})
+                elif cmd == "shutdown":
+                    conn.send({"ok": True})
+                    print("[WORKER] Shutting down.")
+                    return
+                else:
+                    start = time.time()
+                    # Spans of this request go to the client's trace file, linked to its span
+                    timing_trace.configure(**(request.get("trace") or {}))
+                    with request_env(request.get("env")):
+                        if cmd == "run_batch":
+                            print(f"\n[WORKER] {request['module']} x{len(request['argv_list'])}")
+                            codes = run_module_batch(request["module"], request["argv_list"])
+                            response = {"ok": all(c == 0 for c in codes), "returncodes": codes}
+                        else:
+                            print(f"\n[WORKER] {request['module']} {' '.join(request['argv'])}")
+                            code = run_module(request["module"], request["argv"])
+                            response = {"ok": code == 0, "returncode": code}
+                    timing_trace.configure(None)
+                    sys.stdout.flush()
+                    response["elapsed"] = time.time() - start
+                    conn.send(response)
+
+
+# ---------------------------------------------------------------------------
+# Client helpers (used by master_pipeline.py)
+# ---------------------------------------------------------------------------
+def _request(port, payload):
+    authkey = read_authkey(port)
+    if authkey is None:
+        raise ConnectionRefusedError(f"No key for a worker on port {port} at {key_path(port)}")
+    with Client((HOST, port), authkey=authkey) as conn:
+        conn.send(payload)
+        return conn.recv()
+
+
+def ping_worker(port):
+    try:
+        return _request(port, {"cmd": "ping"}).get("ok", False)
+    except (ConnectionRefusedError, OSError, EOFError, AuthenticationError):
+        return False
+
+
+def shutdown_worker(port):
+    try:
+        _request(port, {"cmd": "shutdown"})
+        return True
+    except (ConnectionRefusedError, OSError, EOFError, AuthenticationError):
+        return False
+
+
+def run_on_worker(port, module_name, argv):
+    """Dispatches one stage to a running worker. Returns True on success."""
+    argv = [str(a) for a in argv]
+    with span(f"worker {module_name}", cat="worker", port=port) as span_id:
+        env = {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ}
+        response = _request(port, {"cmd": "run", "module": module_name, "argv": argv, "trace": trace_context(span_id), "env": env})
+    if not response["ok"]:
+        print(f"!!! Worker on port {port} failed {module_name} (code {response['returncode']}).")
+        return False
+    print(f">>> {module_name} finished on worker :{port} in {response['elapsed']:.2f}s")
+    return True
+
+
+def run_batch_on_worker(port, module_name, argv_list):
+    """Dispatches several invocations of one stage to a running worker. Returns a list of bools."""
+    argv_list = [[str(a) for a in argv] for argv in argv_list]
+    with span(f"worker {module_name} x{len(argv_list)}", cat="worker", port=port) as span_id:
+        env = {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ}
+        response = _request(port, {"cmd": "run_batch", "module": module_name, "argv_list": argv_list,
+                                   "trace": trace_context(span_id), "env": env})
+    print(f">>> {module_name} x{len(argv_list)} finished on worker :{port} in {response['elapsed']:.2f}s")
+    return [code == 0 for code in response["returncodes"]]
+
+
+def ensure_worker(port, python_cmd, preload=(), timeout=600):
+    """
+    Returns once a worker answers on `port`, starting one with `python_cmd` if needed.
+    The worker is detached and keeps running after this pipeline exits.
+    """
+    if ping_worker(port):
+        return True
+
+    cmd = list(python_cmd) + [os.path.abspath(__file__), "--port", str(port)]
+    if preload:
+        cmd += ["--preload"] + list(preload)
+    print(f">>> Starting worker on port {port}: {' '.join(cmd)}")
+
+    is_windows = os.name == 'nt'
+    kwargs = {}
+    if is_windows:
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(cmd, shell=is_windows, **kwargs)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if ping_worker(port):
+            return True
+        time.sleep(0.5)
+    print(f"!!! Worker on port {port} did not come up within {timeout}s.")
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Persistent model worker for one conda environment")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--preload", nargs="*", default=[], help="Stage modules to import at startup")
+    parser.add_argument("--shutdown", action="store_true", help="Stop the worker listening on --port")
+    args = parser.parse_args(argv)
+
+    if args.shutdown:
+        if not shutdown_worker(args.port):
+            print(f"No worker listening on port {args.port}.")
+        return
+    serve(args.port, args.preload)
+
+if __name__ == "__main__":
+    main()
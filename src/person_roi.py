@@ -0,0 +1,68 @@
+import os
+import json
+import numpy as np
+
+# Person region of interest. remove_background.py computes a padded box around
+# the rembg alpha once; person.png (and so SCHP, DensePose, target mask,
+# agnostic and compositing) is written for that crop only, and
+# restore_background.py pastes the result back into the full photo.
+#
+# The box is grown to the VITON-HD working aspect (3:4) so the flow renderer,
+# which works at 768x1024, sees the same proportions as with a full 3:4 photo.
+ROI_ASPECT = 768 / 1024
+ROI_FILE = "roi.json"
+
+
+def person_box(alpha, pad=0.05, aspect=ROI_ASPECT):
+    """
+    [x1, y1, x2, y2] (exclusive end) around alpha > 0, padded by `pad` times the
+    box height on every side and grown to `aspect` (w/h) where the image allows.
+    Full image if there is no foreground.
+    """
+    H, W = alpha.shape[:2]
+    rows = np.flatnonzero((alpha > 0).any(axis=1))
+    if len(rows) == 0:
+        return [0, 0, W, H]
+    cols = np.flatnonzero((alpha > 0).any(axis=0))
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    margin = pad * (y2 - y1)
+    bw, bh = (x2 - x1) + 2 * margin, (y2 - y1) + 2 * margin
+    if bw < aspect * bh:
+        bw = aspect * bh
+    else:
+        bh = bw / aspect
+    bw, bh = min(bw, W), min(bh, H)
+
+    cx, cy = (x1 + x2) / 2.0, (y1 + y2) / 2.0
+    # Shift (not shrink) the box back inside the image
+    bx1 = int(round(min(max(cx - bw / 2.0, 0), W - bw)))
+    by1 = int(round(min(max(cy - bh / 2.0, 0), H - bh)))
+    bx2 = min(W, bx1 + int(round(bw)))
+    by2 = min(H, by1 + int(round(bh)))
+    # Never cut the person
+    return [int(min(bx1, x1)), int(min(by1, y1)), int(max(bx2, x2)), int(max(by2, y2))]
+
+
+def full_box(shape):
+    return [0, 0, int(shape[1]), int(shape[0])]
+
+
+def crop(arr, box):
+    x1, y1, x2, y2 = box
+    return arr[y1:y2, x1:x2]
+
+
+def write_roi(path, box, shape):
+    """roi.json: the crop box and the size (w, h) of the photo it was taken from."""
+    with open(path, "w") as f:
+        json.dump({"box": [int(v) for v in box], "size": [int(shape[1]), int(shape[0])]}, f)
+
+
+def read_roi(path):
+    """(box, (w, h)) or None if there is no ROI file (full-canvas run)."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        roi = json.load(f)
+    return roi["box"], tuple(roi["size"])
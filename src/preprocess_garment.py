@@ -1,71 +1,108 @@
 import os
+import sys
 import cv2
 import numpy as np
 import argparse
-import torch
 from PIL import Image
+from artifact_store import read_array, write_array, exists
+from rembg_sessions import remove_images
+from timing_trace import span
+from batch_items import parse_each, run_items
+from label_groups import parse_flags, in_group, TORSO_GARMENT
 
-def preprocess_garment(garment_path, garment_type, output_dir, schp_mask_path=None):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
+def load_garment(garment_path):
     # Load garment
-    img = cv2.imread(garment_path)
+    with span("decode", cat="io"):
+        img = cv2.imread(garment_path)
     if img is None:
         print(f"Error: Could not read garment image at {garment_path}")
-        return
+        return None
 
     # Resize to standard size (e.g., 768x1024 for VITON-HD)
-    img = cv2.resize(img, (768, 1024))
+    with span("resize", cat="compute"):
+        return cv2.resize(img, (768, 1024))
+
+def flat_garment_masks(imgs, workers=1):
+    """rembg alpha masks (binary) for resized BGR garment images, one warm session for all."""
+    print("Using rembg for flat garment masking...")
+    # rembg works on PIL images; only the alpha mask is needed, not the cutout
+    pil_imgs = [Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)) for img in imgs]
+    masks = []
+    for rembg_mask in remove_images(pil_imgs, role="garment", only_mask=True, workers=workers):
+        # Ensure mask is binary
+        _, mask = cv2.threshold(np.array(rembg_mask), 10, 255, cv2.THRESH_BINARY)
+        masks.append(mask)
+    return masks
+
+def preprocess_garment(garment_path, garment_type, output_dir, schp_mask_path=None, img=None, mask=None):
+    """img / mask: already loaded garment and flat mask (main_batch), else computed here."""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if img is None:
+        img = load_garment(garment_path)
+        if img is None:
+            return False
     
     # 1. Generate Garment Mask
-    if garment_type == "flat":
-        print("Using rembg for flat garment masking...")
-        from rembg import remove
-        
-        # rembg works on PIL images
-        pil_img = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        rembg_img = remove(pil_img)
-        
-        # Mask is the alpha channel
-        mask = np.array(rembg_img)[:, :, 3]
-        
-        # Ensure mask is binary
-        _, mask = cv2.threshold(mask, 10, 255, cv2.THRESH_BINARY)
+    if mask is not None:
+        pass
+    elif garment_type == "flat":
+        mask = flat_garment_masks([img])[0]
     else:
         # For worn garments, we use the parsing mask from SCHP
-        if schp_mask_path and os.path.exists(schp_mask_path):
-            # MUST use PIL to read SCHP output — it's a palette PNG.
+        if schp_mask_path and exists(schp_mask_path):
+            # MUST use PIL (read_array) to read SCHP output — it's a palette PNG.
             # cv2.imread in grayscale converts palette colors to grayscale
             # values, losing the actual label indices.
-            parse_img = Image.open(schp_mask_path)
-            parse_mask = np.array(parse_img)
+            parse_mask = read_array(schp_mask_path)
             parse_mask = cv2.resize(parse_mask, (768, 1024), interpolation=cv2.INTER_NEAREST)
             # LIP/SCHP labels: 5 = Upper-clothes, 6 = Dress, 7 = Coat
-            mask = np.where(np.isin(parse_mask, [5, 6, 7]), 255, 0).astype(np.uint8)
+            mask = np.where(in_group(parse_flags(parse_mask), TORSO_GARMENT), 255, 0).astype(np.uint8)
         else:
             print("Warning: Worn garment type selected but no SCHP mask provided. Using threshold fallback.")
             gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
             _, mask = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY_INV)
 
     # 2. Save Results
-    cv2.imwrite(os.path.join(output_dir, "cloth.png"), img)
-    cv2.imwrite(os.path.join(output_dir, "cloth_mask.png"), mask)
-    
-    # 3. Generate source_parsing.pt (Tensor expected by some flow renderers)
-    # This is a dummy/simplified version - actual requirements vary by model
-    # We'll save the mask as a long tensor
-    mask_tensor = torch.from_numpy(mask).long()
-    torch.save(mask_tensor, os.path.join(output_dir, "source_parsing.pt"))
+    with span("png_encode", cat="io"):
+        write_array(os.path.join(output_dir, "cloth.png"), cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        write_array(os.path.join(output_dir, "cloth_mask.png"), mask)
     
     print(f"Garment preprocessing complete. Saved to {output_dir}")
+    return True
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--type", choices=["flat", "worn"], required=True)
     parser.add_argument("--input", required=True)
     parser.add_argument("--schp_mask", help="Path to SCHP mask (required for worn type)")
     parser.add_argument("--output_dir", required=True)
-    
-    args = parser.parse_args()
-    preprocess_garment(args.input, args.type, args.output_dir, args.schp_mask)
+    parser.add_argument("--workers", type=int, default=1, help="Flat garments segmented concurrently in a batch")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    with span("preprocess_garment", cat="script"):
+        return preprocess_garment(args.input, args.type, args.output_dir, args.schp_mask)
+
+def main_batch(argv_list):
+    """Several garments; the flat ones are masked together through one warm rembg session."""
+    all_args = parse_each(build_parser(), argv_list)
+
+    def run(indices):
+        batch = [all_args[i] for i in indices]
+        imgs = [load_garment(args.input) for args in batch]
+        flat = [k for k, args in enumerate(batch) if args.type == "flat" and imgs[k] is not None]
+        masks = dict(zip(flat, flat_garment_masks([imgs[k] for k in flat],
+                                                  workers=max(batch[k].workers for k in flat)))) if flat else {}
+        return [imgs[k] is not None and
+                preprocess_garment(args.input, args.type, args.output_dir, args.schp_mask, img=imgs[k], mask=masks.get(k))
+                for k, args in enumerate(batch)]
+
+    with span("preprocess_garment", cat="script", batch=len(all_args)):
+        return run_items(all_args, run)
+
+if __name__ == "__main__":
+    if main() is False:
+        sys.exit(1)
@@ -1,8 +1,12 @@
 import os
 import argparse
 import subprocess
-import shutil
 import sys
+from artifact_store import ARTIFACT_MODE_ENV, MODES, prepare_root
+from stage_cache import open_cache, run_cached, file_identity
+from stage_graph import Stage, run_graph
+from timing_trace import span, child_env
+from rembg_sessions import role_model
 
 def run_cmd(cmd, cwd=None):
     # Use shell=True on Windows to help resolve commands
@@ -10,108 +14,214 @@ def run_cmd(cmd, cwd=None):
     # If cmd is a list, we might need to handle quoting if windows shell is used
     # But usually subprocess handles this.
     print(f"Executing: {' '.join(cmd)}")
-    result = subprocess.run(cmd, cwd=cwd, shell=is_windows)
+    script = next((os.path.basename(c) for c in cmd if c.endswith(".py")), cmd[0])
+    with span(f"subprocess {script}", cat="subprocess") as span_id:
+        result = subprocess.run(cmd, cwd=cwd, shell=is_windows, env=child_env(span_id))
     if result.returncode != 0:
         print(f"Error executing command: {' '.join(cmd)}")
         return False
     return True
 
-def main(person_image, garment_image, garment_type, sleeve_type, output_root, project_root, schp_python="python", dp_python="python", conda_path=None):
+def cached_stage(cache, name, cache_name, run, inputs, outputs, params=None, code=(), optional=()):
+    """Graph stage whose outputs come from the stage cache when its key hits."""
+    return Stage(name,
+                 lambda: run_cached(cache, cache_name, run, inputs, outputs, params, code, optional),
+                 inputs=inputs, outputs=outputs.values())
+
+def make_runner(project_root, schp_python="python", dp_python="python"):
+    """Default runner: one subprocess per step with the python command of its role."""
     # Split the python commands into lists (handles "conda run -n env python")
     import shlex
-    schp_python_cmd = shlex.split(schp_python)
-    dp_python_cmd = shlex.split(dp_python)
-    gen_python_cmd = [sys.executable] # Use current python for base steps
-    
-    # Setup output paths
-    rembg_dir = os.path.join(output_root, "rembg")
-    schp_dir = os.path.join(output_root, "schp")
-    densepose_dir = os.path.join(output_root, "densepose")
-    garment_dir = os.path.join(output_root, "garment")
-    target_mask_dir = os.path.join(output_root, "target_mask")
-    
-    os.makedirs(output_root, exist_ok=True)
-    
-    # 1. Remove background from person image
-    print("\n--- Step 1: Background Removal (rembg) ---")
-    if not run_cmd(gen_python_cmd + [os.path.join(project_root, "src/remove_background.py"), 
-                    "--input", person_image, "--output_dir", rembg_dir]):
-        return False
+    python_cmds = {
+        "schp": shlex.split(schp_python),
+        "dp": shlex.split(dp_python),
+        "gen": [sys.executable], # Use current python for base steps
+    }
 
-    person_no_bg = os.path.join(rembg_dir, "person.png")
-    
-    # 2. Run SCHP for parsing
-    schp_input_dir = os.path.join(output_root, "temp_schp_input")
-    if os.path.exists(schp_input_dir):
-        shutil.rmtree(schp_input_dir)
-    os.makedirs(schp_input_dir, exist_ok=True)
-    shutil.copy(person_no_bg, os.path.join(schp_input_dir, "person.png"))
-    
-    print("\n--- Step 2: Human Parsing (SCHP) ---")
-    if not run_cmd(schp_python_cmd + [os.path.join(project_root, "src/run_schp.py"), 
-                    "--input_dir", schp_input_dir, "--output_dir", schp_dir, "--project_root", project_root]):
-        return False
-    
-    schp_mask = os.path.join(schp_dir, "person.png")
-    
-    # 3. Run DensePose
-    print("\n--- Step 3: DensePose Extraction ---")
-    if not run_cmd(dp_python_cmd + [os.path.join(project_root, "src/run_densepose.py"), 
-                    "--input", person_no_bg, "--output_dir", densepose_dir, "--project_root", project_root]):
-        return False
-    
-    densepose_mask = os.path.join(densepose_dir, "person_densepose.png")
-    
-    # 4. Preprocess Garment
-    print("\n--- Step 4: Garment Preprocessing ---")
-    garment_cmd = gen_python_cmd + [os.path.join(project_root, "src/preprocess_garment.py"),
-                   "--type", garment_type, "--input", garment_image, "--output_dir", garment_dir]
+    def runner(role, script, args):
+        return run_cmd(python_cmds[role] + [os.path.join(project_root, "src", script)] + args)
+    return runner
+
+def schp_checkpoint(project_root):
+    return file_identity(os.path.join(project_root, "Self-Correction-Human-Parsing", "checkpoints", "schp.pth"))
+
+def densepose_checkpoint(project_root):
+    return file_identity(os.path.join(project_root, "detectron2", "checkpoints", "densepose_r50_fpn.pkl"))
+
+def person_paths(person_root):
+    return {
+        "person_no_bg": os.path.join(person_root, "rembg", "person.png"),
+        "background": os.path.join(person_root, "rembg", "background.png"),
+        "roi": os.path.join(person_root, "rembg", "roi.json"),
+        "schp_mask": os.path.join(person_root, "schp", "person.png"),
+        "densepose_mask": os.path.join(person_root, "densepose", "person_densepose.png"),
+    }
+
+def garment_paths(garment_root):
+    return {
+        "cloth": os.path.join(garment_root, "garment", "cloth.png"),
+        "cloth_mask": os.path.join(garment_root, "garment", "cloth_mask.png"),
+        "schp_mask": os.path.join(garment_root, "schp_garment", "garment.png"),
+    }
+
+def person_stages(person_image, person_root, project_root, runner, cache=None, tag="person", densepose_short_side=None, roi_pad=None):
+    """
+    rembg -> (SCHP, DensePose) for one person. Outputs go under person_root.
+    densepose_short_side: run DensePose in its fast labels-only mode at this short side.
+    roi_pad: person.png (and everything computed from it) covers only the padded
+    person box; roi.json records it for restore_background. Full canvas if None.
+    """
+    paths = person_paths(person_root)
+    rembg_dir = os.path.dirname(paths["person_no_bg"])
+    schp_dir = os.path.dirname(paths["schp_mask"])
+    densepose_dir = os.path.dirname(paths["densepose_mask"])
+
+    def remove_bg():
+        print(f"\n--- Background Removal (rembg) [{tag}] ---")
+        rembg_args = ["--input", person_image, "--output_dir", rembg_dir]
+        if roi_pad is not None:
+            rembg_args += ["--roi_pad", str(roi_pad)]
+        return runner("gen", "remove_background.py", rembg_args)
+
+    def parse_person():
+        print(f"\n--- Human Parsing (SCHP) [{tag}] ---")
+        # The SCHP engine reads the rembg artifact directly (PNG or sidecar)
+        return runner("schp", "run_schp.py", ["--input", paths["person_no_bg"], "--output_dir", schp_dir,
+                                              "--output_name", os.path.basename(paths["schp_mask"]), "--project_root", project_root])
+
+    def densepose():
+        print(f"\n--- DensePose Extraction [{tag}] ---")
+        dp_args = ["--input", paths["person_no_bg"], "--output_dir", densepose_dir, "--project_root", project_root]
+        if densepose_short_side:
+            dp_args += ["--short_side", str(densepose_short_side)]
+        return runner("dp", "run_densepose.py", dp_args)
+
+    return [
+        cached_stage(cache, f"rembg[{tag}]", "rembg", remove_bg,
+                     inputs=[person_image],
+                     outputs={"person.png": paths["person_no_bg"], "background.png": paths["background"], "roi.json": paths["roi"]},
+                     params={"model": role_model("person"), "roi_pad": roi_pad},
+                     code=["remove_background.py"]),
+        cached_stage(cache, f"schp[{tag}]", "schp", parse_person,
+                     inputs=[paths["person_no_bg"]],
+                     outputs={"parse.png": paths["schp_mask"]},
+                     params={"checkpoint": schp_checkpoint(project_root)}, code=["run_schp.py"]),
+        cached_stage(cache, f"densepose[{tag}]", "densepose", densepose,
+                     inputs=[paths["person_no_bg"]],
+                     outputs={"person_densepose.png": paths["densepose_mask"]},
+                     params={"checkpoint": densepose_checkpoint(project_root), "short_side": densepose_short_side},
+                     code=["run_densepose.py"]),
+    ]
+
+def garment_stages(garment_image, garment_type, garment_root, project_root, runner, cache=None, tag="garment"):
+    """(worn-garment SCHP ->) garment preprocessing. Independent of the person."""
+    paths = garment_paths(garment_root)
+    garment_dir = os.path.dirname(paths["cloth"])
+    schp_garment_dir = os.path.dirname(paths["schp_mask"])
+
+    stages = []
+    garment_args = ["--type", garment_type, "--input", garment_image, "--output_dir", garment_dir]
+    garment_inputs = [garment_image]
     if garment_type == "worn":
         # Run SCHP on the garment image (the person wearing the target garment)
         # to get their parsing mask, so we can extract just the garment region
-        schp_garment_input_dir = os.path.join(output_root, "temp_schp_garment_input")
-        schp_garment_dir = os.path.join(output_root, "schp_garment")
-        if os.path.exists(schp_garment_input_dir):
-            shutil.rmtree(schp_garment_input_dir)
-        os.makedirs(schp_garment_input_dir, exist_ok=True)
-        shutil.copy(garment_image, os.path.join(schp_garment_input_dir, "garment.png"))
-        
-        print("\n--- Step 4a: Parsing Garment Wearer (SCHP) ---")
-        if not run_cmd(schp_python_cmd + [os.path.join(project_root, "src/run_schp.py"),
-                        "--input_dir", schp_garment_input_dir, "--output_dir", schp_garment_dir, "--project_root", project_root]):
-            return False
-        
-        garment_schp_mask = os.path.join(schp_garment_dir, "garment.png")
-        garment_cmd += ["--schp_mask", garment_schp_mask]
-        
-        # Clean up temp dir
-        if os.path.exists(schp_garment_input_dir):
-            shutil.rmtree(schp_garment_input_dir)
-        
-    if not run_cmd(garment_cmd):
-        return False
-        
-    # 5. Generate Target Mask
-    print("\n--- Step 5: Target Mask Generation ---")
-    if not run_cmd(gen_python_cmd + [os.path.join(project_root, "src/generate_target_mask.py"),
-                    "--schp", schp_mask, "--densepose", densepose_mask, 
-                    "--person_mask", person_no_bg,
-                    "--output_dir", target_mask_dir, "--sleeve_type", sleeve_type]):
-        return False
+        def parse_garment():
+            print(f"\n--- Parsing Garment Wearer (SCHP) [{tag}] ---")
+            return runner("schp", "run_schp.py", ["--input", garment_image, "--output_dir", schp_garment_dir,
+                                                  "--output_name", os.path.basename(paths["schp_mask"]), "--project_root", project_root])
+
+        stages.append(cached_stage(cache, f"schp_garment[{tag}]", "schp", parse_garment,
+                                   inputs=[garment_image],
+                                   outputs={"parse.png": paths["schp_mask"]},
+                                   params={"checkpoint": schp_checkpoint(project_root)}, code=["run_schp.py"]))
+        garment_args += ["--schp_mask", paths["schp_mask"]]
+        garment_inputs.append(paths["schp_mask"])
+
+    def garment():
+        print(f"\n--- Garment Preprocessing [{tag}] ---")
+        return runner("gen", "preprocess_garment.py", garment_args)
+
+    stages.append(cached_stage(cache, f"garment[{tag}]", "garment", garment,
+                               inputs=garment_inputs,
+                               outputs={"cloth.png": paths["cloth"], "cloth_mask.png": paths["cloth_mask"]},
+                               params={"type": garment_type, "rembg_model": role_model("garment") if garment_type == "flat" else None},
+                               code=["preprocess_garment.py"]))
+    return stages
+
+def target_mask_stage(person_root, target_mask_dir, sleeve_type, runner, cache=None, tag="person"):
+    """Target mask from the person's SCHP + DensePose (depends on person_stages)."""
+    paths = person_paths(person_root)
+
+    def target_mask():
+        print(f"\n--- Target Mask Generation [{tag}] ---")
+        return runner("gen", "generate_target_mask.py", ["--schp", paths["schp_mask"], "--densepose", paths["densepose_mask"],
+                      "--person_mask", paths["person_no_bg"],
+                      "--output_dir", target_mask_dir, "--sleeve_type", sleeve_type])
+
+    return cached_stage(cache, f"target_mask[{tag}]", "target_mask", target_mask,
+                        inputs=[paths["schp_mask"], paths["densepose_mask"], paths["person_no_bg"]],
+                        outputs={"target_mask.png": os.path.join(target_mask_dir, "target_mask.png")},
+                        params={"sleeve_type": sleeve_type}, code=["generate_target_mask.py"])
 
-    # Clean up temp dir
-    if os.path.exists(schp_input_dir):
-        shutil.rmtree(schp_input_dir)
+def target_masks_stage(person_root, target_mask_dir, sleeve_types, runner, cache=None, tag="person"):
+    """
+    Several sleeve type variants of the target mask in one pass (shared decode and morphology):
+    target_mask_dir/target_mask_<sleeve_type>.png each, plus the stacked target_masks.png.
+    """
+    paths = person_paths(person_root)
+    sleeve_types = list(sleeve_types)
+
+    def target_masks():
+        print(f"\n--- Target Mask Generation [{tag}: {', '.join(sleeve_types)}] ---")
+        return runner("gen", "generate_target_mask.py", ["--schp", paths["schp_mask"], "--densepose", paths["densepose_mask"],
+                      "--person_mask", paths["person_no_bg"],
+                      "--output_dir", target_mask_dir, "--sleeve_types", ",".join(sleeve_types)])
+
+    outputs = {f"target_mask_{sleeve_type}.png": os.path.join(target_mask_dir, f"target_mask_{sleeve_type}.png")
+               for sleeve_type in sleeve_types}
+    outputs["target_masks.png"] = os.path.join(target_mask_dir, "target_masks.png")
+    return cached_stage(cache, f"target_masks[{tag}]", "target_masks", target_masks,
+                        inputs=[paths["schp_mask"], paths["densepose_mask"], paths["person_no_bg"]],
+                        outputs=outputs, params={"sleeve_types": sleeve_types}, code=["generate_target_mask.py"])
+
+def main(person_image, garment_image, garment_type, sleeve_type, output_root, project_root, schp_python="python", dp_python="python", conda_path=None, runner=None,
+         cache_dir=None, cache_max_gb=20.0, jobs=4, densepose_short_side=None, roi_pad=None):
+    """
+    garment_image: None skips the garment stages (catalog garments are preprocessed already).
+    runner: optional callable (role, script, args) -> bool used to execute each step.
+    role is "gen" (base steps), "schp" or "dp". Defaults to spawning a subprocess
+    with the matching python command; master_pipeline.py passes a worker dispatcher.
+    cache_dir: enables the content-addressed stage cache (see stage_cache.py).
+    jobs: how many independent stages may run at the same time.
+    densepose_short_side: fast DensePose mode (see run_densepose.py); full resolution if None.
+    roi_pad: run the person-side stages on the padded person crop (see person_roi.py).
+    """
+    if runner is None:
+        runner = make_runner(project_root, schp_python, dp_python)
+    os.makedirs(output_root, exist_ok=True)
+    prepare_root(output_root)
+    cache = open_cache(cache_dir, cache_max_gb)
+
+    # Dependency graph:  rembg -> SCHP, DensePose -> target mask
+    #                    (worn: SCHP garment ->) garment preprocessing
+    stages = person_stages(person_image, output_root, project_root, runner, cache,
+                           densepose_short_side=densepose_short_side, roi_pad=roi_pad)
+    if garment_image:
+        stages += garment_stages(garment_image, garment_type, output_root, project_root, runner, cache)
+    stages.append(target_mask_stage(output_root, os.path.join(output_root, "target_mask"), sleeve_type, runner, cache))
+
+    if not run_graph(stages, max_workers=jobs):
+        return False
 
     print("\n" + "="*40)
     print("Preprocessing Pipeline Finished Successfully!")
     print("="*40)
     return True
 
-if __name__ == "__main__":
+def cli(argv=None):
     parser = argparse.ArgumentParser(description="One-click Preprocessing Pipeline for Viton")
     parser.add_argument("--person", required=True)
-    parser.add_argument("--garment", required=True)
+    parser.add_argument("--garment", default=None, help="Garment image (omit for catalog garments: person stages only)")
     parser.add_argument("--type", choices=["flat", "worn"], default="flat")
     parser.add_argument("--sleeve_type", choices=["none", "half", "full"], default="full")
     parser.add_argument("--output_root", required=True)
@@ -119,7 +229,22 @@ if __name__ == "__main__":
     parser.add_argument("--schp_py", default="python")
     parser.add_argument("--dp_py", default="python")
     parser.add_argument("--conda_path", default=None)
+    parser.add_argument("--cache_dir", default=None, help="Stage cache directory (caching disabled if omitted)")
+    parser.add_argument("--cache_max_gb", type=float, default=20.0, help="Stage cache size budget (LRU eviction)")
+    parser.add_argument("--jobs", type=int, default=4, help="Max number of preprocessing stages running concurrently")
+    parser.add_argument("--artifact_mode", choices=MODES, default=None, help="Intermediate format (see artifact_store.py); inherited from the environment if omitted")
+    parser.add_argument("--densepose_short_side", type=int, default=None, help="Fast labels-only DensePose at this short side (e.g. 512)")
+    parser.add_argument("--roi_pad", type=float, default=None, help="Crop the person stages to the person box padded by this fraction (full canvas if omitted)")
     
-    args = parser.parse_args()
-    if not main(args.person, args.garment, args.type, args.sleeve_type, args.output_root, args.project_root, args.schp_py, args.dp_py, args.conda_path):
+    args = parser.parse_args(argv)
+    if args.artifact_mode:
+        os.environ[ARTIFACT_MODE_ENV] = args.artifact_mode
+    with span("preprocess_pipeline", cat="pipeline"):
+        ok = main(args.person, args.garment, args.type, args.sleeve_type, args.output_root, args.project_root, args.schp_py, args.dp_py, args.conda_path,
+                  cache_dir=args.cache_dir, cache_max_gb=args.cache_max_gb, jobs=args.jobs, densepose_short_side=args.densepose_short_side,
+                  roi_pad=args.roi_pad)
+    if not ok:
         sys.exit(1)
+
+if __name__ == "__main__":
+    cli()
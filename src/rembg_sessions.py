@@ -0,0 +1,91 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timing_trace import span
+
+# Shared rembg (ONNX) sessions. Building a session loads the model and sets up
+# the ONNX runtime, so it is done once per (model, threads) and reused by every
+# call in the process (persistent workers keep them warm between requests).
+#
+# The model is chosen per role; override with the environment variables below
+# (the pipelines set them from --rembg_person_model / --rembg_garment_model):
+#   person:  person photos (remove_background.py)
+#   garment: flat garment photos (preprocess_garment.py)
+# Any rembg model name works, e.g. u2net, u2netp, u2net_human_seg, isnet-general-use, silueta.
+ROLE_MODELS = {"person": "u2net", "garment": "u2net"}
+MODEL_ENV = {"person": "VITON_REMBG_PERSON_MODEL", "garment": "VITON_REMBG_GARMENT_MODEL"}
+# Intra-op threads per session (0 = let onnxruntime decide)
+THREADS_ENV = "VITON_REMBG_THREADS"
+
+_SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+def role_model(role):
+    return os.environ.get(MODEL_ENV[role]) or ROLE_MODELS[role]
+
+
+def configure(person_model=None, garment_model=None, threads=None):
+    """Sets the rembg options for this process, its stage subprocesses and (forwarded) workers."""
+    for role, model in (("person", person_model), ("garment", garment_model)):
+        if model:
+            os.environ[MODEL_ENV[role]] = model
+    if threads is not None:
+        os.environ[THREADS_ENV] = str(threads)
+
+
+def session_threads():
+    try:
+        return max(0, int(os.environ.get(THREADS_ENV, "0")))
+    except ValueError:
+        return 0
+
+
+def get_session(role="person"):
+    """Warm rembg session for `role`, created on first use."""
+    model, threads = role_model(role), session_threads()
+    key = (model, threads)
+    with _LOCK:
+        if key not in _SESSIONS:
+            from rembg import new_session
+            with span("model_load rembg", cat="model_load", model=model, threads=threads):
+                # rembg sizes the onnxruntime thread pools from OMP_NUM_THREADS when it builds a session
+                saved = os.environ.get("OMP_NUM_THREADS")
+                if threads:
+                    os.environ["OMP_NUM_THREADS"] = str(threads)
+                try:
+                    _SESSIONS[key] = new_session(model)
+                finally:
+                    if saved is None:
+                        os.environ.pop("OMP_NUM_THREADS", None)
+                    else:
+                        os.environ["OMP_NUM_THREADS"] = saved
+            print(f"[INFO] rembg session ready: {model} ({threads or 'default'} threads)")
+        return _SESSIONS[key]
+
+
+def remove_images(images, role="person", only_mask=False, workers=1):
+    """
+    Background removal for a list of PIL images with the warm session of `role`.
+    Returns RGBA cutouts, or L alpha masks with only_mask (skips building the cutout).
+    workers > 1 runs that many images concurrently on the shared session
+    (onnxruntime releases the GIL); combine with THREADS_ENV so that
+    workers * threads stays within the available cores.
+    """
+    from rembg import remove
+    session = get_session(role)
+
+    def one(img):
+        with span("inference rembg", cat="inference", role=role):
+            return remove(img, session=session, only_mask=only_mask)
+
+    if workers <= 1 or len(images) <= 1:
+        return [one(img) for img in images]
+    with ThreadPoolExecutor(max_workers=min(workers, len(images))) as pool:
+        return list(pool.map(one, images))
+
+
+def clear():
+    """Drops all sessions (frees the models)."""
+    with _LOCK:
+        _SESSIONS.clear()
@@ -1,39 +1,77 @@
 import os
-import cv2
+import argparse
 import numpy as np
 from PIL import Image
-from rembg import remove
+from artifact_store import write_array
+from rembg_sessions import remove_images
+from person_roi import person_box, full_box, crop, write_roi, ROI_FILE
+from timing_trace import span
+from batch_items import parse_each, run_items
 
-def remove_background(input_path, output_dir):
+def load_image(input_path):
+    with span("decode", cat="io"):
+        input_image = Image.open(input_path)
+        input_image.load()
+    return input_image
+
+def save_outputs(input_image, output_image, output_dir, roi_pad=None):
+    """roi_pad: crop person.png to the padded person box (see person_roi.py); full canvas if None."""
     os.makedirs(output_dir, exist_ok=True)
-    
-    # Load image
-    input_image = Image.open(input_path)
-    
-    # Remove background
-    output_image = remove(input_image)
-    
-    # person.png (RGBA) - contain transparent person
-    output_image.save(os.path.join(output_dir, "person.png"))
-    
-    # Generate background.png
+
     rgba_np = np.array(output_image)
     alpha = rgba_np[:, :, 3]
+    box = person_box(alpha, roi_pad) if roi_pad is not None else full_box(alpha.shape)
+    write_roi(os.path.join(output_dir, ROI_FILE), box, alpha.shape)
+
+    # person.png (RGBA) - contain transparent person (ROI crop)
+    with span("png_encode", cat="io"):
+        write_array(os.path.join(output_dir, "person.png"), crop(rgba_np, box))
+    
+    # Generate background.png (full canvas)
     mask = alpha > 0
     
     original_np = np.array(input_image.convert("RGB"))
     background_np = original_np.copy()
     background_np[mask] = [0, 0, 0] # Black out the person
     
-    background_image = Image.fromarray(background_np)
-    background_image.save(os.path.join(output_dir, "background.png"))
+    with span("png_encode", cat="io"):
+        write_array(os.path.join(output_dir, "background.png"), background_np)
     
     print(f"Background removal complete. Saved to {output_dir}")
 
-if __name__ == "__main__":
-    import argparse
+def remove_background(input_path, output_dir, roi_pad=None):
+    input_image = load_image(input_path)
+    # Remove background (warm shared session, see rembg_sessions.py)
+    output_image = remove_images([input_image], role="person")[0]
+    save_outputs(input_image, output_image, output_dir, roi_pad)
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True)
     parser.add_argument("--output_dir", required=True)
-    args = parser.parse_args()
-    remove_background(args.input, args.output_dir)
+    parser.add_argument("--workers", type=int, default=1, help="Images segmented concurrently in a batch")
+    parser.add_argument("--roi_pad", type=float, default=None,
+                        help="Crop person.png to the person box padded by this fraction of its height (writes roi.json)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    with span("remove_background", cat="script"):
+        remove_background(args.input, args.output_dir, args.roi_pad)
+
+def main_batch(argv_list):
+    """Several persons through one warm session (used by model_worker run_batch)."""
+    all_args = parse_each(build_parser(), argv_list)
+
+    def run(indices):
+        batch = [all_args[i] for i in indices]
+        images = [load_image(args.input) for args in batch]
+        outputs = remove_images(images, role="person", workers=max(args.workers for args in batch))
+        for args, input_image, output_image in zip(batch, images, outputs):
+            save_outputs(input_image, output_image, args.output_dir, args.roi_pad)
+
+    with span("remove_background", cat="script", batch=len(all_args)):
+        return run_items(all_args, run)
+
+if __name__ == "__main__":
+    main()
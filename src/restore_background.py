@@ -2,45 +2,69 @@ import os
 import cv2
 import numpy as np
 from PIL import Image
+from artifact_store import read_image
+from person_roi import read_roi
+from timing_trace import span
 
-def restore_background(original_jpg, tryon_result_png, rembg_person_png, output_path):
+def restore_background(original_jpg, tryon_result_png, rembg_person_png, output_path, roi_path=None):
     """
     Composites the try-on result back into the original background.
+    roi_path: roi.json from remove_background; the person-side stages then worked
+    on that crop, and the result is pasted back into the box of the full photo.
     """
     # 1. Load images
-    original = Image.open(original_jpg).convert("RGB")
-    tryon = Image.open(tryon_result_png).convert("RGB")
-    rembg_person = Image.open(rembg_person_png).convert("RGBA")
+    with span("decode", cat="io"):
+        original = Image.open(original_jpg).convert("RGB")
+        tryon = Image.open(tryon_result_png).convert("RGB")
+        rembg_person = read_image(rembg_person_png, "RGBA")
     
     W_orig, H_orig = original.size
+    roi = read_roi(roi_path)
+    if roi is not None:
+        (x1, y1, x2, y2), roi_size = roi
+        if roi_size != (W_orig, H_orig):
+            raise ValueError(f"roi.json is for a {roi_size} photo, original is {(W_orig, H_orig)}")
+    else:
+        x1, y1, x2, y2 = 0, 0, W_orig, H_orig
     
     # 2. Extract alpha mask from rembg output
-    # This mask tells us exactly where the person is in the original image
+    # This mask tells us exactly where the person is in the ROI of the original image
     alpha = np.array(rembg_person)[:, :, 3]
+    if alpha.shape != (y2 - y1, x2 - x1):
+        alpha = cv2.resize(alpha, (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST)
     mask = (alpha > 0).astype(np.float32)
     
-    # 3. Resize tryon result to original size
-    tryon_resized = tryon.resize((W_orig, H_orig), Image.LANCZOS)
+    # 3. Resize tryon result to the ROI size
+    with span("resize", cat="compute"):
+        tryon_resized = tryon if tryon.size == (x2 - x1, y2 - y1) else tryon.resize((x2 - x1, y2 - y1), Image.LANCZOS)
     tryon_np = np.array(tryon_resized).astype(np.float32)
-    original_np = np.array(original).astype(np.float32)
+    composite_np = np.array(original)
+    original_np = composite_np[y1:y2, x1:x2].astype(np.float32)
     
-    # 4. Composite
+    # 4. Composite (only inside the ROI; everything outside is the original)
     # result = tryon * Mask + original * (1 - Mask)
-    mask_3d = mask[:, :, None]
-    composite_np = tryon_np * mask_3d + original_np * (1.0 - mask_3d)
+    with span("composite", cat="compute"):
+        mask_3d = mask[:, :, None]
+        composite_np[y1:y2, x1:x2] = np.clip(tryon_np * mask_3d + original_np * (1.0 - mask_3d), 0, 255).astype(np.uint8)
     
     # 5. Save
-    composite_img = Image.fromarray(np.clip(composite_np, 0, 255).astype(np.uint8))
-    composite_img.save(output_path)
+    composite_img = Image.fromarray(composite_np)
+    with span("png_encode", cat="io"):
+        composite_img.save(output_path)
     print(f"Final composition saved to: {output_path}")
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--original", required=True, help="Original person.jpg")
     parser.add_argument("--tryon", required=True, help="tryon_result.png from StyleVTON")
     parser.add_argument("--rembg_mask", required=True, help="person.png from rembg")
     parser.add_argument("--output", required=True)
-    args = parser.parse_args()
+    parser.add_argument("--roi", default=None, help="roi.json from remove_background (person crop box)")
+    args = parser.parse_args(argv)
     
-    restore_background(args.original, args.tryon, args.rembg_mask, args.output)
+    with span("restore_background", cat="script"):
+        restore_background(args.original, args.tryon, args.rembg_mask, args.output, args.roi)
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,277 @@
 import os
-import cv2
+import json
 import torch
 import numpy as np
 import argparse
 from detectron2.config import get_cfg
-from detectron2.engine.defaults import DefaultPredictor
 from densepose import add_densepose_config
-from densepose.vis.densepose_results import (
-    DensePoseResultsFineSegmentationVisualizer,
-)
 from densepose.vis.extractor import DensePoseResultExtractor
+import artifact_store
+from timing_trace import span
+from batch_items import parse_each, run_items
+from label_groups import dp_flags, in_group, DP_TORSO, DP_HANDS, DP_UPPER_ARMS, DP_LOWER_ARMS
 
-def run_densepose(input_path, output_dir, project_root):
-    # Setup paths
-    config_file = os.path.join(project_root, "detectron2", "projects", "DensePose", "configs", "densepose_rcnn_R_50_FPN_s1x.yaml")
-    model_weights = os.path.join(project_root, "detectron2", "checkpoints", "densepose_r50_fpn.pkl")
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    filename = os.path.basename(input_path)
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+# Part index groups read downstream (generate_target_mask / run_stylevton),
+# used to score fast mode against full mode
+AGREEMENT_GROUPS = {"torso": DP_TORSO, "hands": DP_HANDS, "upper_arms": DP_UPPER_ARMS, "lower_arms": DP_LOWER_ARMS}
+
+
+class DensePoseEngine:
+    """
+    DensePose R-CNN built once and run on lists of images.
+    Does what DefaultPredictor does for one image (resize to the test size,
+    BGR/RGB handling), but feeds several images to the model per forward pass.
+
+    short_side: fast mode. Detection and segmentation run with the image's
+    short side scaled to this many pixels (instead of the config's 800), and
+    only the part labels are computed: argmax of the head's fine/coarse
+    segmentation at its own resolution, no UV and no per-box resampling of the
+    score maps. The label maps are pasted back into the full-size image
+    (nearest neighbour) like in full mode.
+    """
+
+    def __init__(self, project_root, device=None, short_side=None):
+        from detectron2.modeling import build_model
+        from detectron2.checkpoint import DetectionCheckpointer
+        import detectron2.data.transforms as T
+
+        config_file = os.path.join(project_root, "detectron2", "projects", "DensePose", "configs", "densepose_rcnn_R_50_FPN_s1x.yaml")
+        model_weights = os.path.join(project_root, "detectron2", "checkpoints", "densepose_r50_fpn.pkl")
+
+        # Setup configuration
+        cfg = get_cfg()
+        add_densepose_config(cfg)
+        cfg.merge_from_file(config_file)
+        cfg.MODEL.WEIGHTS = model_weights
+        cfg.MODEL.DEVICE = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        cfg.freeze()
+        self.cfg = cfg
+
+        print("Initializing DensePose model...")
+        with span("model_load densepose", cat="model_load"):
+            self.model = build_model(cfg)
+            self.model.eval()
+            DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+        min_size, max_size = cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST
+        self.short_side = short_side
+        if short_side:
+            # Keep the config's aspect ratio limit
+            min_size, max_size = short_side, int(round(max_size * short_side / min_size))
+        self.aug = T.ResizeShortestEdge([min_size, min_size], max_size)
+        self.input_format = cfg.INPUT.FORMAT
+        self.extractor = DensePoseResultExtractor()
+
+    def _model_input(self, img_bgr):
+        img = img_bgr[:, :, ::-1] if self.input_format == "RGB" else img_bgr
+        height, width = img.shape[:2]
+        resized = self.aug.get_transform(img).apply_image(img)
+        return {"image": torch.as_tensor(resized.astype("float32").transpose(2, 0, 1)), "height": height, "width": width}
+
+    def predict(self, images_bgr, batch_size=4):
+        """Instances (in original image coordinates) for each BGR image."""
+        outputs = []
+        for start in range(0, len(images_bgr), batch_size):
+            chunk = images_bgr[start:start + batch_size]
+            with span("inference densepose", cat="inference", batch=len(chunk)), torch.no_grad():
+                results = self.model([self._model_input(img) for img in chunk])
+            outputs += [r["instances"] for r in results]
+        return outputs
+
+    def part_maps(self, images_bgr, batch_size=4):
+        """Raw part index maps (uint8, 0-24, image size) for each BGR image."""
+        maps = []
+        for img, instances in zip(images_bgr, self.predict(images_bgr, batch_size)):
+            with span("extract_results", cat="compute"):
+                labels = head_labels(instances) if self.short_side else chart_labels(self.extractor(instances))
+                maps.append(paste_part_labels(labels, instances.pred_boxes.tensor.cpu().numpy(), img.shape[:2]))
+        return maps
+
+
+def chart_labels(extracted):
+    """Per-instance label maps (box resolution) from DensePoseResultExtractor output."""
+    if extracted is None:
+        return []
+    # The extractor returns (chart results, boxes_xywh); one result per instance
+    chart_results = extracted[0] if isinstance(extracted, tuple) else extracted
+    labels = []
+    for dp_res in chart_results:
+        if isinstance(dp_res, list):
+            dp_res = dp_res[0] if dp_res else None
+        labels.append(dp_res.labels.cpu().numpy() if dp_res is not None and hasattr(dp_res, 'labels') else None)
+    return labels
+
+
+def head_labels(instances):
+    """Per-instance label maps at the head's output resolution (fast mode, no UV)."""
+    if len(instances) == 0 or not instances.has("pred_densepose"):
+        return []
+    dp = instances.pred_densepose
+    # Fine part where the coarse head says "body", background elsewhere
+    body = dp.coarse_segm.argmax(dim=1) > 0
+    labels = dp.fine_segm.argmax(dim=1) * body
+    return list(labels.to(torch.uint8).cpu().numpy())
+
+
+def paste_part_labels(label_maps, boxes, shape):
+    """
+    Part index map of the image from per-box label maps ([0-24], any resolution).
+    Each box's labels are sampled nearest-neighbour straight into the visible
+    part of the box (index arithmetic, no full-box resize); overlaps keep the max.
+    """
+    part_map = np.zeros(shape, dtype=np.uint8)
+    im_h, im_w = shape
+    for labels, box in zip(label_maps, boxes):
+        if labels is None:
+            continue
+        labels = labels.astype(np.uint8)
+        # box is [x1, y1, x2, y2]
+        x1, y1, x2, y2 = map(int, box)
+        w = max(1, x2 - x1)
+        h = max(1, y2 - y1)
+        # Clip boundaries to image size
+        y1_c, y2_c = max(0, y1), min(im_h, y2)
+        x1_c, x2_c = max(0, x1), min(im_w, x2)
+        if y2_c <= y1_c or x2_c <= x1_c:
+            continue
+        # Same source pixels as cv2.resize(labels, (w, h), INTER_NEAREST) (floor(x / (w / src_w))),
+        # only for the clipped area
+        rows = np.minimum(np.floor((np.arange(y1_c, y2_c) - y1) * (1.0 / (h / labels.shape[0]))).astype(np.intp), labels.shape[0] - 1)
+        cols = np.minimum(np.floor((np.arange(x1_c, x2_c) - x1) * (1.0 / (w / labels.shape[1]))).astype(np.intp), labels.shape[1] - 1)
+        region = part_map[y1_c:y2_c, x1_c:x2_c]
+        np.maximum(region, labels[np.ix_(rows, cols)], out=region)
+    return part_map
+
+
+def label_agreement(fast_map, full_map):
+    """
+    How well a fast-mode part map matches the full-mode one:
+    pixel accuracy over the union of both foregrounds, mean IoU over the part
+    labels present in either map, and IoU of the label groups used downstream.
+    """
+    fg = (fast_map > 0) | (full_map > 0)
+    report = {"pixel_accuracy": float((fast_map[fg] == full_map[fg]).mean()) if fg.any() else 1.0}
+    ious = []
+    for label in np.union1d(np.unique(fast_map), np.unique(full_map)):
+        if label == 0:
+            continue
+        a, b = fast_map == label, full_map == label
+        ious.append((a & b).sum() / (a | b).sum())
+    report["mean_iou"] = float(np.mean(ious)) if ious else 1.0
+    fast_flags, full_flags = dp_flags(fast_map), dp_flags(full_map)
+    for name, group in AGREEMENT_GROUPS.items():
+        a, b = in_group(fast_flags, group), in_group(full_flags, group)
+        union = (a | b).sum()
+        report[f"iou_{name}"] = float((a & b).sum() / union) if union else 1.0
+    return report
+
+# Engines built so far, keyed by (project root, short side) (reused by persistent workers)
+_ENGINES = {}
+
+def get_engine(project_root, short_side=None):
+    key = (project_root, short_side)
+    if key not in _ENGINES:
+        _ENGINES[key] = DensePoseEngine(project_root, short_side=short_side)
+    return _ENGINES[key]
+
+def output_path_for(input_path, output_dir):
     # Ensure output is png
-    output_filename = os.path.splitext(filename)[0] + "_densepose.png"
-    output_image_path = os.path.join(output_dir, output_filename)
-
-    # Setup configuration
-    cfg = get_cfg()
-    add_densepose_config(cfg)
-    cfg.merge_from_file(config_file)
-    cfg.MODEL.WEIGHTS = model_weights
-    cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-    cfg.freeze()
-
-    # Load image
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(input_path))[0] + "_densepose.png")
+
+def load_bgr(input_path):
     print(f"Loading image: {input_path}")
-    img = cv2.imread(input_path)
-    if img is None:
+    if not artifact_store.exists(input_path):
         raise ValueError(f"Error: Could not read image at {input_path}")
+    with span("decode", cat="io"):
+        # The model expects BGR like cv2.imread
+        return np.ascontiguousarray(artifact_store.read_array(input_path, "RGB")[:, :, ::-1])
 
-    # Create predictor
-    print("Initializing DensePose model...")
-    predictor = DefaultPredictor(cfg)
-
-    # Run inference
-    print("Running inference...")
-    with torch.no_grad():
-        outputs = predictor(img)["instances"]
-
-    # Initialize extractor (visualizer is no longer needed for this output type)
-    extractor = DensePoseResultExtractor()
-    
-    # Step 5: Extract raw part indices
-    results = extractor(outputs)
-    
-    # Create raw part index map (same size as input image)
-    part_map = np.zeros(img.shape[:2], dtype=np.uint8)
-    
-    # We need to iterate over instances and their corresponding extractor results
-    for i in range(len(outputs)):
-        inst_res = results[i]
-        # inst_res is usually a list of DensePose results
-        if not isinstance(inst_res, list) or len(inst_res) == 0:
-            continue
-            
-        # Get bbox from instances (for coordinate mapping)
-        # box is [x1, y1, x2, y2]
-        bbox = outputs[i].pred_boxes.tensor[0].cpu().numpy()
-        x1, y1, x2, y2 = map(int, bbox)
-        
-        # Take the first sub-result (most common for single person)
-        for dp_res in inst_res:
-            if dp_res is None or not hasattr(dp_res, 'labels'):
-                continue
-            
-            # labels is the segmentation map [0-24] for the box
-            labels = dp_res.labels.cpu().numpy()
-            
-            w = max(1, x2 - x1)
-            h = max(1, y2 - y1)
-            # Interpolate labels to the detected bounding box size
-            labels_resized = cv2.resize(labels, (w, h), interpolation=cv2.INTER_NEAREST)
-            
-            # Clip boundaries to image size
-            im_h, im_w = part_map.shape
-            y1_c = max(0, y1)
-            y2_c = min(im_h, y2)
-            x1_c = max(0, x1)
-            x2_c = min(im_w, x2)
-            
-            # Crop resized labels to match clipped bbox
-            crop_y1 = y1_c - y1
-            crop_y2 = crop_y1 + (y2_c - y1_c)
-            crop_x1 = x1_c - x1
-            crop_x2 = crop_x1 + (x2_c - x1_c)
-            
-            if crop_y2 > crop_y1 and crop_x2 > crop_x1:
-                # Use maximum if multiple detections overlap
-                part_map[y1_c:y2_c, x1_c:x2_c] = np.maximum(
-                    part_map[y1_c:y2_c, x1_c:x2_c], 
-                    labels_resized[crop_y1:crop_y2, crop_x1:crop_x2]
-                )
-
-    # Save output as grayscale indices (essential for generate_target_mask.py)
-    cv2.imwrite(output_image_path, part_map)
-    print(f"Raw part indices saved to: {output_image_path}")
+def run_densepose_batch(jobs, project_root, batch_size=4, short_side=None):
+    """jobs: [(input_path, output_dir)]. One warm engine, batched forward passes."""
+    engine = get_engine(project_root, short_side)
+    images = [load_bgr(input_path) for input_path, _ in jobs]
+    print(f"Running inference on {len(images)} image(s)...")
+    part_maps = engine.part_maps(images, batch_size)
+    for (input_path, output_dir), part_map in zip(jobs, part_maps):
+        os.makedirs(output_dir, exist_ok=True)
+        output_image_path = output_path_for(input_path, output_dir)
+        # Save output as grayscale indices (essential for generate_target_mask.py)
+        with span("png_encode", cat="io"):
+            artifact_store.write_array(output_image_path, part_map)
+        print(f"Raw part indices saved to: {output_image_path}")
 
-if __name__ == "__main__":
+def run_densepose(input_path, output_dir, project_root, short_side=None):
+    run_densepose_batch([(input_path, output_dir)], project_root, short_side=short_side)
+
+def measure_agreement(input_paths, project_root, short_side, batch_size=4):
+    """Fast mode (short_side) vs full mode on the same images; per-image and mean agreement + timings."""
+    import time
+    images = [load_bgr(path) for path in input_paths]
+    report = {"short_side": short_side, "images": {}}
+    maps = {}
+    for mode, side in (("full", None), ("fast", short_side)):
+        engine = get_engine(project_root, side)
+        engine.part_maps(images[:1], batch_size)  # warm-up
+        start = time.perf_counter()
+        maps[mode] = engine.part_maps(images, batch_size)
+        report[f"{mode}_ms_per_image"] = (time.perf_counter() - start) * 1000 / max(1, len(images))
+    for path, fast_map, full_map in zip(input_paths, maps["fast"], maps["full"]):
+        report["images"][os.path.basename(path)] = label_agreement(fast_map, full_map)
+    per_image = list(report["images"].values())
+    report["mean"] = {k: float(np.mean([r[k] for r in per_image])) for k in per_image[0]} if per_image else {}
+    return report
+
+def list_images(input_dir):
+    names = sorted(n[:-4] if n.endswith(".png.npy") else n for n in os.listdir(input_dir))
+    return [os.path.join(input_dir, n) for n in dict.fromkeys(names) if n.lower().endswith(IMAGE_EXTS)]
+
+def build_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input")
+    source.add_argument("--input_dir", help="Process every image in this folder")
     parser.add_argument("--output_dir", required=True)
     parser.add_argument("--project_root", required=True)
-    args = parser.parse_args()
-    run_densepose(args.input, args.output_dir, args.project_root)
+    parser.add_argument("--batch_size", type=int, default=4, help="Images per forward pass")
+    parser.add_argument("--short_side", type=int, default=None,
+                        help="Fast mode: run at this short side (e.g. 512) and compute labels only (no UV)")
+    parser.add_argument("--agreement", action="store_true",
+                        help="Compare fast mode (--short_side) with full mode on the inputs; writes densepose_agreement.json to --output_dir")
+    return parser
+
+def jobs_for(args):
+    inputs = list_images(args.input_dir) if args.input_dir else [args.input]
+    return [(input_path, args.output_dir) for input_path in inputs]
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.agreement:
+        if not args.short_side:
+            raise SystemExit("--agreement needs --short_side")
+        report = measure_agreement([path for path, _ in jobs_for(args)], args.project_root, args.short_side, args.batch_size)
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "densepose_agreement.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Fast ({args.short_side}px) vs full: {report['fast_ms_per_image']:.0f} vs {report['full_ms_per_image']:.0f} ms/image")
+        for k, v in report["mean"].items():
+            print(f"  {k:18s} {v:.4f}")
+        return
+    with span("run_densepose", cat="script"):
+        run_densepose_batch(jobs_for(args), args.project_root, args.batch_size, args.short_side)
+
+def main_batch(argv_list):
+    """Several invocations in one set of forward passes (used by model_worker run_batch)."""
+    all_args = parse_each(build_parser(), argv_list)
+
+    def run(indices):
+        first = all_args[indices[0]]
+        jobs = [job for i in indices for job in jobs_for(all_args[i])]
+        run_densepose_batch(jobs, first.project_root, max(all_args[i].batch_size for i in indices), first.short_side)
+
+    with span("run_densepose", cat="script", batch=len(all_args)):
+        # One merged batch per engine
+        return run_items(all_args, run, key=lambda args: (args.project_root, args.short_side))
+
+if __name__ == "__main__":
+    main()
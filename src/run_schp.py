@@ -1,44 +1,191 @@
 import os
-import subprocess
-import argparse
 import sys
+import argparse
+import cv2
+import numpy as np
+import artifact_store
+from timing_trace import span
+from batch_items import parse_each, run_items
+
+# simple_extractor.py settings of the SCHP checkpoints
+DATASET_SETTINGS = {
+    "lip": {"input_size": [473, 473], "num_classes": 20},
+    "atr": {"input_size": [512, 512], "num_classes": 18},
+    "pascal": {"input_size": [512, 512], "num_classes": 7},
+}
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+
+def get_palette(num_cls):
+    """Palette of SCHP's parsing PNGs (same as simple_extractor.get_palette)."""
+    palette = [0] * (num_cls * 3)
+    for j in range(num_cls):
+        lab, i = j, 0
+        while lab:
+            palette[j * 3 + 0] |= (((lab >> 0) & 1) << (7 - i))
+            palette[j * 3 + 1] |= (((lab >> 1) & 1) << (7 - i))
+            palette[j * 3 + 2] |= (((lab >> 2) & 1) << (7 - i))
+            i += 1
+            lab >>= 3
+    return palette
 
-def run_schp(input_dir, output_dir, project_root):
+
+class SCHPEngine:
     """
-    Wraps simple_extractor.py from Self-Correction-Human-Parsing.
-    Assumes current python environment has the necessary dependencies.
+    SCHP (Self-Correction-Human-Parsing) as a library: schp.pth is loaded once
+    and images are parsed in batches, in memory. Does what simple_extractor.py
+    does per image (aspect-preserving affine crop to the input size, flipped
+    mean/std normalisation, logits warped back to the image, argmax).
     """
-    # Paths relative to project root
-    schp_root = os.path.join(project_root, "Self-Correction-Human-Parsing")
-    model_path = os.path.join(schp_root, "checkpoints", "schp.pth")
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    cmd = [
-        sys.executable, "simple_extractor.py",
-        "--dataset", "lip",
-        "--model-restore", model_path,
-        "--input-dir", input_dir,
-        "--output-dir", output_dir
-    ]
-    
-    print(f"Running SCHP in {schp_root}...")
-    print(f"Command: {' '.join(cmd)}")
-    
-    # Run with check=True to raise error if it fails
-    try:
-        result = subprocess.run(cmd, cwd=schp_root, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"SCHP failed with error: {e}")
-        sys.exit(1)
-        
-    print(f"SCHP complete. Results in {output_dir}")
 
-if __name__ == "__main__":
+    def __init__(self, project_root, dataset="lip", device=None):
+        import torch
+        schp_root = os.path.join(project_root, "Self-Correction-Human-Parsing")
+        if schp_root not in sys.path:
+            sys.path.insert(0, schp_root)
+        import networks
+        from utils.transforms import get_affine_transform, transform_logits
+        self.torch = torch
+        self.get_affine_transform = get_affine_transform
+        self.transform_logits = transform_logits
+
+        settings = DATASET_SETTINGS[dataset]
+        self.input_size = settings["input_size"]
+        self.num_classes = settings["num_classes"]
+        self.aspect_ratio = self.input_size[1] * 1.0 / self.input_size[0]
+        self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        # simple_extractor's Normalize(mean=[0.406, 0.456, 0.485], std=[0.225, 0.224, 0.229]) on BGR input
+        self.mean = torch.tensor([0.406, 0.456, 0.485]).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.225, 0.224, 0.229]).view(1, 3, 1, 1)
+
+        model_path = os.path.join(schp_root, "checkpoints", "schp.pth")
+        print(f"Loading SCHP model from {model_path}...")
+        with span("model_load schp", cat="model_load"):
+            model = networks.init_model("resnet101", num_classes=self.num_classes, pretrained=None)
+            state_dict = torch.load(model_path, map_location="cpu")["state_dict"]
+            # Checkpoint was saved from DataParallel: strip the `module.` prefix
+            model.load_state_dict({k[7:] if k.startswith("module.") else k: v for k, v in state_dict.items()})
+            self.model = model.to(self.device).eval()
+
+    def _box_to_center_scale(self, w, h):
+        # SimpleFolderDataset._box2cs([0, 0, w - 1, h - 1])
+        bw, bh = w - 1, h - 1
+        center = np.array([bw * 0.5, bh * 0.5], dtype=np.float32)
+        if bw > self.aspect_ratio * bh:
+            bh = bw * 1.0 / self.aspect_ratio
+        elif bw < self.aspect_ratio * bh:
+            bw = bh * self.aspect_ratio
+        return center, np.array([bw, bh], dtype=np.float32)
+
+    def _prepare(self, img_bgr):
+        h, w = img_bgr.shape[:2]
+        center, scale = self._box_to_center_scale(w, h)
+        trans = self.get_affine_transform(center, scale, 0, self.input_size)
+        crop = cv2.warpAffine(img_bgr, trans, (int(self.input_size[1]), int(self.input_size[0])),
+                              flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+        return crop, (center, scale, w, h)
+
+    def parse(self, images, batch_size=4):
+        """
+        images: RGB uint8 arrays (H,W,3) and/or image / artifact paths.
+        Returns one uint8 label map (H,W) per image, in the image's own size.
+        """
+        torch = self.torch
+        label_maps = []
+        for start in range(0, len(images), batch_size):
+            chunk = [load_rgb(img) if isinstance(img, str) else img for img in images[start:start + batch_size]]
+            # The model was trained on BGR input (cv2.imread in simple_extractor)
+            prepared = [self._prepare(np.ascontiguousarray(img[:, :, :3][:, :, ::-1])) for img in chunk]
+            batch = torch.from_numpy(np.stack([crop for crop, _ in prepared])).permute(0, 3, 1, 2).float() / 255.0
+            batch = ((batch - self.mean) / self.std).to(self.device)
+            with span("inference schp", cat="inference", batch=len(chunk)), torch.no_grad():
+                output = self.model(batch)
+                # Fused parsing head, upsampled to the network input size
+                logits = torch.nn.functional.interpolate(output[0][-1], size=self.input_size, mode="bilinear", align_corners=True)
+                logits = logits.permute(0, 2, 3, 1).cpu().numpy()
+            with span("transform_logits", cat="compute"):
+                for lg, (_, (center, scale, w, h)) in zip(logits, prepared):
+                    lg = self.transform_logits(lg, center, scale, w, h, input_size=self.input_size)
+                    label_maps.append(np.argmax(lg, axis=2).astype(np.uint8))
+        return label_maps
+
+
+def load_rgb(path):
+    with span("decode", cat="io"):
+        return artifact_store.read_array(path, "RGB")
+
+
+def write_parsing(path, label_map, num_classes=20):
+    """Label map as an SCHP-style palette PNG (or sidecar, per artifact mode)."""
+    with span("png_encode", cat="io"):
+        artifact_store.write_array(path, label_map, palette=get_palette(num_classes))
+
+
+# Engines built so far, keyed by (project root, dataset) (reused by persistent workers)
+_ENGINES = {}
+
+def get_engine(project_root, dataset="lip"):
+    key = (project_root, dataset)
+    if key not in _ENGINES:
+        _ENGINES[key] = SCHPEngine(project_root, dataset)
+    return _ENGINES[key]
+
+
+def list_images(input_dir):
+    names = sorted(n[:-4] if n.endswith(".png.npy") else n for n in os.listdir(input_dir))
+    return [os.path.join(input_dir, n) for n in dict.fromkeys(names) if n.lower().endswith(IMAGE_EXTS)]
+
+
+def jobs_for(args):
+    """[(input path, output path)] of one invocation. Outputs are <stem>.png unless --output_name is given."""
+    inputs = list_images(args.input_dir) if args.input_dir else [args.input]
+    if args.output_name and len(inputs) == 1:
+        return [(inputs[0], os.path.join(args.output_dir, args.output_name))]
+    return [(path, os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + ".png")) for path in inputs]
+
+
+def run_schp(jobs, project_root, dataset="lip", batch_size=4):
+    """jobs: [(input path, output path)]. One warm engine, batched forward passes."""
+    engine = get_engine(project_root, dataset)
+    print(f"Running SCHP on {len(jobs)} image(s)...")
+    label_maps = engine.parse([path for path, _ in jobs], batch_size)
+    for (_, out_path), label_map in zip(jobs, label_maps):
+        write_parsing(out_path, label_map, engine.num_classes)
+    print(f"SCHP complete. Results in {', '.join(sorted({os.path.dirname(p) for _, p in jobs}))}")
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input_dir", required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="Image or artifact to parse")
+    source.add_argument("--input_dir", help="Parse every image in this folder")
     parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--output_name", default=None, help="Output file name for a single --input (default <stem>.png)")
     parser.add_argument("--project_root", required=True)
-    args = parser.parse_args()
-    run_schp(args.input_dir, args.output_dir, args.project_root)
+    parser.add_argument("--dataset", choices=list(DATASET_SETTINGS), default="lip")
+    parser.add_argument("--batch_size", type=int, default=4, help="Images per forward pass")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    with span("run_schp", cat="script"):
+        run_schp(jobs_for(args), args.project_root, args.dataset, args.batch_size)
+
+
+def main_batch(argv_list):
+    """Several invocations in one set of forward passes (used by model_worker run_batch)."""
+    all_args = parse_each(build_parser(), argv_list)
+
+    def run(indices):
+        first = all_args[indices[0]]
+        run_schp([job for i in indices for job in jobs_for(all_args[i])], first.project_root, first.dataset,
+                 max(all_args[i].batch_size for i in indices))
+
+    with span("run_schp", cat="script", batch=len(all_args)):
+        # One merged batch per engine
+        return run_items(all_args, run, key=lambda args: (args.project_root, args.dataset))
+
+
+if __name__ == "__main__":
+    main()
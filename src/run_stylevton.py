@@ -3,157 +3,90 @@ import cv2
 import numpy as np
 from PIL import Image
 import argparse
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-
-# ---------------------------------------------------------------------------
-# LIP / SCHP label groups
-# ---------------------------------------------------------------------------
-# Preservation zone — these pixels are NEVER touched, always taken from original
-PRESERVE_LABELS  = [1, 2, 4, 13]   # Hat, Hair, Sunglasses, Face
-# Old garment region — erase before pasting new cloth
-GARMENT_LABELS   = [5, 6, 7, 10, 11]  # Upper-clothes, Dress, Coat, Jumpsuit, Scarf
-# Arm/hand labels — erased only where new garment covers them
-ARM_LABELS       = [14, 15]         # Left-arm, Right-arm
-# Lower body — never touched
-LOWER_LABELS     = [9, 12, 16, 17, 18, 19]  # Pants, Skirt, Left-leg, Right-leg, Left-shoe, Right-shoe
-
-
-# ---------------------------------------------------------------------------
-# Generator Architecture (Copied from Flow-Style-VTON for self-containment)
-# ---------------------------------------------------------------------------
-class ResidualBlock(nn.Module):
-    def __init__(self, in_features=64, norm_layer=nn.BatchNorm2d):
-        super(ResidualBlock, self).__init__()
-        self.relu = nn.ReLU(True)
-        if norm_layer == None:
-            self.block = nn.Sequential(
-                nn.Conv2d(in_features, in_features, 3, 1, 1, bias=False),
-                nn.ReLU(inplace=True),
-                nn.Conv2d(in_features, in_features, 3, 1, 1, bias=False),
-            )
-        else:
-            self.block = nn.Sequential(
-                nn.Conv2d(in_features, in_features, 3, 1, 1, bias=False),
-                norm_layer(in_features),
-                nn.ReLU(inplace=True),
-                nn.Conv2d(in_features, in_features, 3, 1, 1, bias=False),
-                norm_layer(in_features)
-            )
-
-    def forward(self, x):
-        residual = x
-        out = self.block(x)
-        out += residual
-        out = self.relu(out)
-        return out
-
-
-class ResUnetSkipConnectionBlock(nn.Module):
-    def __init__(self, outer_nc, inner_nc, input_nc=None,
-                 submodule=None, outermost=False, innermost=False, norm_layer=nn.BatchNorm2d, use_dropout=False):
-        super(ResUnetSkipConnectionBlock, self).__init__()
-        self.outermost = outermost
-        use_bias = norm_layer == nn.InstanceNorm2d
-
-        if input_nc is None:
-            input_nc = outer_nc
-        downconv = nn.Conv2d(input_nc, inner_nc, kernel_size=3,
-                             stride=2, padding=1, bias=use_bias)
-        res_downconv = [ResidualBlock(inner_nc, norm_layer), ResidualBlock(inner_nc, norm_layer)]
-        res_upconv = [ResidualBlock(outer_nc, norm_layer), ResidualBlock(outer_nc, norm_layer)]
-
-        downrelu = nn.ReLU(True)
-        uprelu = nn.ReLU(True)
-        if norm_layer != None:
-            downnorm = norm_layer(inner_nc)
-            upnorm = norm_layer(outer_nc)
-
-        if outermost:
-            upsample = nn.Upsample(scale_factor=2, mode='nearest')
-            upconv = nn.Conv2d(inner_nc * 2, outer_nc, kernel_size=3, stride=1, padding=1, bias=use_bias)
-            down = [downconv, downrelu] + res_downconv
-            up = [upsample, upconv]
-            model = down + [submodule] + up
-        elif innermost:
-            upsample = nn.Upsample(scale_factor=2, mode='nearest')
-            upconv = nn.Conv2d(inner_nc, outer_nc, kernel_size=3, stride=1, padding=1, bias=use_bias)
-            down = [downconv, downrelu] + res_downconv
-            if norm_layer == None:
-                up = [upsample, upconv, uprelu] + res_upconv
-            else:
-                up = [upsample, upconv, upnorm, uprelu] + res_upconv
-            model = down + up
-        else:
-            upsample = nn.Upsample(scale_factor=2, mode='nearest')
-            upconv = nn.Conv2d(inner_nc*2, outer_nc, kernel_size=3, stride=1, padding=1, bias=use_bias)
-            if norm_layer == None:
-                down = [downconv, downrelu] + res_downconv
-                up = [upsample, upconv, uprelu] + res_upconv
-            else:
-                down = [downconv, downnorm, downrelu] + res_downconv
-                up = [upsample, upconv, upnorm, uprelu] + res_upconv
-
-            if use_dropout:
-                model = down + [submodule] + up + [nn.Dropout(0.5)]
-            else:
-                model = down + [submodule] + up
-
-        self.model = nn.Sequential(*model)
-
-    def forward(self, x):
-        if self.outermost:
-            return self.model(x)
-        else:
-            return torch.cat([x, self.model(x)], 1)
-
-
-class ResUnetGenerator(nn.Module):
-    def __init__(self, input_nc, output_nc, num_downs, ngf=64,
-                 norm_layer=nn.BatchNorm2d, use_dropout=False):
-        super(ResUnetGenerator, self).__init__()
-        unet_block = ResUnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=None, norm_layer=norm_layer, innermost=True)
-        for i in range(num_downs - 5):
-            unet_block = ResUnetSkipConnectionBlock(ngf * 8, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer, use_dropout=use_dropout)
-        unet_block = ResUnetSkipConnectionBlock(ngf * 4, ngf * 8, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = ResUnetSkipConnectionBlock(ngf * 2, ngf * 4, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = ResUnetSkipConnectionBlock(ngf, ngf * 2, input_nc=None, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = ResUnetSkipConnectionBlock(output_nc, ngf, input_nc=input_nc, submodule=unet_block, outermost=True, norm_layer=norm_layer)
-        self.model = unet_block
-
-    def forward(self, input):
-        return self.model(input)
+import artifact_store
+from artifact_store import read_image
+from timing_trace import span, traced
+from stage_cache import file_identity
+from batch_items import parse_each, run_items
+# LIP / SCHP label groups (label_groups.py):
+#   PRESERVE  Hat, Hair, Sunglasses, Face — NEVER touched, always taken from original
+#   GARMENT   Upper-clothes, Dress, Coat, Jumpsuit, Scarf — erased before pasting new cloth
+#   ARMS      Left-arm, Right-arm — erased only where new garment covers them
+#   LOWER     Pants, Skirt, legs, shoes — never touched
+from label_groups import parse_flags, dp_flags, in_group, PRESERVE, GARMENT, ARMS, LOWER, FACE, DP_HANDS
+
+
+# Generators loaded so far, keyed by (checkpoint, device, precision, identity of the loaded
+# files) (reused by persistent workers; a checkpoint or prepared model replaced in place
+# is loaded again)
+_GENERATOR_CACHE = {}
+
+def generator_identity(checkpoint, precision):
+    identity = file_identity(checkpoint)
+    if precision != "fp32":
+        # generator_quant.prepared_path, without importing torch here
+        identity += "|" + file_identity(f"{checkpoint}.{precision}.ts")
+    return identity
+
+def load_generator(checkpoint, device, precision="fp32"):
+    """
+    fp32 builds the generator from the checkpoint; bf16 / int8 load the copy prepared
+    (and checked against fp32) by generator_quant.py prepare.
+    """
+    key = (checkpoint, str(device), precision, generator_identity(checkpoint, precision))
+    if key not in _GENERATOR_CACHE:
+        for old in [k for k in _GENERATOR_CACHE if k[:3] == key[:3]]:
+            del _GENERATOR_CACHE[old]
+        # torch is only needed for GAN inpainting; the layered compositing is numpy/cv2
+        import torch
+        import torch.nn as nn
+        if precision != "fp32":
+            from generator_quant import load_prepared
+            with span(f"model_load stylevton {precision}", cat="model_load"):
+                _GENERATOR_CACHE[key] = load_prepared(checkpoint, precision, device)
+            return _GENERATOR_CACHE[key]
+        from stylevton_generator import ResUnetGenerator
+        with span("model_load stylevton", cat="model_load"):
+            gen = ResUnetGenerator(7, 4, 5, ngf=64, norm_layer=nn.BatchNorm2d).to(device)
+            ckpt = torch.load(checkpoint, map_location=device)
+            gen.load_state_dict(ckpt['G'] if 'G' in ckpt else ckpt)
+            gen.eval()
+        _GENERATOR_CACHE[key] = gen
+    return _GENERATOR_CACHE[key]
 
 
+@traced("decode", cat="io")
 def load_rgba(path, target_size=None):
     """Load image as float32 RGBA [0,1]. target_size = (W, H)."""
-    img = Image.open(path).convert("RGBA")
+    img = read_image(path, "RGBA")
     if target_size:
         img = img.resize(target_size, Image.LANCZOS)
     return np.array(img).astype(np.float32) / 255.0
 
 
+@traced("decode", cat="io")
 def load_rgb(path, target_size=None):
     """Load image as float32 RGB [0,1]. target_size = (W, H)."""
-    img = Image.open(path).convert("RGB")
+    img = read_image(path, "RGB")
     if target_size:
         img = img.resize(target_size, Image.LANCZOS)
     return np.array(img).astype(np.float32) / 255.0
 
 
+@traced("decode", cat="io")
 def load_mask(path, target_size=None, threshold=0.5):
     """Load image as binary float32 mask [0 or 1]. target_size = (W, H)."""
-    img = Image.open(path).convert("L")
+    img = read_image(path, "L")
     if target_size:
         img = img.resize(target_size, Image.NEAREST)
     arr = np.array(img).astype(np.float32) / 255.0
     return (arr > threshold).astype(np.float32)
 
 
+@traced("decode", cat="io")
 def load_parse(path, target_size=None):
     """Load SCHP parsing map as uint8. target_size = (W, H)."""
-    img = Image.open(path)
+    img = read_image(path)
     if target_size:
         img = img.resize(target_size, Image.NEAREST)
     return np.array(img).astype(np.uint8)
@@ -168,15 +101,12 @@ def soft_mask(binary_mask, blur_radius=7):
     return cv2.GaussianBlur(binary_mask.astype(np.float32), (r, r), 0)
 
 
-def build_label_mask(parse, labels):
-    """Return binary mask where any of `labels` is present in `parse`."""
-    mask = np.zeros(parse.shape, dtype=np.uint8)
-    for lbl in labels:
-        mask |= (parse == lbl).astype(np.uint8)
-    return mask.astype(np.float32)
+def build_label_mask(flags, groups):
+    """Float 0/1 mask of the pixels in any of `groups` (flags from label_groups.parse_flags)."""
+    return in_group(flags, groups).astype(np.float32)
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Layered Virtual Try-On Compositor (no GAN inpainting)"
     )
@@ -200,13 +130,25 @@ def main():
     parser.add_argument("--checkpoint",    default=None,   help="Path to generator checkpoint (for inpainting mode)")
     parser.add_argument("--inpaint_skin", action="store_true", help="Use GAN inpainting to fill skin holes (e.g. for full-to-half sleeve)")
     parser.add_argument("--initial_sleeve", choices=['none', 'half', 'full'], default='full', help="Initial sleeve type of the person")
+    parser.add_argument("--inpaint_precision", choices=["fp32", "bf16", "int8"], default="fp32",
+                        help="Generator precision for inpainting (bf16/int8 must be prepared first with generator_quant.py prepare, int8 runs on CPU)")
+    parser.add_argument("--dump_inpaint_input", default=None,
+                        help="Save the generator input and hole mask here (.npz) for generator_quant.py calibration / comparison")
+    parser.add_argument("--inpaint_batch", type=int, default=4, help="Images per generator forward pass in a batch")
+    return parser
 
-    args = parser.parse_args()
+
+def composite(args):
+    """
+    One try-on composite. A generator: when GAN inpainting is needed it yields
+    (generator input, device) and expects the tanh RGB output (1, 3, H, W) back,
+    so composite_batch can run the generator for several composites at once.
+    """
 
     # ------------------------------------------------------------------
     # 0. Resolve working size from the original person image
     # ------------------------------------------------------------------
-    orig_pil = Image.open(args.original).convert("RGBA")
+    orig_pil = read_image(args.original, "RGBA")
     W, H = orig_pil.size
     sz = (W, H)
     print(f"[INFO] Working resolution: {W}x{H}")
@@ -226,7 +168,7 @@ def main():
     warped_mask  = load_mask(args.warped_mask, sz)       # (H,W)   binary
 
     # SCHP parsing — optional but strongly recommended
-    if args.parse and os.path.exists(args.parse):
+    if args.parse and artifact_store.exists(args.parse):
         parse = load_parse(args.parse, sz)               # (H,W)   uint8 label ids
         has_parse = True
         print("[INFO] SCHP parsing loaded.")
@@ -236,9 +178,9 @@ def main():
         print("[WARN] No SCHP parse provided.")
 
     # DensePose — optional but recommended for hand protection
-    if args.densepose and os.path.exists(args.densepose):
-        dp_img = cv2.imread(args.densepose)
-        dp = cv2.resize(dp_img[:, :, 0], sz, interpolation=cv2.INTER_NEAREST)
+    if args.densepose and artifact_store.exists(args.densepose):
+        dp_img = artifact_store.read_array(args.densepose)
+        dp = cv2.resize(dp_img if dp_img.ndim == 2 else dp_img[:, :, 0], sz, interpolation=cv2.INTER_NEAREST)
         has_dp = True
         print("[INFO] DensePose loaded for hand protection.")
     else:
@@ -249,10 +191,11 @@ def main():
     # 2. Build semantic masks from SCHP & DensePose
     # ------------------------------------------------------------------
     if has_parse:
-        old_garment_mask = build_label_mask(parse, GARMENT_LABELS)   # torso clothing
-        arm_mask         = build_label_mask(parse, ARM_LABELS)        # both arms
-        preserve_mask    = build_label_mask(parse, PRESERVE_LABELS)   # face/hair — NEVER touch
-        lower_mask       = build_label_mask(parse, LOWER_LABELS)      # pants/shoes — NEVER touch
+        parse_groups     = parse_flags(parse)                          # one lookup pass for all groups
+        old_garment_mask = build_label_mask(parse_groups, GARMENT)    # torso clothing
+        arm_mask         = build_label_mask(parse_groups, ARMS)       # both arms
+        preserve_mask    = build_label_mask(parse_groups, PRESERVE)   # face/hair — NEVER touch
+        lower_mask       = build_label_mask(parse_groups, LOWER)      # pants/shoes — NEVER touch
     else:
         # Fallback: use agnostic mask as erase region, no arm/preserve logic
         old_garment_mask = load_mask(args.agnostic_mask, sz)
@@ -263,7 +206,7 @@ def main():
     # Hand Protection (Labels 3, 4 from DensePose)
     hand_mask = np.zeros((H, W), dtype=np.float32)
     if has_dp:
-        hand_mask = ((dp == 3) | (dp == 4)).astype(np.float32)
+        hand_mask = in_group(dp_flags(dp), DP_HANDS).astype(np.float32)
         # Dilate hands slightly to be safe
         hand_mask = cv2.dilate(hand_mask, np.ones((5, 5), np.uint8), iterations=1)
 
@@ -354,10 +297,13 @@ def main():
     if np.any(uncovered_holes):
         if do_inpaint and args.checkpoint and os.path.exists(args.checkpoint):
             print("[INFO] Inpainting uncovered skin holes using GAN...")
+            import torch
             # 1. Prepare GAN inputs
             # GAN expects [-1, 1], (1, C, H, W)
             torch.backends.cudnn.enabled = False
-            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            # Quantized kernels are CPU only
+            use_cuda = torch.cuda.is_available() and args.inpaint_precision != "int8"
+            device = torch.device('cuda' if use_cuda else 'cpu')
             
             # Agnostic image (person_rgb with erased regions as grey)
             agnostic_t = torch.from_numpy(canvas).permute(2,0,1).unsqueeze(0).to(device) * 2.0 - 1.0
@@ -367,21 +313,16 @@ def main():
             mask_t = torch.from_numpy(warped_mask).unsqueeze(0).unsqueeze(0).to(device)
             
             gen_input = torch.cat([agnostic_t, cloth_t, mask_t], 1)
+            if args.dump_inpaint_input:
+                np.savez_compressed(args.dump_inpaint_input, input=gen_input[0].cpu().numpy().astype(np.float16),
+                                    holes=uncovered_holes)
             
-            # 2. Load and Run Generator
-            gen = ResUnetGenerator(7, 4, 5, ngf=64, norm_layer=nn.BatchNorm2d).to(device)
-            ckpt = torch.load(args.checkpoint, map_location=device)
-            gen.load_state_dict(ckpt['G'] if 'G' in ckpt else ckpt)
-            gen.eval()
-            
-            with torch.no_grad():
-                gen_output = gen(gen_input)
-                p_rendered, _ = torch.split(gen_output, [3, 1], 1)
-                p_rendered = torch.tanh(p_rendered)
+            # 2. Run the Generator (composite_batch, batched with other composites)
+            p_rendered = yield gen_input, device
             
             # 3. Skin Tone Matching Fallback
             # Sample skin color from face (Label 13) to ensure GAN output matches person
-            face_mask = build_label_mask(parse, [13]) if has_parse else np.zeros_like(warped_mask)
+            face_mask = build_label_mask(parse_groups, FACE) if has_parse else np.zeros_like(warped_mask)
             if np.any(face_mask > 0.5):
                 face_pixels = person_rgb[face_mask > 0.5]
                 median_skin = np.median(face_pixels, axis=0) # [R, G, B]
@@ -432,26 +373,74 @@ def main():
     # ------------------------------------------------------------------
     # 7. Save
     # ------------------------------------------------------------------
-    result_img.save(args.output_path)
+    with span("png_encode", cat="io"):
+        result_img.save(args.output_path)
     print(f"[SUCCESS] Layered try-on result saved to: {args.output_path}")
 
     # ------------------------------------------------------------------
     # 8. Debug / diagnostic saves (same folder, prefixed with dbg_)
     # ------------------------------------------------------------------
     dbg_dir = output_dir if output_dir else "."
-    Image.fromarray((erase_mask * 255).astype(np.uint8)).save(
-        os.path.join(dbg_dir, "dbg_erase_mask.png"))
-    Image.fromarray((paste_mask_soft[:, :, 0] * 255).astype(np.uint8)).save(
-        os.path.join(dbg_dir, "dbg_paste_mask.png"))
-    if has_parse:
-        Image.fromarray((preserve_mask * 255).astype(np.uint8)).save(
-            os.path.join(dbg_dir, "dbg_preserve_mask.png"))
-        Image.fromarray((arm_under_garment * 255).astype(np.uint8)).save(
-            os.path.join(dbg_dir, "dbg_arm_erased.png"))
-    Image.fromarray((paste_support * 255).astype(np.uint8)).save(
-        os.path.join(dbg_dir, "dbg_paste_support.png"))
+    with span("png_encode debug", cat="io"):
+        Image.fromarray((erase_mask * 255).astype(np.uint8)).save(
+            os.path.join(dbg_dir, "dbg_erase_mask.png"))
+        Image.fromarray((paste_mask_soft[:, :, 0] * 255).astype(np.uint8)).save(
+            os.path.join(dbg_dir, "dbg_paste_mask.png"))
+        if has_parse:
+            Image.fromarray((preserve_mask * 255).astype(np.uint8)).save(
+                os.path.join(dbg_dir, "dbg_preserve_mask.png"))
+            Image.fromarray((arm_under_garment * 255).astype(np.uint8)).save(
+                os.path.join(dbg_dir, "dbg_arm_erased.png"))
+        Image.fromarray((paste_support * 255).astype(np.uint8)).save(
+            os.path.join(dbg_dir, "dbg_paste_support.png"))
     print(f"[DEBUG] Diagnostic masks saved to: {dbg_dir}")
 
 
+def composite_batch(all_args):
+    """
+    Composites for several argument sets. The GAN inpainting inputs of the same
+    generator and size are stacked into forward passes of up to --inpaint_batch.
+    """
+    steps = [composite(args) for args in all_args]
+    pending = {}
+    for i, step in enumerate(steps):
+        request = next(step, None)
+        if request is not None:
+            pending[i] = request
+    if not pending:
+        return
+    import torch
+    groups = {}
+    for i, (gen_input, device) in pending.items():
+        args = all_args[i]
+        groups.setdefault((args.checkpoint, str(device), args.inpaint_precision, tuple(gen_input.shape[2:])), []).append(i)
+    for (checkpoint, _, precision, _), indices in groups.items():
+        gen_input, device = pending[indices[0]]
+        gen = load_generator(checkpoint, device, precision)
+        batch_size = max(1, max(all_args[i].inpaint_batch for i in indices))
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            with span("inference stylevton", cat="inference", batch=len(chunk)), torch.no_grad():
+                gen_output = gen(torch.cat([pending[i][0] for i in chunk]))
+                p_rendered, _ = torch.split(gen_output, [3, 1], 1)
+                p_rendered = torch.tanh(p_rendered)
+            for k, i in enumerate(chunk):
+                try:
+                    steps[i].send(p_rendered[k:k + 1])
+                except StopIteration:
+                    pass
+
+
+def main(argv=None):
+    composite_batch([build_parser().parse_args(argv)])
+
+
+def main_batch(argv_list):
+    """Several composites, GAN inpainting batched (used by model_worker run_batch)."""
+    all_args = parse_each(build_parser(), argv_list)
+    with span("run_stylevton", cat="script", batch=len(all_args)):
+        return run_items(all_args, lambda indices: composite_batch([all_args[i] for i in indices]))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,318 @@
+import os
+import ast
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import artifact_store
+from timing_trace import span
+
+# Bump to invalidate every cached entry (e.g. after changing the cache layout)
+CACHE_VERSION = 1
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (abspath, size, mtime_ns) -> sha256, so unchanged files are only hashed once per process
+_FILE_HASHES = {}
+# sha256 of a script -> names of the src/ modules it imports
+_SRC_IMPORTS = {}
+
+
+def hash_file(path):
+    """sha256 of a file's bytes (memoized on path, size and mtime)."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo_key not in _FILE_HASHES:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _FILE_HASHES[memo_key] = h.hexdigest()
+    return _FILE_HASHES[memo_key]
+
+
+def file_identity(path):
+    """
+    Cheap identity for large files such as checkpoints: name, size and mtime.
+    Hashing a few hundred MB of weights on every request would defeat the cache.
+    """
+    if not path or not os.path.exists(path):
+        return f"missing:{path}"
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def src_imports(script):
+    """src/ scripts imported by `script` (anywhere in it, including imports inside functions)."""
+    digest = hash_file(os.path.join(SRC_DIR, script))
+    if digest not in _SRC_IMPORTS:
+        with open(os.path.join(SRC_DIR, script), "rb") as f:
+            tree = ast.parse(f.read(), filename=script)
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names.add(node.module.split(".")[0])
+        _SRC_IMPORTS[digest] = sorted(f"{name}.py" for name in names
+                                      if os.path.isfile(os.path.join(SRC_DIR, f"{name}.py")))
+    return _SRC_IMPORTS[digest]
+
+
+def code_closure(scripts):
+    """The scripts plus every src/ module they import, transitively (sorted)."""
+    seen, todo = set(), list(scripts)
+    while todo:
+        script = todo.pop()
+        if script not in seen:
+            seen.add(script)
+            todo.extend(src_imports(script))
+    return sorted(seen)
+
+
+def code_version(scripts):
+    """
+    Hash of the stage scripts (names relative to src/) that produce an output and
+    of every src/ module they import, so editing a shared helper (label tables,
+    artifact storage, ...) invalidates the outputs that depend on it.
+    """
+    h = hashlib.sha256(str(CACHE_VERSION).encode())
+    for script in code_closure(scripts):
+        h.update(script.encode())
+        h.update(hash_file(os.path.join(SRC_DIR, script)).encode())
+    return h.hexdigest()
+
+
+class StageCache:
+    """
+    Content-addressed cache of stage outputs.
+
+    Each entry is a directory <root>/<key[:2]>/<key>/ holding the output files and a
+    meta.json. Entries are published with an atomic rename, and the meta.json mtime
+    records the last use, so several processes can share one cache without locking.
+    """
+
+    def __init__(self, root, max_bytes=20 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Bytes in the cache as last counted plus what this process stored since
+        # (entries stored by other processes are counted at the next eviction)
+        self._total = None
+        os.makedirs(root, exist_ok=True)
+
+    def make_key(self, stage, inputs=(), params=None, code=()):
+        """
+        stage: stage name, inputs: list of input file paths (hashed by content,
+        through their .npy sidecar or job container record when there is one), params: JSON-serializable
+        dict, code: stage entry scripts (their src/ imports are included, see code_version).
+        """
+        h = hashlib.sha256()
+        h.update(stage.encode())
+        for path in inputs:
+            h.update(b"\0")
+            found = artifact_store.packed(path) if path else None
+            if found:
+                h.update(found[0].fingerprint(found[1]).encode())
+                continue
+            path = artifact_store.resolve(path) if path else path
+            h.update(hash_file(path).encode() if path and os.path.exists(path) else b"missing")
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        h.update(code_version(code).encode())
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, outputs):
+        """
+        Copies a cached entry to `outputs` ({name: path}). Returns False on a miss.
+        Outputs that were optional when the entry was stored (not produced) are skipped.
+        .npy sidecars (artifact_store) are stored as "<name>.npy" and restored next to the path,
+        job container records as "<name>.vtc" and restored into the destination's container.
+        """
+        entry = self._entry_dir(key)
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        files = set(meta["files"])
+        if any(not {name, name + ".npy", name + ".vtc"} & files and name not in meta["absent"] for name in outputs):
+            return False
+        packing = artifact_store.artifact_mode() == "container"
+
+        for name, path in outputs.items():
+            if name in meta["absent"]:
+                # Not produced by the cached run: drop what an earlier run left there
+                for leftover in [path, artifact_store.sidecar(path)]:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                continue
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            for stored, dest in [(name, path), (name + ".npy", artifact_store.sidecar(path))]:
+                if stored in files:
+                    shutil.copyfile(os.path.join(entry, stored), dest)
+                elif os.path.exists(dest):
+                    # Leftover from a run in another artifact mode
+                    os.remove(dest)
+            if name + ".vtc" in files:
+                with open(os.path.join(entry, name + ".vtc"), "rb") as f:
+                    artifact_store.import_record(path, f.read())
+            elif packing and os.path.splitext(path)[1] == ".png":
+                # Entry from another artifact mode: move it into the job container
+                artifact_store.import_png(path)
+        # Mark as recently used
+        os.utime(meta_path)
+        return True
+
+    def clear_outputs(self, outputs):
+        """
+        Call before running a stage: removes the files an earlier run left at `outputs`
+        ({name: path}), so an optional output the new run does not write (e.g. a mask of
+        another sleeve type) is not mistaken for one it produced. Container records
+        cannot be removed; their positions are returned instead, for store(before=...).
+        """
+        before = {}
+        for name, path in outputs.items():
+            found = artifact_store.packed(path)
+            if found:
+                before[name] = found[0].position(found[1])
+            for leftover in [path, artifact_store.sidecar(path)]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        return before
+
+    def store(self, key, outputs, before=None):
+        """
+        Copies produced `outputs` ({name: path}) into the cache and enforces the size budget.
+        before: clear_outputs() result from before the run; container records it saw
+        unchanged are leftovers of an earlier run, not produced.
+        """
+        entry = self._entry_dir(key)
+        if os.path.exists(os.path.join(entry, "meta.json")):
+            return
+        tmp = f"{entry}.tmp{os.getpid()}_{time.time_ns()}"
+        os.makedirs(tmp, exist_ok=True)
+
+        files, absent, size = [], [], 0
+        for name, path in outputs.items():
+            found = artifact_store.packed(path)
+            if not artifact_store.exists(path) or (found and before and before.get(name) == found[0].position(found[1])):
+                absent.append(name)
+                continue
+            if found:
+                record = found[0].record(found[1])
+                with open(os.path.join(tmp, name + ".vtc"), "wb") as f:
+                    f.write(record)
+                files.append(name + ".vtc")
+                size += len(record)
+                continue
+            for stored, src in [(name, path), (name + ".npy", artifact_store.sidecar(path))]:
+                if os.path.exists(src):
+                    shutil.copyfile(src, os.path.join(tmp, stored))
+                    files.append(stored)
+                    size += os.path.getsize(src)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"files": files, "absent": absent, "size": size, "created": time.time()}, f)
+
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            # Another process published the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        # The directory is only walked when the running total crosses the budget
+        if self._total is None:
+            self.evict()
+        else:
+            self._total += size
+            if self._total > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """Yields (entry_dir, size, last_used) for every published entry."""
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                meta_path = os.path.join(shard_dir, key, "meta.json")
+                try:
+                    with open(meta_path) as f:
+                        size = json.load(f)["size"]
+                    yield os.path.join(shard_dir, key), size, os.path.getmtime(meta_path)
+                except (OSError, ValueError, KeyError):
+                    continue
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for entry, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._total = total
+
+
+def missing_outputs(outputs, optional=()):
+    """Names of the required `outputs` ({name: path}) that do not exist."""
+    return [name for name, path in outputs.items() if name not in optional and not artifact_store.exists(path)]
+
+
+def run_cached(cache, stage, run, inputs, outputs, params=None, code=(), optional=()):
+    """
+    Runs `run()` (returns bool) unless `cache` holds outputs for the same inputs,
+    params and code. `cache` may be None to always run.
+    optional: names of outputs a successful run may leave out (stored as absent).
+    Every other output must exist afterwards, or the stage fails and nothing is stored.
+    """
+    if cache is None:
+        return run() and not _report_missing(stage, outputs, optional)
+    with span(f"cache lookup {stage}", cat="cache"):
+        key = cache.make_key(stage, inputs, params, code)
+        hit = cache.restore(key, outputs)
+    if hit:
+        print(f"[CACHE] Hit for {stage} ({key[:12]}), skipping.")
+        return True
+    before = cache.clear_outputs(outputs)
+    ok = run() and not _report_missing(stage, outputs, optional)
+    if ok:
+        with span(f"cache store {stage}", cat="cache"):
+            cache.store(key, outputs, before)
+    return ok
+
+
+def _report_missing(stage, outputs, optional):
+    missing = missing_outputs(outputs, optional)
+    if missing:
+        print(f"!!! Stage {stage} reported success but did not write {', '.join(missing)}")
+    return missing
+
+
+def open_cache(cache_dir, max_gb):
+    """Returns a StageCache, or None when caching is disabled (no cache_dir)."""
+    if not cache_dir:
+        return None
+    return StageCache(cache_dir, int(max_gb * 1024**3))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or trim the stage cache")
+    parser.add_argument("--cache_dir", required=True)
+    parser.add_argument("--max_gb", type=float, default=20.0)
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    args = parser.parse_args(argv)
+
+    cache = StageCache(args.cache_dir, 0 if args.clear else int(args.max_gb * 1024**3))
+    cache.evict()
+    entries = list(cache.entries())
+    print(f"{len(entries)} entries, {sum(e[1] for e in entries) / 1024**2:.1f} MB in {args.cache_dir}")
+
+if __name__ == "__main__":
+    main()
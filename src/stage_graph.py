@@ -0,0 +1,135 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from timing_trace import span
+
+
+class Stage:
+    """
+    One node of a pipeline graph.
+    run: callable returning True on success.
+    inputs / outputs: file paths. A stage depends on every stage producing one of
+    its inputs; inputs no stage produces must already exist on disk.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=()):
+        self.name = name
+        self.run = run
+        self.inputs = [os.path.abspath(p) for p in inputs]
+        self.outputs = [os.path.abspath(p) for p in outputs]
+
+    def execute(self):
+        with span(self.name, cat="stage"):
+            return self.run()
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def build_dependencies(stages):
+    """Returns {stage_name: set(names of stages it waits for)}."""
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in producers:
+                raise ValueError(f"{path} is produced by both {producers[path]} and {stage.name}")
+            producers[path] = stage.name
+
+    deps = {}
+    for stage in stages:
+        deps[stage.name] = {producers[p] for p in stage.inputs if p in producers and producers[p] != stage.name}
+
+    # Reject cycles up front instead of deadlocking the scheduler
+    remaining = {name: set(d) for name, d in deps.items()}
+    while remaining:
+        ready = [name for name, d in remaining.items() if not d]
+        if not ready:
+            raise ValueError(f"Dependency cycle between stages: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return deps
+
+
+def run_graph(stages, max_workers=4, keep_going=False, on_event=None, status=None):
+    """
+    Runs every stage once all of its dependencies succeeded, at most `max_workers`
+    at a time. Stops scheduling after the first failure and returns False, unless
+    keep_going is set: then only the stages downstream of a failure are skipped.
+    on_event: optional callable(event, stage_name) for progress reporting, with
+    event one of "start", "done", "failed", "skipped".
+    status: optional dict filled with the outcome of each stage ("done", "failed"
+    or "skipped"; stages never started after a failure are left out).
+    """
+    status = {} if status is None else status
+    notify = on_event or (lambda event, name: None)
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate stage names in {names}")
+    by_name = {s.name: s for s in stages}
+    deps = build_dependencies(stages)
+    dependents = {name: set() for name in names}
+    for name, d in deps.items():
+        for upstream in d:
+            dependents[upstream].add(name)
+
+    def skip_downstream(name):
+        # Every stage reachable from the failed one, whatever its position in `stages`
+        queue = deque(dependents[name])
+        while queue:
+            child = queue.popleft()
+            if child in skipped:
+                continue
+            skipped.add(child)
+            status[child] = "skipped"
+            print(f"[GRAPH] Skipping {child} (upstream stage {name} failed)")
+            notify("skipped", child)
+            queue.extend(dependents[child])
+
+    done = set()
+    # Failed stages and everything downstream of them
+    skipped = set()
+    running = {}
+    failed = None
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        while True:
+            if failed is None or keep_going:
+                for name in names:
+                    if name in done or name in skipped or name in running.values():
+                        continue
+                    if deps[name] <= done:
+                        notify("start", name)
+                        running[pool.submit(by_name[name].execute)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"!!! Stage {name} raised: {e!r}")
+                    ok = False
+                status[name] = "done" if ok else "failed"
+                if ok:
+                    done.add(name)
+                    print(f"[GRAPH] {name} done ({time.time() - start:.1f}s elapsed)")
+                    notify("done", name)
+                    continue
+                skipped.add(name)
+                notify("failed", name)
+                if failed is None:
+                    failed = name
+                if keep_going:
+                    print(f"!!! Stage {name} failed; continuing with independent stages.")
+                    skip_downstream(name)
+                else:
+                    print(f"!!! Stage {name} failed; waiting for running stages to finish.")
+
+    return failed is None and len(done) == len(stages)
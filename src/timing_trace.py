@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+from contextlib import contextmanager
+
+# Trace context, inherited by subprocesses through the environment
+TRACE_FILE_ENV = "VITON_TRACE_FILE"      # file every process appends its events to
+TRACE_PARENT_ENV = "VITON_TRACE_PARENT"  # span id of the parent-process span that spawned us
+TRACE_LAUNCH_ENV = "VITON_TRACE_LAUNCH"  # wall-clock time (us) at which the parent spawned us
+
+_context = {
+    "file": os.environ.get(TRACE_FILE_ENV),
+    "parent": os.environ.get(TRACE_PARENT_ENV),
+    "launch": int(os.environ[TRACE_LAUNCH_ENV]) if os.environ.get(TRACE_LAUNCH_ENV) else None,
+}
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_named = set()  # trace files we already wrote this process's name to
+
+
+def _now_us():
+    # Wall clock, so events from different processes line up on one timeline
+    return time.time_ns() // 1000
+
+
+def enabled():
+    return bool(_context["file"])
+
+
+def configure(trace_file=None, parent=None, launch=None):
+    """Sets the trace context of this process (used by persistent workers per request)."""
+    _context.update(file=trace_file, parent=parent, launch=launch)
+
+
+def _emit(event):
+    event.setdefault("pid", os.getpid())
+    event.setdefault("tid", threading.get_ident() % 2**31)
+    with _lock:
+        path = _context["file"]
+        if path not in _named:
+            _named.add(path)
+            name = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+            meta = {"ph": "M", "name": "process_name", "pid": event["pid"], "tid": 0, "args": {"name": f"{name} ({event['pid']})"}}
+            _append(path, meta)
+        _append(path, event)
+
+
+def _append(path, event):
+    # One O_APPEND write per event keeps lines from concurrent processes intact
+    line = (json.dumps(event) + ",\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(name, cat="step", **args):
+    """
+    Times the enclosed block as a Chrome trace complete ("X") event.
+    Yields the span id (pass it to child_env / trace_context when spawning work).
+    No-op when no trace file is configured.
+    """
+    if not enabled():
+        yield None
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    span_id = f"{os.getpid()}.{next(_ids)}"
+    start = _now_us()
+
+    if not stack and _context["parent"]:
+        # First span of a spawned process/request: show startup cost and link to the parent
+        if _context["launch"]:
+            _emit({"ph": "X", "name": "startup", "cat": "startup", "ts": _context["launch"],
+                   "dur": max(0, start - _context["launch"])})
+            _context["launch"] = None
+        _emit({"ph": "f", "bp": "e", "name": "spawn", "cat": "flow", "id": _context["parent"], "ts": start})
+        args["parent_span"] = _context["parent"]
+
+    stack.append(span_id)
+    try:
+        yield span_id
+    finally:
+        stack.pop()
+        _emit({"ph": "X", "name": name, "cat": cat, "ts": start, "dur": _now_us() - start,
+               "args": dict(args, span=span_id)})
+
+
+def traced(name=None, cat="step"):
+    """Decorator form of span()."""
+    def wrap(fn):
+        def inner(*a, **kw):
+            with span(name or fn.__name__, cat=cat):
+                return fn(*a, **kw)
+        inner.__name__ = fn.__name__
+        inner.__doc__ = fn.__doc__
+        return inner
+    return wrap
+
+
+def trace_context(span_id):
+    """Context to hand to another process that works on behalf of `span_id`."""
+    if not enabled():
+        return None
+    _emit({"ph": "s", "name": "spawn", "cat": "flow", "id": span_id, "ts": _now_us()})
+    return {"trace_file": _context["file"], "parent": span_id, "launch": _now_us()}
+
+
+def child_env(span_id):
+    """Environment for a subprocess spawned inside span `span_id` (None = inherit as-is)."""
+    ctx = trace_context(span_id)
+    if ctx is None:
+        return None
+    env = dict(os.environ)
+    env[TRACE_FILE_ENV] = ctx["trace_file"]
+    env[TRACE_PARENT_ENV] = ctx["parent"]
+    env[TRACE_LAUNCH_ENV] = str(ctx["launch"])
+    return env
+
+
+def start_trace(path):
+    """Starts a fresh trace file for this run; subprocesses inherit it via the environment."""
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("[\n")
+    os.environ[TRACE_FILE_ENV] = path
+    os.environ.pop(TRACE_PARENT_ENV, None)
+    os.environ.pop(TRACE_LAUNCH_ENV, None)
+    configure(path)
+    return path
+
+
+def load_events(path):
+    """Reads the events of a trace file (streaming or finished form)."""
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("{"):
+        return json.loads(text)["traceEvents"]
+    return json.loads(text.rstrip(",") + ("" if text.endswith("]") else "]"))
+
+
+def finish_trace(path=None):
+    """Rewrites the streaming trace into a standard {"traceEvents": [...]} JSON file."""
+    path = path or _context["file"]
+    events = load_events(path)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return events
+
+
+def summarize(events, cat=None):
+    """Total duration (ms) per span name, optionally for one category."""
+    totals = {}
+    for e in events:
+        if e.get("ph") == "X" and (cat is None or e.get("cat") == cat):
+            totals[e["name"]] = totals.get(e["name"], 0.0) + e["dur"] / 1000.0
+    return dict(sorted(totals.items(), key=lambda kv: -kv[1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a pipeline trace file (open it in ui.perfetto.dev for the timeline)")
+    parser.add_argument("trace")
+    parser.add_argument("--cat", default=None, help="Only spans of this category (stage, subprocess, step, ...)")
+    args = parser.parse_args(argv)
+
+    for name, ms in summarize(load_events(args.trace), args.cat).items():
+        print(f"{ms:10.1f} ms  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import time
+import uuid
+import io
+import base64
+import shutil
+import asyncio
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from master_pipeline import add_pipeline_args, StageRunner, ROI_PAD
+from batch_pipeline import build_batch, PAIR_OPTIONS
+from stage_cache import open_cache
+from stage_graph import run_graph
+from artifact_store import ARTIFACT_MODE_ENV
+from garment_catalog import catalog_ref, open_catalog
+import rembg_sessions
+
+# Model stages whose calls from concurrent jobs are merged into one worker request
+BATCHED_SCRIPTS = {"remove_background.py", "preprocess_garment.py", "run_schp.py", "run_densepose.py",
+                   "fvnt_flow_renderer.py", "run_stylevton.py"}
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+# Uploaded images are stored under the extension of their decoded format
+UPLOAD_FORMATS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+TERMINAL = ("done", "failed")
+
+
+class MicroBatcher:
+    """
+    Collects calls to the same (env, script) made by concurrent jobs for up to
+    `window` seconds, or until `max_batch` calls, and hands them to
+    `dispatch(env, script, [stage_args, ...]) -> [bool, ...]` as one batch.
+    Called from the stage graph threads; each caller blocks until its batch ran.
+    """
+
+    class _Batch:
+        def __init__(self):
+            self.items = []
+            self.results = None
+            self.full = threading.Event()
+            self.done = threading.Event()
+
+    def __init__(self, dispatch, window=0.03, max_batch=8):
+        self.dispatch = dispatch
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def __call__(self, env_name, script, stage_args):
+        key = (env_name, script)
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.pending[key] = self._Batch()
+            index = len(batch.items)
+            batch.items.append(stage_args)
+            if len(batch.items) >= self.max_batch:
+                del self.pending[key]
+                batch.full.set()
+
+        if not leader:
+            batch.done.wait()
+            return batch.results[index]
+
+        # The first caller waits out the window, then runs the whole batch
+        batch.full.wait(self.window)
+        with self.lock:
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+        try:
+            batch.results = self.dispatch(env_name, script, batch.items)
+        except Exception as e:
+            print(f"!!! Batch of {len(batch.items)}x {script} raised: {e!r}")
+            batch.results = [False] * len(batch.items)
+        batch.done.set()
+        return batch.results[index]
+
+
+def image_format(data):
+    """PIL format name of encoded image bytes (ValueError if they are not a readable image)."""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+            return img.format
+    except Exception as e:
+        raise ValueError(f"not an image: {e}")
+
+
+class Job:
+    def __init__(self, job_id, pair, job_dir, loop):
+        self.id = job_id
+        self.pair = pair
+        self.dir = job_dir
+        self.loop = loop
+        self.status = "queued"
+        self.created = time.time()
+        self.events = []
+        self.result = None
+        self._changed = asyncio.Event()
+        self.add_event("queued")
+
+    def add_event(self, event, stage=None, **extra):
+        """Records a progress event (event-loop thread only; see post_event)."""
+        if event in ("running",) + TERMINAL:
+            self.status = event
+        record = dict(extra, event=event, t=round(time.time() - self.created, 3))
+        if stage:
+            record["stage"] = stage
+        self.events.append(record)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def post_event(self, event, stage=None, **extra):
+        """Thread-safe add_event for the stage graph threads."""
+        self.loop.call_soon_threadsafe(lambda: self.add_event(event, stage, **extra))
+
+    async def wait_change(self):
+        await self._changed.wait()
+
+    def info(self):
+        return {"job_id": self.id, "status": self.status, "created": self.created,
+                "pair": {k: v for k, v in self.pair.items() if k in ["person", "garment"] + PAIR_OPTIONS},
+                "events": len(self.events), "result": self.result}
+
+
+class TryOnService:
+    def __init__(self, args):
+        self.args = args
+        # Stages always go to persistent workers: that is what keeps models warm between requests
+        args.use_workers = True
+        self.runner = StageRunner(args)
+        self.batcher = MicroBatcher(self.runner.run_batch, window=args.batch_window_ms / 1000.0, max_batch=args.max_batch)
+        self.cache = open_cache(args.cache_dir, args.cache_max_gb)
+        self.jobs = {}
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        os.environ[ARTIFACT_MODE_ENV] = args.artifact_mode
+        rembg_sessions.configure(args.rembg_person_model, args.rembg_garment_model, args.rembg_threads)
+
+    def run_stage(self, env_name, script, stage_args):
+        if script in BATCHED_SCRIPTS:
+            return self.batcher(env_name, script, stage_args)
+        return self.runner(env_name, script, stage_args)
+    # StageRunner interface used by build_batch / pair_stages
+    __call__ = run_stage
+
+    def role_runner(self):
+        role_envs = {"gen": self.args.dp_env, "dp": self.args.dp_env, "schp": self.args.schp_env}
+        return lambda role, script, stage_args: self.run_stage(role_envs[role], script, stage_args)
+
+    # ------------------------------------------------------------------
+    # Jobs
+    # ------------------------------------------------------------------
+    def input_path(self, path, trusted=False):
+        """
+        A server-side input path from a request, or None if it may not be used:
+        raw paths are only accepted below --input_root (and from the service itself).
+        """
+        real = os.path.realpath(path)
+        if not trusted:
+            if not self.args.input_root:
+                return None
+            root = os.path.realpath(self.args.input_root)
+            if os.path.commonpath([real, root]) != root:
+                return None
+        return real if os.path.isfile(real) else None
+
+    def create_job(self, request, trusted=False):
+        """
+        Validates a request body and stores its inputs. Returns the Job (not yet queued).
+        trusted: the request comes from the service itself (warmup), its paths are used as given.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = os.path.join(self.args.output_root, "jobs", job_id)
+        os.makedirs(os.path.join(job_dir, "inputs"), exist_ok=True)
+
+        pair = {k: request[k] for k in PAIR_OPTIONS if request.get(k)}
+        if request.get("garment_id"):
+            if not self.args.catalog or request["garment_id"] not in open_catalog(self.args.catalog):
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise ValueError(f"Unknown garment_id {request['garment_id']!r}")
+            pair["garment"] = catalog_ref(request["garment_id"])
+        for role in ["person", "garment"]:
+            if role in pair:
+                continue
+            if request.get(f"{role}_b64"):
+                try:
+                    data = base64.b64decode(request[f"{role}_b64"], validate=True)
+                    ext = UPLOAD_FORMATS.get(image_format(data))
+                except ValueError:
+                    ext = None
+                if ext is None:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    raise ValueError(f"'{role}_b64' must be a PNG, JPEG or WebP image")
+                # The file name comes from the decoded format only, never from the request
+                path = os.path.join(job_dir, "inputs", role + ext)
+                with open(path, "wb") as f:
+                    f.write(data)
+                pair[role] = path
+            elif request.get(role) and self.input_path(request[role], trusted):
+                pair[role] = self.input_path(request[role], trusted)
+            else:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                extra = " (or a catalog 'garment_id')" if role == "garment" else ""
+                where = f" or a file path below {self.args.input_root}" if self.args.input_root else " (server-side paths are disabled)"
+                raise ValueError(f"'{role}' must be '{role}_b64' image data{extra}{where}")
+        return Job(job_id, pair, job_dir, asyncio.get_running_loop())
+
+    def run_job(self, job, cache):
+        """Runs one job's stage graph (executor thread). Returns True on success."""
+        job_args = argparse.Namespace(**dict(vars(self.args), output_root=job.dir))
+        stages, results = build_batch([job.pair], job_args, self, cache)
+        ok = run_graph(stages, max_workers=self.args.jobs,
+                       on_event=lambda event, stage: job.post_event("stage_" + event, stage))
+        tryon, composite = results[0]["tryon"], results[0]["composite"]
+        if ok:
+            job.result = composite if os.path.exists(composite) else tryon
+        return ok
+
+    async def execute(self, job, cache):
+        job.add_event("running")
+        loop = asyncio.get_running_loop()
+        try:
+            ok = await loop.run_in_executor(self.executor, self.run_job, job, cache)
+        except Exception as e:
+            print(f"!!! Job {job.id} raised: {e!r}")
+            ok = False
+        job.add_event("done" if ok else "failed", result=job.result)
+        self.prune()
+
+    async def consume(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.execute(job, self.cache)
+            finally:
+                self.queue.task_done()
+
+    def prune(self):
+        """Forgets (and deletes) the oldest finished jobs beyond --keep_jobs."""
+        finished = sorted((j for j in self.jobs.values() if j.status in TERMINAL), key=lambda j: j.created)
+        for job in finished[:max(0, len(finished) - self.args.keep_jobs)]:
+            del self.jobs[job.id]
+            shutil.rmtree(job.dir, ignore_errors=True)
+
+    async def warmup(self):
+        """Runs one synthetic request through every stage so all workers load their models."""
+        from benchmark_pipeline import write_fixtures
+        print("[SERVICE] Warming up with a synthetic request...")
+        persons, garments = write_fixtures(os.path.join(self.args.output_root, "warmup_inputs"), 1024, 768, 1)
+        job = self.create_job({"person": persons[0], "garment": garments[0]}, trusted=True)
+        self.jobs[job.id] = job
+        start = time.time()
+        # Bypass the cache: a cache hit would skip the very model loads we want
+        await self.execute(job, None)
+        print(f"[SERVICE] Warmup {job.status} in {time.time() - start:.1f}s")
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                return await self.respond(writer, 413, {"error": "request body too large"})
+            body = await reader.readexactly(length) if length else b""
+            await self.route(method, target.split("?", 1)[0], body, writer)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self.respond(writer, 400, {"error": str(e)})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                await self.respond(writer, 500, {"error": f"internal error: {e!r}"})
+            except ConnectionError:
+                pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def route(self, method, path, body, writer):
+        parts = [p for p in path.split("/") if p]
+        if method == "GET" and parts == ["health"]:
+            return await self.respond(writer, 200, {"ok": True, "queued": self.queue.qsize(),
+                                                    "queue_size": self.args.queue_size, "jobs": len(self.jobs)})
+        if method == "POST" and parts == ["tryon"]:
+            return await self.submit(body, writer)
+        if len(parts) >= 2 and parts[0] == "jobs" and method == "GET":
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return await self.respond(writer, 404, {"error": "unknown job"})
+            if len(parts) == 2:
+                return await self.respond(writer, 200, job.info())
+            if parts[2:] == ["events"]:
+                return await self.stream_events(job, writer)
+            if parts[2:] == ["result"]:
+                if job.status != "done":
+                    return await self.respond(writer, 409, {"error": f"job is {job.status}"})
+                try:
+                    with open(job.result, "rb") as f:
+                        data = f.read()
+                except OSError:
+                    return await self.respond(writer, 410, {"error": "result file is no longer available"})
+                return await self.respond(writer, 200, data, content_type="image/png")
+        await self.respond(writer, 404, {"error": f"no route for {method} {path}"})
+
+    async def submit(self, body, writer):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return await self.respond(writer, 400, {"error": "body must be JSON"})
+        # Backpressure: refuse early instead of queueing work we cannot start soon
+        if self.queue.full():
+            return await self.respond(writer, 503, {"error": "queue full, retry later"}, headers={"Retry-After": "5"})
+        try:
+            job = self.create_job(request)
+        except ValueError as e:
+            return await self.respond(writer, 400, {"error": str(e)})
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            shutil.rmtree(job.dir, ignore_errors=True)
+            return await self.respond(writer, 503, {"error": "queue full, retry later"}, headers={"Retry-After": "5"})
+        self.jobs[job.id] = job
+        await self.respond(writer, 202, {"job_id": job.id, "status": job.status,
+                                         "events": f"/jobs/{job.id}/events", "result": f"/jobs/{job.id}/result"})
+
+    async def stream_events(self, job, writer):
+        """Server-sent events: everything so far, then live progress until the job ends."""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        sent = 0
+        while True:
+            while sent < len(job.events):
+                record = job.events[sent]
+                writer.write(f"event: {record['event']}\ndata: {json.dumps(record)}\n\n".encode())
+                sent += 1
+            await writer.drain()
+            if job.status in TERMINAL:
+                return
+            await job.wait_change()
+
+    async def respond(self, writer, status, payload, content_type="application/json", headers=None):
+        reasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 409: "Conflict",
+                   410: "Gone", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        head = [f"HTTP/1.1 {status} {reasons.get(status, '')}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(data)}", "Connection: close"]
+        head += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+        await writer.drain()
+
+    async def serve(self):
+        self.queue = asyncio.Queue(maxsize=self.args.queue_size)
+        if not self.args.no_warmup:
+            await self.warmup()
+        consumers = [asyncio.create_task(self.consume()) for _ in range(self.args.concurrency)]
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        print(f"[SERVICE] Listening on http://{self.args.host}:{self.args.port}")
+        sys.stdout.flush()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in consumers:
+                task.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP try-on service (POST /tryon, GET /jobs/<id>[/events|/result])")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--queue_size", type=int, default=16, help="Queued jobs before POST /tryon answers 503")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs whose stage graphs run at the same time")
+    parser.add_argument("--batch_window_ms", type=float, default=30.0, help="How long a model stage waits for calls from other jobs")
+    parser.add_argument("--max_batch", type=int, default=8, help="Max calls merged into one model stage batch")
+    parser.add_argument("--keep_jobs", type=int, default=100, help="Finished jobs kept (older ones are deleted)")
+    parser.add_argument("--input_root", default=None,
+                        help="Allow requests to name server-side input files below this folder (default: uploads only)")
+    parser.add_argument("--no_warmup", action="store_true", help="Skip the synthetic warmup request at startup")
+    add_pipeline_args(parser)
+    parser.set_defaults(roi_pad=ROI_PAD)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_root, exist_ok=True)
+    service = TryOnService(args)
+    if args.stop_workers:
+        service.runner.stop_workers()
+        return
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        print("[SERVICE] Stopped.")
+
+if __name__ == "__main__":
+    main()